@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import asyncio
+import ssl
+import time
+
+from typing import Dict, Optional
+from urllib import parse
+
+# Minimal asyncio HTTP/1.1 client with keep-alive, used by the load and probe
+# tools. Only what nginx serves to players is supported: Content-Length and
+# chunked bodies, one request at a time per connection.
+
+DEFAULT_TIMEOUT = 10
+READ_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class HttpError(Exception):
+    pass
+
+
+class Response:
+    __slots__ = ("status", "headers", "body", "size", "ttfb", "elapsed")
+
+    def __init__(self, status: int, headers: Dict[str, str], body: Optional[bytes], size: int, ttfb: float,
+                 elapsed: float):
+        self.status = status
+        self.headers = headers
+        # None when the body was discarded (keep_body=False)
+        self.body = body
+        self.size = size
+        # seconds from sending the request to the first byte of the response
+        self.ttfb = ttfb
+        self.elapsed = elapsed
+
+
+class HttpClient:
+    # server_name: name sent as SNI and Host instead of the url host, for nodes reached through an address
+    # verify: check the certificate chain and name of HTTPS servers
+    def __init__(self, base_url: str, timeout: float = DEFAULT_TIMEOUT, server_name: Optional[str] = None,
+                 verify: bool = True):
+        url = parse.urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported url: {base_url}")
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = None  # type: Optional[ssl.SSLContext]
+        if url.scheme == "https":
+            self.ssl = ssl.create_default_context()
+            if not verify:
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+        self.timeout = timeout
+        self.server_name = server_name
+        self.host_header = f"{server_name}:{self.port}" if server_name else url.netloc
+        # seconds the last connect (TCP and TLS handshake) took
+        self.connect_time = None  # type: Optional[float]
+        self._reader = None  # type: Optional[asyncio.StreamReader]
+        self._writer = None  # type: Optional[asyncio.StreamWriter]
+
+    async def _connect(self) -> None:
+        started = time.monotonic()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl,
+                                    server_hostname=self.server_name if self.ssl else None), self.timeout
+        )
+        self.connect_time = time.monotonic() - started
+
+    async def close(self) -> None:
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (OSError, AttributeError):
+                pass
+        self._reader = self._writer = None
+
+    async def request(self, method: str, path: str, headers: Optional[Dict[str, str]] = None,
+                      keep_body: bool = True) -> Response:
+        # a kept-alive connection may have been closed by the server meanwhile
+        reused = self._writer is not None
+        try:
+            return await asyncio.wait_for(self._request(method, path, headers, keep_body), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError) as ex:
+            await self.close()
+            if not reused:
+                raise HttpError(str(ex)) from ex
+        except asyncio.TimeoutError as ex:
+            await self.close()
+            raise HttpError(f"timeout after {self.timeout}s") from ex
+        try:
+            return await asyncio.wait_for(self._request(method, path, headers, keep_body), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as ex:
+            await self.close()
+            raise HttpError(str(ex) or type(ex).__name__) from ex
+
+    async def _request(self, method: str, path: str, headers: Optional[Dict[str, str]],
+                       keep_body: bool) -> Response:
+        if not self._writer:
+            await self._connect()
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host_header}", "User-Agent: fastocloud-env"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        started = time.monotonic()
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await self._writer.drain()
+
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        ttfb = time.monotonic() - started
+        if len(head) > MAX_HEADER_SIZE:
+            raise HttpError("response header too large")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        try:
+            status = int(status_line.split(" ", 2)[1])
+        except (IndexError, ValueError):
+            raise HttpError(f"bad status line: {status_line!r}")
+        response_headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                response_headers[name.strip().lower()] = value.strip()
+
+        chunks = [] if keep_body else None
+        size = 0
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if chunk_size == 0:
+                    # trailers
+                    while await self._reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                size += await self._read_body(chunk_size, chunks)
+                await self._reader.readexactly(2)
+        elif "content-length" in response_headers:
+            size = await self._read_body(int(response_headers["content-length"]), chunks)
+        else:
+            # body runs to the end of the connection
+            while True:
+                data = await self._reader.read(READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if chunks is not None:
+                    chunks.append(data)
+            await self.close()
+
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+
+        body = b"".join(chunks) if chunks is not None else None
+        return Response(status, response_headers, body, size, ttfb, time.monotonic() - started)
+
+    async def _read_body(self, length: int, chunks: Optional[list]) -> int:
+        left = length
+        while left:
+            data = await self._reader.read(min(left, READ_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", left)
+            left -= len(data)
+            if chunks is not None:
+                chunks.append(data)
+        return length
@@ -8,13 +8,22 @@ if sys.version_info < (3, 10):  # pyfastostream
 
 import argparse
 import os
+import pwd
+import re
 import subprocess
 import shutil
+import tarfile
+import time
+import urllib.request
 from abc import ABCMeta, abstractmethod
 
 from pyfastogt import system_info, build_utils, utils
 
 from check_plugins import check_plugins
+import env_bundle
+import live_storage
+import system_tuning
+import ttl_janitor
 
 _file_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -22,7 +31,32 @@ _file_path = os.path.dirname(os.path.abspath(__file__))
 
 DEFAULT_HOSTNAME = "fastocloud.com"
 
+NGINX_LUA_DIR = "/etc/nginx/lua"
+NGINX_LUA_CONFIG = "fastocloud_lua"
+# log format and maps used by the access_log of every site: conf.d is included before sites-enabled
+NGINX_COMMON_CONFIG = "fastocloud_common"
+NGINX_CONF_DIR = "/etc/nginx/conf.d"
+
+# CODS touch tracking (see nginx/lua/fastocloud/touched.lua)
+DEFAULT_CODS_STREAMS = 1000
+DEFAULT_CODS_TOUCH_TTL = 3600
+CODS_TOUCH_LOG_TTL = 120
+CODS_TOUCH_INTERVAL = 5
+# Upper bound of one lua_shared_dict entry: rbtree node, key and value rounded up to the slab size
+NGINX_SHDICT_ENTRY_SIZE = 256
+
 GSTREAMER_SRC_ROOT = "https://gstreamer.freedesktop.org/src/"
+# tracer hooks and the core tracers, kept on for gst_profile.py
+GSTREAMER_TRACER_FLAGS = ['-Dtracer_hooks=true', '-Dcoretracers=enabled']
+# --production-core: the debug log, extra checks, GLib assertions and tracer hooks compiled out of the core.
+# The plugins inherit GST_DISABLE_GST_DEBUG from the installed gstconfig.h, so their GST_DEBUG_OBJECT
+# call sites go as well; only the GLib checks and what is not installed are switched off for them.
+GSTREAMER_PRODUCTION_CORE_FLAGS = ['-Dgst_debug=false', '-Dextra-checks=disabled', '-Dtracer_hooks=false',
+                                   '-Dcoretracers=disabled', '-Dglib_debug=disabled', '-Dglib_assert=false',
+                                   '-Dglib_checks=false', '-Dcheck=disabled', '-Dbenchmarks=disabled',
+                                   '-Dexamples=disabled', '-Dtests=disabled', '-Ddoc=disabled']
+GSTREAMER_PRODUCTION_PLUGIN_FLAGS = ['-Dglib_debug=disabled', '-Dglib_assert=false', '-Dglib_checks=false',
+                                     '-Dtests=disabled', '-Ddoc=disabled']
 GSTREAMER_ARCH_COMP = "xz"
 GSTREAMER_ARCH_EXT = "tar." + GSTREAMER_ARCH_COMP
 
@@ -58,6 +92,7 @@ AWS_S3_URL = 'https://github.com/amzn/amazon-s3-gst-plugin'  # --with-gst-awss3
 GST_NICE_URL = 'https://gitlab.freedesktop.org/libnice/libnice'
 # WPE elements (wpesrc, wpevideosrc) are built-in to gst-plugins-bad since 1.16
 GST_CEF_URL = 'https://github.com/centricular/gstcefsrc'  # --with-gst-cef (cefsrc element)
+GST_SHARK_URL = 'https://github.com/RidgeRun/gst-shark'  # --with-gst-shark (proctime, queuelevel, cpuusage tracers)
 
 NDI_URL = 'https://github.com/Palakis/obs-ndi'
 FAAC_URL = 'https://github.com/knik0/faac/archive/1_30.tar.gz'
@@ -88,6 +123,72 @@ SRT_SRC_URL = 'https://github.com/Haivision/srt/archive'
 SRT_ARCH_COMP = 'gz'
 SRT_ARCH_EXT = 'tar.' + SRT_ARCH_COMP
 
+# nginx from source (--nginx-from-source)
+NGINX_SRC_URL = 'https://nginx.org/download'
+NGINX_ARCH_COMP = 'gz'
+NGINX_ARCH_EXT = 'tar.' + NGINX_ARCH_COMP
+LUAJIT_URL = 'https://github.com/openresty/luajit2/archive/refs/tags/v2.1-20240815.tar.gz'
+NGINX_DEVEL_KIT_URL = 'https://github.com/vision5/ngx_devel_kit/archive/refs/tags/v0.3.3.tar.gz'
+NGINX_LUA_MODULE_URL = 'https://github.com/openresty/lua-nginx-module/archive/refs/tags/v0.10.27.tar.gz'
+LUA_RESTY_CORE_URL = 'https://github.com/openresty/lua-resty-core/archive/refs/tags/v0.1.29.tar.gz'
+LUA_RESTY_LRUCACHE_URL = 'https://github.com/openresty/lua-resty-lrucache/archive/refs/tags/v0.14.tar.gz'
+NGINX_VOD_MODULE_URL = 'https://github.com/kaltura/nginx-vod-module/archive/refs/tags/1.33.tar.gz'  # --with-nginx-vod
+NGINX_BROTLI_URL = 'https://github.com/google/ngx_brotli'  # --with-nginx-brotli
+
+NGINX_CONFIG_PATH = '/etc/nginx/nginx.conf'
+NGINX_SYSTEMD_UNIT_PATH = '/etc/systemd/system/nginx.service'
+
+NGINX_MAIN_CONFIG_TEMPLATE = """user {user};
+worker_processes auto;
+worker_rlimit_nofile 65535;
+pid /run/nginx.pid;
+
+# Segment and VOD reads are offloaded from the event loop
+thread_pool default threads=32 max_queue=65536;
+
+events {{
+    worker_connections 16384;
+    multi_accept on;
+}}
+
+http {{
+    include mime.types;
+    default_type application/octet-stream;
+
+    sendfile on;
+    tcp_nopush on;
+    tcp_nodelay on;
+    aio threads;
+    keepalive_timeout 65;
+    server_tokens off;
+
+    access_log /var/log/nginx/access.log;
+    error_log /var/log/nginx/error.log;
+
+    include /etc/nginx/conf.d/*.conf;
+    include /etc/nginx/sites-enabled/*;
+}}
+"""
+
+NGINX_SYSTEMD_UNIT = """[Unit]
+Description=nginx (FastoCloud build)
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=forking
+PIDFile=/run/nginx.pid
+ExecStartPre=/usr/sbin/nginx -t -q
+ExecStart=/usr/sbin/nginx
+ExecReload=/usr/sbin/nginx -s reload
+ExecStop=/bin/kill -s QUIT $MAINPID
+TimeoutStopSec=5
+KillMode=mixed
+
+[Install]
+WantedBy=multi-user.target
+"""
+
 
 class OperationSystem(metaclass=ABCMeta):
     @abstractmethod
@@ -117,6 +218,9 @@ class OperationSystem(metaclass=ABCMeta):
     def get_gst_repo_libs(self):
         pass
 
+    def get_nginx_build_libs(self) -> list:
+        return []
+
 
 class Debian(OperationSystem):
     def get_required_exec(self) -> list:
@@ -158,6 +262,9 @@ class Debian(OperationSystem):
                 'gstreamer1.0-plugins-base', 'gstreamer1.0-plugins-good', 'gstreamer1.0-plugins-bad',
                 'gstreamer1.0-plugins-ugly', 'gstreamer1.0-libav', 'gstreamer1.0-nice', 'gstreamer1.0-rtsp']
 
+    def get_nginx_build_libs(self) -> list:
+        return ['libpcre2-dev', 'zlib1g-dev', 'libssl-dev']
+
 
 class RedHat(OperationSystem):
     def get_required_exec(self) -> list:
@@ -192,6 +299,9 @@ class RedHat(OperationSystem):
                 'gstreamer1-plugins-bad-free', 'gstreamer1-plugins-ugly-free', 'gstreamer1-libav',
                 'gstreamer1-nice', 'gstreamer1-rtsp-server']
 
+    def get_nginx_build_libs(self) -> list:
+        return ['pcre2-devel', 'zlib-devel', 'openssl-devel']
+
 
 class Arch(OperationSystem):
     def get_required_exec(self) -> list:
@@ -223,6 +333,9 @@ class Arch(OperationSystem):
                 'gstreamer-plugins-bad', 'gstreamer-plugins-ugly', 'gstreamer-libav', 'gstreamer-nice',
                 'gstreamer-rtsp-server']
 
+    def get_nginx_build_libs(self) -> list:
+        return ['pcre2', 'zlib', 'openssl']
+
 
 class FreeBSD(OperationSystem):
     def get_required_exec(self) -> list:
@@ -336,22 +449,88 @@ class MacOSX(OperationSystem):
 
 
 class BuildRequest(build_utils.BuildRequest):
-    def __init__(self, host, platform, arch_name, dir_path, prefix_path):
+    def __init__(self, host, platform, arch_name, dir_path, prefix_path, production_core=False):
+        # the build steps write their install logs under it, taken before the base class may chdir
+        self.env_build_dir = os.path.abspath(dir_path)
         build_utils.BuildRequest.__init__(
             self, platform, arch_name, dir_path, prefix_path)
 
         self.host = host
+        self.production_core = production_core
+        self.env_prefix = prefix_path if prefix_path else env_bundle.DEFAULT_PREFIX
+
+    def get_gstreamer_plugin_flags(self, compiler_flags):
+        if self.production_core:
+            return compiler_flags + GSTREAMER_PRODUCTION_PLUGIN_FLAGS
+        return compiler_flags
+
+    # Components are recorded in the manifest of the prefix (see env_bundle.py) as they are built,
+    # with the files each step installed, so an environment can be removed without globbing
+    def record_component(self, url, compiler_flags, since, branch=None):
+        env_bundle.record_component(self.env_prefix, url, compiler_flags, branch, since, self.env_build_dir)
+
+    def download_and_build_via_meson(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.download_and_build_via_meson(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since)
+
+    def download_and_build_via_cmake(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.download_and_build_via_cmake(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since)
+
+    def download_and_build_via_bootstrap(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.download_and_build_via_bootstrap(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since)
+
+    def clone_and_build_via_meson(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.clone_and_build_via_meson(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since, kwargs.get('branch'))
+
+    def clone_and_build_via_meson_system(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.clone_and_build_via_meson_system(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since, kwargs.get('branch'))
+
+    def clone_and_build_via_cmake(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.clone_and_build_via_cmake(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since, kwargs.get('branch'))
+
+    def clone_and_build_via_configure(self, url, compiler_flags, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.clone_and_build_via_configure(self, url, compiler_flags, *args, **kwargs)
+        self.record_component(url, compiler_flags, since, kwargs.get('branch'))
+
+    def clone_and_build_via_cargo_c_arr(self, url, plugins, *args, **kwargs):
+        since = time.time()
+        build_utils.BuildRequest.clone_and_build_via_cargo_c_arr(self, url, plugins, *args, **kwargs)
+        self.record_component(url, plugins, since, kwargs.get('branch'))
+
+    def start_bundle(self):
+        env_bundle.start_manifest(self.env_prefix)
+
+    # OPTIONAL: export the installed environment as tarball/.deb/.rpm bundles (default: OFF, requires --bundle-dir)
+    # Deploy on nodes of the same distribution with: python3 env_bundle.py install <bundle>
+    def export_bundle(self, output_dir, version, formats):
+        platform = self.platform()
+        if platform.name() != 'linux':
+            print("Warning: environment bundles are supported only on Linux")
+            return
 
-    def get_system_libs(self, with_nvidia, with_wpe, with_gstreamer, repo_build):
+        for bundle in env_bundle.create(self.env_prefix, output_dir, version, formats):
+            print('Wrote bundle: {0}'.format(bundle))
+
+    def get_current_system(self) -> OperationSystem:
         platform = self.platform_
         platform_name = platform.name()
         ar = platform.architecture()
-        dep_libs = []
 
         current_system = None
         if platform_name == 'linux':
             distribution = system_info.linux_get_dist()
-            self.set_linux_hostname()
             if distribution == 'DEBIAN':
                 current_system = Debian()
             elif distribution == 'RHEL':
@@ -371,6 +550,15 @@ class BuildRequest(build_utils.BuildRequest):
         if not current_system:
             raise NotImplementedError("Unknown platform '%s'" % platform_name)
 
+        return current_system
+
+    def get_system_libs(self, with_nvidia, with_wpe, with_gstreamer, repo_build):
+        dep_libs = []
+
+        if self.platform_.name() == 'linux':
+            self.set_linux_hostname()
+        current_system = self.get_current_system()
+
         dep_libs.extend(current_system.get_required_exec())
         dep_libs.extend(current_system.get_build_exec())
 
@@ -451,8 +639,10 @@ class BuildRequest(build_utils.BuildRequest):
     def install_cargo_c(self):
         self.install_via_cargo('cargo-c')
 
-    def install_nginx(self):
-        self.install_package('nginx')
+    def install_nginx(self, from_source=False, cods_streams=DEFAULT_CODS_STREAMS,
+                      cods_touch_ttl=DEFAULT_CODS_TOUCH_TTL):
+        if not from_source:
+            self.install_package('nginx')
         # post install step
         platform = self.platform()
         platform_name = platform.name()
@@ -473,7 +663,151 @@ class BuildRequest(build_utils.BuildRequest):
                     continue
                 dstname = os.path.join(dst, name)
                 print(f"Installing nginx config: {name}")
-                shutil.copy2(srcname, dstname)
+                if name == NGINX_COMMON_CONFIG:
+                    # installed into sites-enabled before, where the sites sorting first did not see it
+                    if os.path.exists(dstname):
+                        os.remove(dstname)
+                    os.makedirs(NGINX_CONF_DIR, exist_ok=True)
+                    shutil.copy2(srcname, os.path.join(NGINX_CONF_DIR, name + '.conf'))
+                elif name == NGINX_LUA_CONFIG:
+                    self.install_nginx_lua_config(srcname, dstname, cods_streams, cods_touch_ttl)
+                else:
+                    shutil.copy2(srcname, dstname)
+
+            lua_src = os.path.join(src, "lua")
+            if os.path.isdir(lua_src):
+                print(f"Installing nginx lua modules: {NGINX_LUA_DIR}")
+                shutil.copytree(lua_src, NGINX_LUA_DIR, dirs_exist_ok=True)
+
+    def install_nginx_lua_config(self, src, dst, cods_streams, cods_touch_ttl):
+        # every stream has one touch entry and up to one index record per touch interval (of all workers together)
+        touched_size = nginx_zone_size(cods_streams)
+        log_size = nginx_zone_size(cods_streams * (CODS_TOUCH_LOG_TTL // CODS_TOUCH_INTERVAL + 1))
+        print(f"Sizing touch tracking for {cods_streams} streams: touched_files {touched_size}, "
+              f"touched_files_log {log_size}")
+
+        with open(src, "r") as f:
+            config = f.read()
+
+        config = re.sub(r'lua_shared_dict touched_files \S+;', f'lua_shared_dict touched_files {touched_size};',
+                        config)
+        config = re.sub(r'lua_shared_dict touched_files_log \S+;', f'lua_shared_dict touched_files_log {log_size};',
+                        config)
+        config = re.sub(r'stream_ttl = \d+', f'stream_ttl = {cods_touch_ttl}', config)
+
+        with open(dst, "w") as f:
+            f.write(config)
+
+    # OPTIONAL: nginx from source (default: OFF, requires --nginx-from-source)
+    # Built with LuaJIT (lua-nginx-module, needed by fastocloud_cods_84), thread pool aio and the mp4/slice
+    # modules, plus the optional kaltura VOD packager and brotli. Installed with the Debian layout
+    # (/usr/sbin/nginx, /etc/nginx) so install_nginx places the site configs as for the distro package.
+    def build_nginx(self, version, cc_opt, with_vod, with_brotli):
+        for lib in self.get_current_system().get_nginx_build_libs():
+            self.install_package(lib)
+
+        local_prefix = '/usr/local'
+        src_dir = os.path.abspath('nginx_src')
+        os.makedirs(src_dir, exist_ok=True)
+        make = ['make', '-j{0}'.format(os.cpu_count() or 1)]
+
+        luajit_dir = download_and_extract(LUAJIT_URL, src_dir, 'luajit2')
+        subprocess.check_call(make + ['PREFIX={0}'.format(local_prefix)], cwd=luajit_dir)
+        subprocess.check_call(['make', 'install', 'PREFIX={0}'.format(local_prefix)], cwd=luajit_dir)
+
+        # lua-nginx-module refuses to start without resty.core and resty.lrucache
+        for url, name in ((LUA_RESTY_CORE_URL, 'lua-resty-core'), (LUA_RESTY_LRUCACHE_URL, 'lua-resty-lrucache')):
+            lib_dir = download_and_extract(url, src_dir, name)
+            subprocess.check_call(['make', 'install', 'PREFIX={0}'.format(local_prefix),
+                                   'LUA_LIB_DIR={0}/share/lua/5.1'.format(local_prefix)], cwd=lib_dir)
+
+        modules = [download_and_extract(NGINX_DEVEL_KIT_URL, src_dir, 'ngx_devel_kit'),
+                   download_and_extract(NGINX_LUA_MODULE_URL, src_dir, 'lua-nginx-module')]
+        if with_vod:
+            modules.append(download_and_extract(NGINX_VOD_MODULE_URL, src_dir, 'nginx-vod-module'))
+        if with_brotli:
+            brotli_dir = os.path.join(src_dir, 'ngx_brotli')
+            if os.path.exists(brotli_dir):
+                shutil.rmtree(brotli_dir)
+            subprocess.check_call(['git', 'clone', '--depth', '1', '--recurse-submodules', '--shallow-submodules',
+                                   NGINX_BROTLI_URL, brotli_dir])
+            modules.append(brotli_dir)
+
+        url = '{0}/nginx-{1}.{2}'.format(NGINX_SRC_URL, version, NGINX_ARCH_EXT)
+        nginx_dir = download_and_extract(url, src_dir, 'nginx')
+        configure = ['./configure',
+                     '--prefix=/usr/share/nginx',
+                     '--sbin-path=/usr/sbin/nginx',
+                     '--modules-path=/usr/lib/nginx/modules',
+                     '--conf-path={0}'.format(NGINX_CONFIG_PATH),
+                     '--error-log-path=/var/log/nginx/error.log',
+                     '--http-log-path=/var/log/nginx/access.log',
+                     '--pid-path=/run/nginx.pid',
+                     '--lock-path=/var/lock/nginx.lock',
+                     '--with-threads',
+                     '--with-file-aio',
+                     '--with-pcre-jit',
+                     '--with-http_ssl_module',
+                     '--with-http_v2_module',
+                     '--with-http_stub_status_module',
+                     '--with-http_realip_module',
+                     '--with-http_mp4_module',
+                     '--with-http_slice_module',
+                     '--with-http_gzip_static_module',
+                     '--with-cc-opt={0}'.format(cc_opt),
+                     '--with-ld-opt=-Wl,-rpath,{0}/lib'.format(local_prefix)]
+        configure.extend(['--add-module={0}'.format(module) for module in modules])
+
+        env = os.environ.copy()
+        env['LUAJIT_LIB'] = '{0}/lib'.format(local_prefix)
+        env['LUAJIT_INC'] = '{0}/include/luajit-2.1'.format(local_prefix)
+        subprocess.check_call(configure, cwd=nginx_dir, env=env)
+        subprocess.check_call(make, cwd=nginx_dir, env=env)
+
+        # make install keeps an existing nginx.conf, so ours has to be in place first
+        os.makedirs('/var/log/nginx', exist_ok=True)
+        os.makedirs(os.path.dirname(NGINX_CONFIG_PATH), exist_ok=True)
+        os.makedirs('/etc/nginx/conf.d', exist_ok=True)
+        if not os.path.exists(NGINX_CONFIG_PATH):
+            with open(NGINX_CONFIG_PATH, 'w') as f:
+                f.write(NGINX_MAIN_CONFIG_TEMPLATE.format(user=nginx_user()))
+        subprocess.check_call(['make', 'install'], cwd=nginx_dir, env=env)
+
+        if self.platform().name() == 'linux' and not os.path.exists('/lib/systemd/system/nginx.service'):
+            with open(NGINX_SYSTEMD_UNIT_PATH, 'w') as f:
+                f.write(NGINX_SYSTEMD_UNIT)
+            subprocess.call(['systemctl', 'daemon-reload'])
+            subprocess.call(['systemctl', 'enable', 'nginx'])
+
+    # OPTIONAL: tmpfs for the live hls/cods/proxy trees (default: OFF, requires --with-tmpfs-live-storage)
+    def setup_live_storage(self, hls_channels, cods_channels, proxy_channels, bitrate_kbps, window_seconds):
+        platform = self.platform()
+        if platform.name() != 'linux':
+            print("Warning: RAM-backed live storage is supported only on Linux")
+            return
+
+        channels = {'hls': hls_channels, 'cods': cods_channels, 'proxy': proxy_channels}
+        live_storage.setup(channels, bitrate_kbps, window_seconds, live_storage.DEFAULT_HEADROOM,
+                           live_storage.DEFAULT_THRESHOLD, self.env_prefix)
+
+    # OPTIONAL: sysctl and file descriptor limits profile (default: OFF, requires --tune-system)
+    # Revert with: python3 system_tuning.py revert
+    def tune_system(self):
+        platform = self.platform()
+        if platform.name() != 'linux':
+            print("Warning: system tuning is supported only on Linux")
+            return
+
+        system_tuning.apply()
+
+    # OPTIONAL: TTL janitor service for the cods/hls/proxy trees (default: OFF, requires --with-ttl-janitor)
+    def install_ttl_janitor(self):
+        platform = self.platform()
+        if platform.name() != 'linux':
+            print("Warning: the TTL janitor is supported only on Linux")
+            return
+
+        ttl_janitor.install(self.env_prefix)
 
     def build_faac(self):
         compiler_flags = []
@@ -558,12 +892,17 @@ class BuildRequest(build_utils.BuildRequest):
 
     def build_gstreamer(self, version):
         compiler_flags = ['--buildtype=release', '-Dintrospection=disabled']
+        if self.production_core:
+            compiler_flags += GSTREAMER_PRODUCTION_CORE_FLAGS
+        else:
+            compiler_flags += GSTREAMER_TRACER_FLAGS
         url = '{0}gstreamer/gstreamer-{1}.{2}'.format(
             GSTREAMER_SRC_ROOT, version, GSTREAMER_ARCH_EXT)
         self.download_and_build_via_meson(url, compiler_flags, [])
 
     def build_gst_plugins_base(self, version):
         compiler_flags = ['--buildtype=release', '-Dexamples=disabled', '-Dintrospection=disabled']
+        compiler_flags = self.get_gstreamer_plugin_flags(compiler_flags)
         url = '{0}gst-plugins-base/gst-plugins-base-{1}.{2}'.format(
             GST_PLUGINS_BASE_SRC_ROOT, version, GST_PLUGINS_BASE_ARCH_EXT)
         patch_files = [
@@ -577,12 +916,14 @@ class BuildRequest(build_utils.BuildRequest):
 
     def build_gst_plugins_good(self, version):
         compiler_flags = ['--buildtype=release']  # Note: gst-plugins-good does not support -Dintrospection
+        compiler_flags = self.get_gstreamer_plugin_flags(compiler_flags)
         url = '{0}gst-plugins-good/gst-plugins-good-{1}.{2}'.format(GST_PLUGINS_GOOD_SRC_ROOT, version,
                                                                     GST_PLUGINS_GOOD_ARCH_EXT)
         self.download_and_build_via_meson(url, compiler_flags, [])
 
     def build_gst_plugins_bad(self, version, mfx: bool, vaapi: bool):
         compiler_flags = ['--buildtype=release', '-Dgpl=enabled', '-Dintrospection=disabled']
+        compiler_flags = self.get_gstreamer_plugin_flags(compiler_flags)
         url = '{0}gst-plugins-bad/gst-plugins-bad-{1}.{2}'.format(GST_PLUGINS_BAD_SRC_ROOT, version,
                                                                   GST_PLUGINS_BAD_ARCH_EXT)
         patch_files = [
@@ -603,6 +944,7 @@ class BuildRequest(build_utils.BuildRequest):
 
     def build_gst_plugins_ugly(self, version):
         compiler_flags = ['--buildtype=release', '-Dgpl=enabled']  # Note: gst-plugins-ugly does not support -Dintrospection
+        compiler_flags = self.get_gstreamer_plugin_flags(compiler_flags)
         url = '{0}gst-plugins-ugly/gst-plugins-ugly-{1}.{2}'.format(GST_PLUGINS_UGLY_SRC_ROOT, version,
                                                                     GST_PLUGINS_UGLY_ARCH_EXT)
         self.download_and_build_via_meson(url, compiler_flags, [])
@@ -637,7 +979,7 @@ class BuildRequest(build_utils.BuildRequest):
     def build_gst_libav(self, version):
         # gst-libav 1.26 dropped the `introspection` meson option (libav has
         # no public API to introspect — it's a thin wrapper around ffmpeg).
-        compiler_flags = ['--buildtype=release']
+        compiler_flags = self.get_gstreamer_plugin_flags(['--buildtype=release'])
         url = '{0}gst-libav/gst-libav-{1}.{2}'.format(
             GST_LIBAV_SRC_ROOT, version, GST_LIBAV_ARCH_EXT)
         self.download_and_build_via_meson(url, compiler_flags, [])
@@ -647,7 +989,7 @@ class BuildRequest(build_utils.BuildRequest):
         self.clone_and_build_via_meson(GST_NICE_URL, compiler_flags)
 
     def build_gst_rtsp(self, version):
-        compiler_flags = ['--buildtype=release', '-Dintrospection=disabled']
+        compiler_flags = self.get_gstreamer_plugin_flags(['--buildtype=release', '-Dintrospection=disabled'])
         url = '{0}gst-rtsp-server/gst-rtsp-server-{1}.{2}'.format(
             GST_RTSP_SRC_ROOT, version, GST_RTSP_ARCH_EXT)
         self.download_and_build_via_meson(url, compiler_flags, [])
@@ -658,6 +1000,56 @@ class BuildRequest(build_utils.BuildRequest):
         compiler_flags = ['--buildtype=release', '-Dintrospection=disabled']
         self.clone_and_build_via_meson(GST_CEF_URL, compiler_flags)
 
+    # OPTIONAL: GstShark tracers (proctime, queuelevel, cpuusage) used by gst_profile.py
+    # (default: OFF, requires --with-gst-shark)
+    def build_gst_shark(self):
+        compiler_flags = ['--buildtype=release']
+        self.clone_and_build_via_meson(GST_SHARK_URL, compiler_flags)
+
+
+def download_and_extract(url, dst_dir, name):
+    archive_path = os.path.join(dst_dir, name + '.tar')
+    extract_dir = os.path.join(dst_dir, name)
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+
+    print("Downloading {0}".format(url))
+    urllib.request.urlretrieve(url, archive_path)
+    with tarfile.open(archive_path) as archive:
+        top_dir = archive.getnames()[0].split('/')[0]
+        if hasattr(tarfile, 'data_filter'):
+            # refuses absolute paths, .. and links leaving dst_dir, drops setuid bits
+            archive.extractall(dst_dir, filter='data')
+        else:
+            # Python before 3.10.12 has no extraction filters
+            for member in archive.getmembers():
+                path = os.path.realpath(os.path.join(dst_dir, member.name))
+                if not path.startswith(os.path.realpath(dst_dir) + os.sep) or member.islnk() or \
+                        (member.issym() and os.path.isabs(member.linkname)) or '..' in member.linkname.split('/'):
+                    raise RuntimeError('unsafe path in {0}: {1}'.format(url, member.name))
+            archive.extractall(dst_dir)
+    os.remove(archive_path)
+
+    os.rename(os.path.join(dst_dir, top_dir), extract_dir)
+    return extract_dir
+
+
+def nginx_user():
+    for user in ('www-data', 'nginx'):
+        try:
+            pwd.getpwnam(user)
+            return user
+        except KeyError:
+            continue
+
+    subprocess.check_call(['useradd', '--system', '--no-create-home', '--shell', '/sbin/nologin', 'nginx'])
+    return 'nginx'
+
+
+def nginx_zone_size(entries):
+    megabytes = -(-entries * NGINX_SHDICT_ENTRY_SIZE // (1024 * 1024))
+    return '{0}m'.format(max(1, megabytes))
+
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -679,6 +1071,8 @@ if __name__ == "__main__":
     wpe_backend_version = '1.14.3'
     wpe_webkit_version = '2.50.2'
     ffmpeg_version = 'n7.1.1'
+    nginx_default_version = '1.26.2'
+    nginx_default_cc_opt = '-O2 -march=native'
 
     host_os = system_info.get_os()
     arch_host_os = system_info.get_arch_name()
@@ -706,6 +1100,64 @@ if __name__ == "__main__":
     nginx_grp.add_argument('--without-nginx', help='without nginx and fastocloud scripts', dest='with_nginx',
                            action='store_false',
                            default=False)
+    parser.add_argument('--nginx-from-source',
+                        help='build nginx with LuaJIT and streaming modules instead of the distro package',
+                        dest='nginx_from_source', action='store_true', default=False)
+    parser.add_argument('--nginx-version', help='nginx version (default: {0})'.format(nginx_default_version),
+                        default=nginx_default_version)
+    parser.add_argument('--nginx-cc-opt',
+                        help='nginx compiler optimization flags (default: {0})'.format(nginx_default_cc_opt),
+                        default=nginx_default_cc_opt)
+    nginx_vod_grp = parser.add_mutually_exclusive_group()
+    nginx_vod_grp.add_argument('--with-nginx-vod', help='build nginx with the VOD packaging module',
+                               dest='with_nginx_vod', action='store_true', default=False)
+    nginx_vod_grp.add_argument('--without-nginx-vod', help='build nginx without the VOD packaging module (default)',
+                               dest='with_nginx_vod', action='store_false', default=True)
+    nginx_brotli_grp = parser.add_mutually_exclusive_group()
+    nginx_brotli_grp.add_argument('--with-nginx-brotli', help='build nginx with brotli compression',
+                                  dest='with_nginx_brotli', action='store_true', default=False)
+    nginx_brotli_grp.add_argument('--without-nginx-brotli', help='build nginx without brotli (default)',
+                                  dest='with_nginx_brotli', action='store_false', default=True)
+    parser.add_argument('--cods-streams',
+                        help='expected number of on-demand streams, sizes nginx touch tracking (default: {0})'.format(
+                            DEFAULT_CODS_STREAMS), type=int, default=DEFAULT_CODS_STREAMS)
+    parser.add_argument('--cods-touch-ttl',
+                        help='seconds a touched on-demand stream is remembered (default: {0})'.format(
+                            DEFAULT_CODS_TOUCH_TTL), type=int, default=DEFAULT_CODS_TOUCH_TTL)
+
+    # tmpfs live storage
+    live_storage_grp = parser.add_mutually_exclusive_group()
+    live_storage_grp.add_argument('--with-tmpfs-live-storage',
+                                  help='mount hls, cods and proxy directories as size-capped tmpfs',
+                                  dest='with_tmpfs_live_storage', action='store_true', default=False)
+    live_storage_grp.add_argument('--without-tmpfs-live-storage', help='keep live directories on disk (default)',
+                                  dest='with_tmpfs_live_storage', action='store_false', default=True)
+    parser.add_argument('--live-hls-channels', help='number of hls channels sizing tmpfs (default: 0)', type=int,
+                        default=0)
+    parser.add_argument('--live-cods-channels', help='number of cods channels sizing tmpfs (default: 0)', type=int,
+                        default=0)
+    parser.add_argument('--live-proxy-channels', help='number of proxy channels sizing tmpfs (default: 0)', type=int,
+                        default=0)
+    parser.add_argument('--live-bitrate',
+                        help='total bitrate of one channel in kbit/s (default: {0})'.format(
+                            live_storage.DEFAULT_BITRATE_KBPS), type=int, default=live_storage.DEFAULT_BITRATE_KBPS)
+    parser.add_argument('--live-window',
+                        help='seconds of segments kept per channel (default: {0})'.format(
+                            live_storage.DEFAULT_WINDOW_SECONDS), type=int,
+                        default=live_storage.DEFAULT_WINDOW_SECONDS)
+
+    # system tuning
+    parser.add_argument('--tune-system',
+                        help='apply the streaming sysctl and limits profile v{0} (revert: system_tuning.py revert)'.format(
+                            system_tuning.PROFILE_VERSION), action='store_true', default=False)
+
+    # ttl janitor
+    ttl_janitor_grp = parser.add_mutually_exclusive_group()
+    ttl_janitor_grp.add_argument('--with-ttl-janitor',
+                                 help='install a service expiring cods, hls and proxy streams by their ttl',
+                                 dest='with_ttl_janitor', action='store_true', default=False)
+    ttl_janitor_grp.add_argument('--without-ttl-janitor', help='leave expiry to the streamer (default)',
+                                 dest='with_ttl_janitor', action='store_false', default=True)
 
     # faac
     faac_grp = parser.add_mutually_exclusive_group()
@@ -890,6 +1342,10 @@ if __name__ == "__main__":
                         help='gstreamer version (default: {0})'.format(
                             gstreamer_default_version),
                         default=gstreamer_default_version)
+    parser.add_argument('--production-core',
+                        help='build gstreamer and its plugins without the debug log, extra checks, GLib assertions '
+                             'and tracer hooks (compare: gst_bench.py core, profiling needs the default build) '
+                             '(default: False)', action='store_true', default=False)
 
     # gst-plugins-base
     gst_plugins_base_grp = parser.add_mutually_exclusive_group()
@@ -1000,6 +1456,13 @@ if __name__ == "__main__":
                              action='store_false',
                              default=True)
 
+    # gst-shark (profiling tracers)
+    gst_shark_grp = parser.add_mutually_exclusive_group()
+    gst_shark_grp.add_argument('--with-gst-shark', help='build gst-shark tracers (version: git master)',
+                               dest='with_gst_shark', action='store_true', default=False)
+    gst_shark_grp.add_argument('--without-gst-shark', help='build without gst-shark (default)',
+                               dest='with_gst_shark', action='store_false', default=True)
+
     # other
     parser.add_argument("--hostname", help="server hostname (default: {0})".format(
         DEFAULT_HOSTNAME), default=DEFAULT_HOSTNAME)
@@ -1011,6 +1474,20 @@ if __name__ == "__main__":
         '--prefix', help='prefix path (default: None)', default=None)
     parser.add_argument('--docker', help='docker build (default: False)', dest='docker', action='store_true',
                         default=False)
+    parser.add_argument('--env-version',
+                        help='install into its own prefix {0}/<version> instead of --prefix, '
+                             'see env_bundle.py (default: None)'.format(env_bundle.ENVS_DIR), default=None)
+    parser.add_argument('--switch-env', help='switch to the --env-version environment after the build '
+                                             '(default: False)', dest='switch_env', action='store_true',
+                        default=False)
+    parser.add_argument('--bundle-dir',
+                        help='export what this run installed into the prefix as bundles to this directory, '
+                             'see env_bundle.py (default: None)', default=None)
+    parser.add_argument('--bundle-version', help='bundle version (default: gstreamer version and build date)',
+                        default=None)
+    parser.add_argument('--bundle-formats',
+                        help='bundle formats (default: {0})'.format(','.join(env_bundle.FORMATS)),
+                        default=','.join(env_bundle.FORMATS))
 
     parser.add_argument('--install-other-packages',
                         help='install other packages (--with-system, --with-tools --with-meson --with-jsonc --with-libev) (default: True)',
@@ -1033,11 +1510,23 @@ if __name__ == "__main__":
     arg_install_fastogt_packages = argv.install_fastogt_packages
     arg_install_gstreamer_packages = argv.install_gstreamer_packages
 
+    if argv.env_version:
+        if arg_prefix_path:
+            parser.error('--env-version and --prefix are exclusive')
+        arg_prefix_path = env_bundle.env_prefix(argv.env_version)
+        # build against and check the new environment, not the current one
+        os.environ.update(env_bundle.prefix_environ(arg_prefix_path))
+    elif argv.switch_env:
+        parser.error('--switch-env requires --env-version')
+
     request = BuildRequest(arg_hostname, arg_platform, arg_architecture,
-                           'build_' + arg_platform + '_env', arg_prefix_path)
+                           'build_' + arg_platform + '_env', arg_prefix_path, argv.production_core)
     if argv_docker:
         request.prepare_docker()
 
+    if argv.bundle_dir:
+        request.start_bundle()
+
     if argv.with_system and arg_install_other_packages:
         request.install_system(with_nvidia=argv.with_nvidia, with_wpe=argv.with_wpe, with_gstreamer=True, repo_build=False)
 
@@ -1045,7 +1534,20 @@ if __name__ == "__main__":
         request.install_tools()
 
     if argv.with_nginx and arg_install_other_packages:
-        request.install_nginx()
+        if argv.nginx_from_source:
+            request.build_nginx(argv.nginx_version, argv.nginx_cc_opt, argv.with_nginx_vod, argv.with_nginx_brotli)
+        request.install_nginx(from_source=argv.nginx_from_source, cods_streams=argv.cods_streams,
+                              cods_touch_ttl=argv.cods_touch_ttl)
+
+    if argv.with_tmpfs_live_storage:
+        request.setup_live_storage(argv.live_hls_channels, argv.live_cods_channels, argv.live_proxy_channels,
+                                   argv.live_bitrate, argv.live_window)
+
+    if argv.tune_system:
+        request.tune_system()
+
+    if argv.with_ttl_janitor:
+        request.install_ttl_janitor()
 
     if argv.with_faac and arg_install_other_packages:
         request.build_faac()
@@ -1146,4 +1648,15 @@ if __name__ == "__main__":
     if argv.with_gst_cef and arg_install_gstreamer_packages:
         request.build_gst_cef()
 
+    if argv.with_gst_shark and arg_install_gstreamer_packages:
+        request.build_gst_shark()
+
     check_plugins()
+
+    if argv.bundle_dir:
+        request.export_bundle(argv.bundle_dir, argv.bundle_version, argv.bundle_formats.split(','))
+
+    if argv.switch_env:
+        env_bundle.switch(argv.env_version)
+    elif argv.env_version:
+        print('Switch to it with: python3 env_bundle.py switch {0}'.format(argv.env_version))
@@ -1,10 +1,25 @@
 #!/bin/bash
 # Script to remove ALL GStreamer and libnice libraries from /usr/local/lib
 # Use this before reinstalling/updating GStreamer
+#
+# Environments built by build_env.py record the files of every build step in
+# /usr/local/share/fastocloud_env/manifest.json: when it is there, exactly the
+# files it lists for the GStreamer and libnice components are removed instead
+# of globbing for them.
+#
+# Usage: cleanup_old_gstreamer.sh [version]
+#   version: remove the environment built with build_env.py --env-version
+#            from /opt/fastocloud/env/<version> (not the current one)
+#            instead of /usr/local. There is nothing to remove before
+#            upgrading such environments: build the new version next to it
+#            and switch with env_bundle.py switch <version>.
 
 set -e
 
-LIB_DIR="/usr/local/lib"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+PREFIX="/usr/local"
+LIB_DIR="$PREFIX/lib"
+MANIFEST="$PREFIX/share/fastocloud_env/manifest.json"
 
 echo "=== Removing ALL GStreamer and libnice libraries from $LIB_DIR ==="
 echo ""
@@ -15,6 +30,23 @@ if [ "$EUID" -ne 0 ]; then
     exit 1
 fi
 
+if [ -n "$1" ]; then
+    echo "=== Removing environment $1 ==="
+    python3 "$SCRIPT_DIR/env_bundle.py" remove "$1"
+    exit 0
+fi
+
+if [ -f "$MANIFEST" ]; then
+    echo "Found install manifest $MANIFEST"
+    if python3 "$SCRIPT_DIR/env_bundle.py" remove --prefix "$PREFIX" --components gst,libnice; then
+        echo ""
+        echo "=== Cleanup complete ==="
+        exit 0
+    fi
+    echo "WARNING: the manifest does not list the installed files, falling back to removing by name"
+    echo ""
+fi
+
 cd "$LIB_DIR"
 
 # Count files before removal
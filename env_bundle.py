@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. env_bundle requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+# Prebuilt environment bundles.
+#
+# build_env.py records every component it builds (source, version, configure
+# flags, installed files) in a manifest kept in the install prefix, together
+# with the time the build started. "create" packs the files of the components
+# with that manifest into a versioned tarball, .deb and .rpm; "install"
+# deploys a bundle on a node of the same distribution and architecture
+# instead of building the stack there.
+#
+# The tarball can be installed under another prefix: text files (pkg-config,
+# libtool, scripts) are rewritten to it, the paths compiled into the binaries
+# are not, so the GStreamer plugin path and scanner are set from a profile.d
+# script instead. The .deb and .rpm always install under the build prefix.
+#
+# Each build step also records the files it installed, so "remove" deletes
+# exactly what the manifest lists. They are read from the install log of the
+# build system (install_manifest.txt of CMake, meson-logs/install-log.txt of
+# meson), which also lists the files an install left "Up-to-date"; steps
+# without one fall back to the files of the prefix changed during the step.
+# Those are kept apart as "swept_files": in a shared prefix such as /usr/local
+# they can belong to anything else installed meanwhile, so "create" and
+# "remove" use them only in the dedicated --env-version prefixes or with --force.
+# A rebuild keeps the files recorded for the previous build of the component.
+#
+# With build_env.py --env-version every environment gets its own prefix under
+# /opt/fastocloud/env and "switch" flips the "current" symlink the ld.so.conf.d
+# entry points at, in one rename: the previous environment stays installed and
+# running streams keep it until they are restarted.
+
+PACKAGE_NAME = "fastocloud-env"
+DEFAULT_PREFIX = "/usr/local"
+MANIFEST_PATH = "share/fastocloud_env/manifest.json"
+FORMATS = ("tar", "deb", "rpm")
+# file timestamps come from the coarse kernel clock, up to a tick behind time.time()
+CTIME_SLACK = 0.02
+INSTALL_LOGS = ("install_manifest.txt", os.path.join("meson-logs", "install-log.txt"))
+# levels below the build directory the build systems keep their logs at
+INSTALL_LOG_DEPTH = 4
+
+LD_SO_CONF_PATH = "/etc/ld.so.conf.d/fastocloud-env.conf"
+PROFILE_PATH = "/etc/profile.d/fastocloud-env.sh"
+
+ENVS_DIR = "/opt/fastocloud/env"
+CURRENT_LINK = os.path.join(ENVS_DIR, "current")
+
+DEB_ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "armhf", "i686": "i386"}
+
+ARCHIVE_EXT_RE = re.compile(r"\.(tar\.gz|tar\.xz|tar\.bz2|tgz|zip|git)$")
+VERSION_RE = re.compile(r"^(?:(?P<name>.+?)-)?v?(?P<version>\d[\w.]*)$")
+
+DEB_CONTROL_TEMPLATE = """Package: {name}
+Version: {version}
+Architecture: {arch}
+Maintainer: FastoGT <support@fastogt.com>
+Installed-Size: {size_kb}
+Section: libs
+Priority: optional
+Description: FastoCloud prebuilt environment
+ {components}
+"""
+
+RPM_SPEC_TEMPLATE = """Name: {name}
+Version: {version}
+Release: 1
+Summary: FastoCloud prebuilt environment
+License: Multiple
+AutoReqProv: no
+%define _build_id_links none
+%define debug_package %{{nil}}
+%define __os_install_post %{{nil}}
+
+%description
+{components}
+
+%install
+cp -a {staging}/. %{{buildroot}}/
+
+%post
+/sbin/ldconfig
+
+%postun
+/sbin/ldconfig
+
+%files
+{files}
+"""
+
+PROFILE_TEMPLATE = """# written by env_bundle.py, the bundle was built for {build_prefix}
+export PATH="{prefix}/bin:$PATH"
+export PKG_CONFIG_PATH="{libdir}/pkgconfig:{prefix}/share/pkgconfig${{PKG_CONFIG_PATH:+:$PKG_CONFIG_PATH}}"
+export GST_PLUGIN_SYSTEM_PATH_1_0="{libdir}/gstreamer-1.0"
+export GST_PLUGIN_SCANNER="{libexecdir}/gstreamer-1.0/gst-plugin-scanner"
+"""
+
+ENV_PROFILE_TEMPLATE = """# written by env_bundle.py, the environment is switched with: env_bundle.py switch <version>
+export PATH="{prefix}/bin:$PATH"
+export PKG_CONFIG_PATH="{pkgconfig}${{PKG_CONFIG_PATH:+:$PKG_CONFIG_PATH}}"
+"""
+
+
+def os_release() -> Dict[str, str]:
+    release = {}
+    try:
+        with open("/etc/os-release", "r") as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep:
+                    release[key] = value.strip("\"'")
+    except OSError:
+        pass
+    return {"id": release.get("ID", "unknown"), "version_id": release.get("VERSION_ID", "")}
+
+
+def manifest_file(prefix: str) -> str:
+    return os.path.join(prefix, MANIFEST_PATH)
+
+
+def load_manifest(prefix: str) -> Optional[Dict]:
+    try:
+        with open(manifest_file(prefix), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(prefix: str, manifest: Dict) -> None:
+    path = manifest_file(prefix)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def component_from_url(url: str, branch: Optional[str] = None) -> Tuple[str, str]:
+    base = ARCHIVE_EXT_RE.sub("", url.rstrip("/").split("/")[-1])
+    match = VERSION_RE.match(base)
+    if match and match.group("name"):
+        return match.group("name"), match.group("version")
+    if match:
+        # .../srt/archive/v1.5.3.tar.gz: the project is in the path
+        return url.rstrip("/").split("/")[-3], match.group("version")
+    return base, branch or "git"
+
+
+def start_manifest(prefix: str) -> Dict:
+    """Starts a new build manifest in prefix, only files installed from now on are bundled."""
+    manifest = {
+        "name": PACKAGE_NAME,
+        "prefix": prefix,
+        "os": os_release(),
+        "arch": os.uname().machine,
+        "started": int(time.time()),
+        "components": [],
+    }
+    save_manifest(prefix, manifest)
+    return manifest
+
+
+def record_component(prefix: str, url: str, flags: List[str], branch: Optional[str] = None,
+                     since: Optional[float] = None, build_dir: Optional[str] = None) -> None:
+    """Adds a component built into prefix to its manifest, replacing an earlier build of it.
+
+    The files the step installed into prefix are recorded with it, from the install logs written
+    under build_dir since the step started, or else as swept_files from the files changed in prefix
+    since then.
+    """
+    manifest = load_manifest(prefix) or start_manifest(prefix)
+    name, version = component_from_url(url, branch)
+    component = {"name": name, "version": version, "url": url, "flags": list(flags)}
+    if since is not None:
+        logs = install_logs(build_dir, since - CTIME_SLACK) if build_dir else []
+        files = set(logged_files(prefix, logs))
+        swept = set() if logs else set(installed_files(prefix, since - CTIME_SLACK))
+        for other in manifest["components"]:
+            if other["name"] == name:
+                files.update(path for path in other.get("files", [])
+                             if os.path.lexists(os.path.join(prefix, path)))
+                swept.update(path for path in other.get("swept_files", [])
+                             if os.path.lexists(os.path.join(prefix, path)))
+        component["files"] = sorted(files)
+        if swept - files:
+            component["swept_files"] = sorted(swept - files)
+    manifest["components"] = [other for other in manifest["components"] if other["name"] != name]
+    manifest["components"].append(component)
+    save_manifest(prefix, manifest)
+
+
+def manifest_files(manifest: Dict, swept: bool = True) -> List[str]:
+    files = set(manifest.get("files", []))
+    for component in manifest["components"]:
+        files.update(component.get("files", []))
+        if swept:
+            files.update(component.get("swept_files", []))
+    return sorted(files)
+
+
+def untrusted_components(manifest: Dict) -> List[str]:
+    return [component["name"] for component in manifest["components"] if component.get("swept_files")]
+
+
+def install_logs(build_dir: str, since: float) -> List[str]:
+    """Install logs of CMake and meson written under build_dir since the step started."""
+    logs = []
+    depth = build_dir.rstrip(os.sep).count(os.sep)
+    for root, dirs, _ in os.walk(build_dir):
+        if root.count(os.sep) - depth >= INSTALL_LOG_DEPTH:
+            del dirs[:]
+        for name in INSTALL_LOGS:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime >= since:
+                    logs.append(path)
+            except OSError:
+                pass
+    return logs
+
+
+def logged_files(prefix: str, logs: List[str]) -> List[str]:
+    """Files under prefix listed in install logs, relative to it."""
+    files = set()
+    root = prefix.rstrip(os.sep) + os.sep
+    for log in logs:
+        with open(log, "r") as f:
+            for line in f:
+                path = line.strip()
+                # meson starts its log with a comment
+                if path.startswith(root) and os.path.lexists(path):
+                    files.add(os.path.relpath(path, prefix))
+    files.discard(MANIFEST_PATH)
+    return sorted(files)
+
+
+def dedicated_prefix(prefix: str) -> bool:
+    """Prefix of a build_env.py --env-version environment, which holds nothing but the environment."""
+    return os.path.dirname(os.path.abspath(prefix)) == ENVS_DIR
+
+
+def installed_files(prefix: str, since: float) -> List[str]:
+    """Files and symlinks under prefix changed since the build started, relative to it."""
+    files = []
+    for root, dirs, names in os.walk(prefix):
+        dirs.sort()
+        for name in sorted(names) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            if os.lstat(path).st_ctime >= since:
+                files.append(os.path.relpath(path, prefix))
+    return [path for path in files if path != MANIFEST_PATH]
+
+
+def default_version(manifest: Dict) -> str:
+    gstreamer = [component["version"] for component in manifest["components"] if component["name"] == "gstreamer"]
+    stamp = time.strftime("%Y%m%d%H%M", time.gmtime())
+    return f"{gstreamer[0]}.{stamp}" if gstreamer else stamp
+
+
+def bundle_name(manifest: Dict) -> str:
+    system = manifest["os"]
+    return f"{PACKAGE_NAME}-{manifest['version']}-{system['id']}{system['version_id']}-{manifest['arch']}"
+
+
+def describe(manifest: Dict) -> str:
+    return ", ".join(f"{component['name']} {component['version']}" for component in manifest["components"])
+
+
+def write_tar(prefix: str, files: List[str], path: str) -> None:
+    with tarfile.open(path + ".tmp", "w:gz") as tar:
+        for name in files + [MANIFEST_PATH]:
+            tar.add(os.path.join(prefix, name), arcname=name, recursive=False)
+    os.replace(path + ".tmp", path)
+
+
+def stage(prefix: str, files: List[str], root: str) -> int:
+    """Copies the bundle into root as it is installed from a package, returns its size in bytes."""
+    size = 0
+    for name in files + [MANIFEST_PATH]:
+        src = os.path.join(prefix, name)
+        dst = os.path.join(root, prefix.lstrip("/"), name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(src, dst, follow_symlinks=False)
+        size += os.lstat(src).st_size
+    ld_so_conf = os.path.join(root, LD_SO_CONF_PATH.lstrip("/"))
+    os.makedirs(os.path.dirname(ld_so_conf), exist_ok=True)
+    with open(ld_so_conf, "w") as f:
+        f.write("".join(f"{libdir}\n" for libdir in lib_dirs(prefix)))
+    return size
+
+
+def write_deb(manifest: Dict, staging: str, size: int, path: str) -> None:
+    arch = DEB_ARCHITECTURES.get(manifest["arch"], manifest["arch"])
+    debian = os.path.join(staging, "DEBIAN")
+    os.makedirs(debian)
+    with open(os.path.join(debian, "control"), "w") as f:
+        f.write(DEB_CONTROL_TEMPLATE.format(name=PACKAGE_NAME, version=manifest["version"], arch=arch,
+                                            size_kb=size // 1024, components=describe(manifest)))
+    for script in ("postinst", "postrm"):
+        with open(os.path.join(debian, script), "w") as f:
+            f.write("#!/bin/sh\nset -e\nldconfig\n")
+        os.chmod(os.path.join(debian, script), 0o755)
+    try:
+        subprocess.check_call(["dpkg-deb", "--root-owner-group", "--build", staging, path],
+                              stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(debian)
+
+
+def write_rpm(manifest: Dict, staging: str, files: List[str], path: str) -> None:
+    if not shutil.which("rpmbuild"):
+        raise RuntimeError("rpmbuild not found (rpm-build on RedHat, rpm on Debian)")
+    prefix = manifest["prefix"]
+    listed = [os.path.join(prefix, name) for name in files + [MANIFEST_PATH]] + [LD_SO_CONF_PATH]
+    with tempfile.TemporaryDirectory(prefix="env_bundle_rpm_") as topdir:
+        spec = os.path.join(topdir, PACKAGE_NAME + ".spec")
+        with open(spec, "w") as f:
+            f.write(RPM_SPEC_TEMPLATE.format(name=PACKAGE_NAME, version=manifest["version"],
+                                             components=describe(manifest), staging=staging,
+                                             files="\n".join('"{0}"'.format(name.replace("%", "%%"))
+                                                             for name in listed)))
+        subprocess.check_call(["rpmbuild", "-bb", "--quiet",
+                               "--define", f"_topdir {topdir}",
+                               "--define", f"_rpmdir {os.path.dirname(path)}",
+                               "--define", f"_rpmfilename {os.path.basename(path)}", spec],
+                              stdout=subprocess.DEVNULL)
+
+
+def create(prefix: str, output: str, version: Optional[str], formats: List[str], force: bool = False) -> List[str]:
+    manifest = load_manifest(prefix)
+    if manifest is None:
+        raise RuntimeError(f"No build manifest in {prefix}, build the environment with build_env.py first")
+    swept = force or dedicated_prefix(prefix)
+    if not swept and untrusted_components(manifest):
+        print(f"Warning: the files of {', '.join(untrusted_components(manifest))} are only known from the "
+              f"changes to {prefix} during their build and are not bundled (use --force to bundle them)")
+    files = set(path for path in manifest_files({"components": manifest["components"]}, swept)
+                if os.path.lexists(os.path.join(prefix, path)))
+    if dedicated_prefix(prefix):
+        # also what steps built outside of build_env.py installed; a shared prefix such as /usr/local
+        # gets files from pip and other builds too, so its bundle holds only the recorded files
+        files.update(installed_files(prefix, manifest["started"]))
+    files = sorted(files)
+    if not files:
+        raise RuntimeError(f"No files of the built components are installed in {prefix}")
+
+    manifest["version"] = version or default_version(manifest)
+    manifest["created"] = int(time.time())
+    manifest["files"] = files
+    save_manifest(prefix, manifest)
+
+    os.makedirs(output, exist_ok=True)
+    output = os.path.abspath(output)
+    name = bundle_name(manifest)
+    bundles = []
+    if "tar" in formats:
+        bundles.append(os.path.join(output, name + ".tar.gz"))
+        write_tar(prefix, files, bundles[-1])
+    if "deb" in formats or "rpm" in formats:
+        with tempfile.TemporaryDirectory(prefix="env_bundle_") as staging:
+            os.chmod(staging, 0o755)
+            size = stage(prefix, files, staging)
+            if "deb" in formats:
+                bundles.append(os.path.join(output, name + ".deb"))
+                write_deb(manifest, staging, size, bundles[-1])
+            if "rpm" in formats:
+                bundles.append(os.path.join(output, name + ".rpm"))
+                write_rpm(manifest, staging, files, bundles[-1])
+    return bundles
+
+
+def read_bundle_manifest(path: str) -> Dict:
+    with tarfile.open(path, "r:*") as tar:
+        with tar.extractfile(MANIFEST_PATH) as f:
+            return json.load(f)
+
+
+def check_compatible(manifest: Dict) -> None:
+    system, arch = os_release(), os.uname().machine
+    built = manifest["os"]
+    if (built["id"], built["version_id"], manifest["arch"]) != (system["id"], system["version_id"], arch):
+        raise RuntimeError(f"The bundle was built on {built['id']} {built['version_id']} {manifest['arch']}, "
+                           f"this node is {system['id']} {system['version_id']} {arch} (use --force to install anyway)")
+
+
+def lib_dirs(prefix: str) -> List[str]:
+    dirs = [os.path.join(prefix, "lib"), os.path.join(prefix, "lib64")]
+    libdir = os.path.join(prefix, "lib")
+    if os.path.isdir(libdir):
+        dirs += [os.path.join(libdir, name) for name in sorted(os.listdir(libdir)) if "-linux-gnu" in name]
+    return [path for path in dirs if os.path.isdir(path) and not os.path.islink(path)]
+
+
+def prefix_environ(prefix: str) -> Dict[str, str]:
+    """Environment to build against and run from prefix, before its library directories exist."""
+    libdirs = [os.path.join(prefix, "lib"), os.path.join(prefix, "lib", f"{os.uname().machine}-linux-gnu")]
+
+    def prepend(key: str, paths: List[str]) -> str:
+        return ":".join(paths + [path for path in os.environ.get(key, "").split(":") if path])
+
+    return {
+        "PATH": prepend("PATH", [os.path.join(prefix, "bin")]),
+        "LD_LIBRARY_PATH": prepend("LD_LIBRARY_PATH", libdirs),
+        "PKG_CONFIG_PATH": prepend("PKG_CONFIG_PATH", [os.path.join(libdir, "pkgconfig") for libdir in libdirs]
+                                   + [os.path.join(prefix, "share", "pkgconfig")]),
+    }
+
+
+def relocate(prefix: str, build_prefix: str, files: List[str]) -> int:
+    """Rewrites build_prefix to prefix in the installed text files, returns how many were changed."""
+    pattern = re.compile(re.escape(build_prefix.rstrip("/").encode()) + rb"(?=[/\s\"':;=]|$)", re.MULTILINE)
+    changed = 0
+    for name in files:
+        path = os.path.join(prefix, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        if b"\0" in data or not pattern.search(data):
+            continue
+        with open(path, "wb") as f:
+            f.write(pattern.sub(prefix.rstrip("/").encode(), data))
+        changed += 1
+    return changed
+
+
+def configure_runtime(prefix: str, build_prefix: str) -> None:
+    dirs = lib_dirs(prefix)
+    os.makedirs(os.path.dirname(LD_SO_CONF_PATH), exist_ok=True)
+    with open(LD_SO_CONF_PATH, "w") as f:
+        f.write("".join(f"{libdir}\n" for libdir in dirs))
+    if prefix.rstrip("/") != build_prefix.rstrip("/"):
+        gst_libdir = next((libdir for libdir in dirs if os.path.isdir(os.path.join(libdir, "gstreamer-1.0"))),
+                          os.path.join(prefix, "lib"))
+        with open(PROFILE_PATH, "w") as f:
+            f.write(PROFILE_TEMPLATE.format(build_prefix=build_prefix, prefix=prefix, libdir=gst_libdir,
+                                            libexecdir=os.path.join(prefix, "libexec")))
+    elif os.path.exists(PROFILE_PATH):
+        os.remove(PROFILE_PATH)
+    subprocess.call(["ldconfig"])
+
+
+def install_tar(path: str, prefix: Optional[str], force: bool) -> Dict:
+    manifest = read_bundle_manifest(path)
+    if not force:
+        check_compatible(manifest)
+    build_prefix = manifest["prefix"]
+    prefix = os.path.abspath(prefix or build_prefix)
+
+    os.makedirs(prefix, exist_ok=True)
+    with tarfile.open(path, "r:*") as tar:
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(prefix, filter="tar")
+        else:
+            tar.extractall(prefix)
+    if prefix != build_prefix.rstrip("/"):
+        changed = relocate(prefix, build_prefix, manifest["files"])
+        print(f"Relocated {build_prefix} to {prefix} in {changed} files")
+
+    manifest["prefix"] = prefix
+    manifest["build_prefix"] = build_prefix
+    manifest["installed"] = int(time.time())
+    save_manifest(prefix, manifest)
+    if os.path.dirname(prefix) != ENVS_DIR:
+        configure_runtime(prefix, build_prefix)
+    return manifest
+
+
+def install(path: str, prefix: Optional[str], force: bool) -> None:
+    start = time.monotonic()
+    if path.endswith(".deb") or path.endswith(".rpm"):
+        if prefix:
+            raise ValueError("--prefix is supported only for tarball bundles, packages install under the build prefix")
+        command = ["dpkg", "-i", path] if path.endswith(".deb") else ["rpm", "-U", "--replacepkgs", path]
+        if force:
+            command.insert(1, "--force-architecture" if path.endswith(".deb") else "--ignorearch")
+        subprocess.check_call(command)
+        print(f"Installed {os.path.basename(path)} in {time.monotonic() - start:.1f}s")
+        return
+
+    manifest = install_tar(path, prefix, force)
+    print(f"Installed {PACKAGE_NAME} {manifest['version']} ({len(manifest['files'])} files) into "
+          f"{manifest['prefix']} in {time.monotonic() - start:.1f}s")
+    if os.path.dirname(manifest["prefix"]) == ENVS_DIR:
+        print(f"Switch to it with: env_bundle.py switch {os.path.basename(manifest['prefix'])}")
+    elif manifest["prefix"] != manifest["build_prefix"].rstrip("/"):
+        print(f"Log in again or source {PROFILE_PATH} for the GStreamer plugin path to apply")
+
+
+def show(path: Optional[str], prefix: str) -> None:
+    manifest = read_bundle_manifest(path) if path else load_manifest(prefix)
+    if manifest is None:
+        raise RuntimeError(f"No manifest in {prefix}")
+    system = manifest["os"]
+    print(f"{manifest['name']} {manifest.get('version', '(not bundled)')}: {system['id']} {system['version_id']} "
+          f"{manifest['arch']}, prefix {manifest['prefix']}, {len(manifest_files(manifest))} files")
+    width = max([len(component["name"]) for component in manifest["components"]] + [1])
+    for component in manifest["components"]:
+        print(f"  {component['name']:{width}s}  {component['version']:12s}  {' '.join(component['flags'])}")
+
+
+def env_prefix(version: str) -> str:
+    if not version or "/" in version or version in (".", "..", os.path.basename(CURRENT_LINK)):
+        raise ValueError(f"Invalid environment version: {version!r}")
+    return os.path.join(ENVS_DIR, version)
+
+
+def current_version() -> Optional[str]:
+    try:
+        return os.path.basename(os.readlink(CURRENT_LINK))
+    except OSError:
+        return None
+
+
+def list_envs() -> None:
+    current = current_version()
+    versions = sorted(name for name in os.listdir(ENVS_DIR) if name != os.path.basename(CURRENT_LINK)) \
+        if os.path.isdir(ENVS_DIR) else []
+    if not versions:
+        print(f"No environments in {ENVS_DIR}")
+    for version in versions:
+        manifest = load_manifest(env_prefix(version))
+        if manifest is None:
+            print(f"  {version}  (no manifest)")
+            continue
+        marker = "*" if version == current else " "
+        print(f"{marker} {version}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(manifest['started']))}  "
+              f"{len(manifest['components'])} components, {len(manifest_files(manifest))} files  {describe(manifest)}")
+
+
+def switch(version: str) -> None:
+    prefix = env_prefix(version)
+    if load_manifest(prefix) is None:
+        raise RuntimeError(f"No environment in {prefix}")
+    previous = current_version()
+
+    # a new link renamed over the old one: readers see either version, never none
+    tmp = CURRENT_LINK + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(version, tmp)
+    os.replace(tmp, CURRENT_LINK)
+
+    dirs = [os.path.join(CURRENT_LINK, os.path.relpath(libdir, prefix)) for libdir in lib_dirs(prefix)]
+    os.makedirs(os.path.dirname(LD_SO_CONF_PATH), exist_ok=True)
+    with open(LD_SO_CONF_PATH + ".tmp", "w") as f:
+        f.write("".join(f"{libdir}\n" for libdir in dirs))
+    os.replace(LD_SO_CONF_PATH + ".tmp", LD_SO_CONF_PATH)
+    pkgconfig = ":".join(os.path.join(libdir, "pkgconfig") for libdir in dirs)
+    with open(PROFILE_PATH, "w") as f:
+        f.write(ENV_PROFILE_TEMPLATE.format(prefix=CURRENT_LINK, pkgconfig=pkgconfig))
+    subprocess.check_call(["ldconfig"])
+
+    print(f"Switched {CURRENT_LINK} from {previous or '(none)'} to {version}")
+    print("Restart the streams for them to load it, the running ones keep the previous environment")
+
+
+def remove(prefix: str, force: bool, components: Optional[List[str]] = None) -> None:
+    """Deletes the files the manifest lists, of every component or of those whose names start with components."""
+    prefix = os.path.abspath(prefix)
+    manifest = load_manifest(prefix)
+    if manifest is None:
+        raise RuntimeError(f"No manifest in {prefix}")
+    if os.path.realpath(CURRENT_LINK) == os.path.realpath(prefix) and not force:
+        raise RuntimeError(f"{prefix} is the current environment, switch to another one first (or use --force)")
+
+    kept = dict(manifest, components=[])
+    if components:
+        for component in manifest["components"]:
+            if not any(component["name"].startswith(name) for name in components):
+                kept["components"].append(component)
+    selected = dict(manifest, components=[c for c in manifest["components"] if c not in kept["components"]])
+    swept = force or dedicated_prefix(prefix)
+    if components or not swept:
+        # the bundle file list is not split by component, nor by how the files were found
+        kept.pop("files", None)
+        selected.pop("files", None)
+    if not swept and untrusted_components(selected):
+        print(f"Warning: keeping the files of {', '.join(untrusted_components(selected))} in {prefix}, they are "
+              "only known from the changes to the prefix during their build (use --force to remove them)")
+    files = sorted(set(manifest_files(selected, swept)) - set(manifest_files(kept)))
+    if not files:
+        raise RuntimeError(f"The manifest of {prefix} lists no files to remove, it was written before files were "
+                           "recorded or has no such components")
+
+    removed, dirs = 0, set()
+    for name in files:
+        path = os.path.join(prefix, name)
+        if os.path.lexists(path) and not (os.path.isdir(path) and not os.path.islink(path)):
+            os.remove(path)
+            removed += 1
+        dirs.add(os.path.dirname(path))
+    if kept["components"]:
+        save_manifest(prefix, kept)
+    else:
+        os.remove(manifest_file(prefix))
+        dirs.add(os.path.dirname(manifest_file(prefix)))
+
+    # prune the directories left empty, deepest first, never the prefix itself
+    for path in sorted(dirs, key=len, reverse=True):
+        while path.startswith(prefix + "/"):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+    subprocess.call(["ldconfig"])
+    print(f"Removed {removed} of {len(files)} files of {describe(selected)} from {prefix}")
+    if os.path.dirname(prefix) == ENVS_DIR and not kept["components"]:
+        try:
+            os.rmdir(prefix)
+        except OSError:
+            print(f"Kept {prefix}: it holds files that are not in the manifest")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="env_bundle",
+                                     usage="%(prog)s {create,install,show,list,switch,remove} [target] [options]")
+    parser.add_argument("command", choices=["create", "install", "show", "list", "switch", "remove"])
+    parser.add_argument("target", nargs="?",
+                        help="bundle to install (.tar.gz, .deb or .rpm) or show (.tar.gz), "
+                             f"environment version in {ENVS_DIR} to switch to or remove")
+    parser.add_argument("--prefix", help=f"install prefix (default: {DEFAULT_PREFIX}, install: the build prefix)")
+    parser.add_argument("--output", help="directory the bundles are written to (default: .)", default=".")
+    parser.add_argument("--version", help="bundle version (default: gstreamer version and build date)")
+    parser.add_argument("--formats", help=f"bundle formats (default: {','.join(FORMATS)})", default=",".join(FORMATS))
+    parser.add_argument("--components",
+                        help="remove only the components whose names start with these, comma separated "
+                             "(default: all)")
+    parser.add_argument("--force",
+                        help="install on another distribution or architecture, remove the current environment, "
+                             "bundle and remove the files found by the prefix sweep in a shared prefix "
+                             "(default: False)",
+                        action="store_true", default=False)
+    argv = parser.parse_args()
+
+    try:
+        if argv.command == "create":
+            formats = [fmt for fmt in argv.formats.split(",") if fmt]
+            unknown = set(formats) - set(FORMATS)
+            if unknown:
+                raise ValueError(f"Unknown bundle formats: {', '.join(sorted(unknown))}")
+            for bundle in create(argv.prefix or DEFAULT_PREFIX, argv.output, argv.version, formats,
+                                 argv.force):
+                print(f"Wrote {bundle} ({os.path.getsize(bundle) // (1024 * 1024)} MiB)")
+        elif argv.command == "install":
+            if not argv.target:
+                raise ValueError("install requires a bundle")
+            install(argv.target, argv.prefix, argv.force)
+        elif argv.command == "show":
+            show(argv.target, argv.prefix or DEFAULT_PREFIX)
+        elif argv.command == "list":
+            list_envs()
+        elif argv.command == "switch":
+            switch(argv.target)
+        else:
+            if not argv.target and not argv.prefix:
+                raise ValueError("remove requires an environment version or --prefix")
+            components = [name for name in argv.components.split(",") if name] if argv.components else None
+            remove(env_prefix(argv.target) if argv.target else argv.prefix, argv.force, components)
+    except (OSError, RuntimeError, ValueError, KeyError, subprocess.CalledProcessError) as ex:
+        print(f"Error: {ex}")
+        sys.exit(1)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+
+from typing import Dict
+
+# Installation of the scripts that run as systemd services. The units start the
+# copies installed into the environment prefix, so they keep working when the
+# checkout is moved or removed.
+
+# environment prefix of build_env.py and env_bundle.py, the scripts go next to its manifest
+DEFAULT_PREFIX = "/usr/local"
+SCRIPTS_DIR = os.path.join("share", "fastocloud_env")
+SYSTEMD_DIR = "/etc/systemd/system"
+
+
+def install_script(script: str, prefix: str) -> str:
+    # the script and this module, returns the path of the installed script
+    scripts_dir = os.path.join(prefix, SCRIPTS_DIR)
+    os.makedirs(scripts_dir, exist_ok=True)
+    for path in (script, __file__):
+        path = os.path.abspath(path)
+        installed = os.path.join(scripts_dir, os.path.basename(path))
+        if path != installed:
+            shutil.copy2(path, installed)
+    return os.path.join(scripts_dir, os.path.basename(script))
+
+
+def install_units(units: Dict[str, str], start: str) -> None:
+    # units: file name -> content, start: the unit enabled and started
+    for name, content in units.items():
+        with open(os.path.join(SYSTEMD_DIR, name), "w") as f:
+            f.write(content)
+    subprocess.check_call(["systemctl", "daemon-reload"])
+    subprocess.check_call(["systemctl", "enable", "--now", start])
@@ -0,0 +1,879 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 7):
+    print(
+        "Tried to start script with an unsupported version of Python. gst_bench requires Python 3.7 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+from typing import Dict, List, Optional, Tuple
+from urllib import parse
+
+# Benchmarks for the patched GStreamer elements.
+#
+# "connections" measures how fast httpsink answers clients, the way players
+# (re)connect to a stream:
+#   connect    new connection per request, GET and read the start of the stream
+#   keepalive  HEAD requests on kept-alive connections, reconnecting when the
+#              server closes
+#   pipelined  HEAD and GET sent in one write on a new connection
+# The sink is either started here from --pipeline or an already running one is
+# given with --url (and --pid for its CPU time). --save and --compare put a run
+# before and after a patch change side by side.
+#
+# "startup" connects repeatedly at random points of the GOP and measures the
+# time until the first MPEG-TS packet flagged as random access (a keyframe),
+# the wait a player has before it can decode; compare with and without
+# gop-cache=true. With --tcp the stream of a tcpserversink is read raw, e.g.
+# with sync-method=burst-keyframe, the upstream way of starting its clients at
+# a keyframe.
+#
+# "streams" starts one encoder teed into httpsinks with different keys on the
+# same port and reports, per stream count, the listening sockets and threads
+# of the process and whether every key answers.
+#
+# "fanout" keeps --clients viewers reading the stream of one httpsink and
+# reports the syscalls per second of the sink process (with perf or strace)
+# and its CPU time per 1000 clients, once per --variants entry of httpsink
+# properties, e.g. without and with coalesce-bytes.
+#
+# "busmessages" runs an hlssink pipeline to EOS with gst-launch-1.0 -m once per
+# --hls-modes value and counts the messages reaching the application bus. A
+# value is a segment-messages mode, "multifilesink" being the forwarding of
+# every internal message the patch did before hls-segment-added, or a number
+# of milliseconds run as segment-messages=all with that
+# segment-message-interval.
+#
+# "core" runs the same pipelines to EOS against GStreamer installs in
+# different --prefixes, e.g. the default build and one of build_env.py
+# --production-core, and reports the CPU time per buffer of each: "buffers"
+# pushes small buffers through a chain of trivial elements, where the per
+# buffer overhead of the core dominates, "transcode" decodes, scales and
+# encodes like a channel does.
+
+DEFAULT_PORT = 8990
+DEFAULT_KEY = "/fastocloud"
+DEFAULT_PIPELINE = (
+    "videotestsrc is-live=true ! video/x-raw,width=640,height=360,framerate=25/1 ! "
+    "x264enc tune=zerolatency speed-preset=ultrafast key-int-max=50 ! mpegtsmux ! "
+    "httpsink port={port} key={key}"
+)
+DEFAULT_REQUESTS = 2000
+DEFAULT_CONCURRENCY = 16
+DEFAULT_BODY_BYTES = 188 * 7
+MODES = ("connect", "keepalive", "pipelined")
+DEFAULT_STREAM_COUNTS = [1, 10, 100]
+STREAMS_SOURCE = (
+    "videotestsrc is-live=true ! video/x-raw,width=320,height=180,framerate=25/1 ! "
+    "x264enc tune=zerolatency speed-preset=ultrafast key-int-max=50 ! mpegtsmux ! tee name=t"
+)
+STREAMS_SINK = "t. ! httpsink port={port} key=/stream{number} sync=false async=false"
+TCP_LISTEN = "0A"
+DEFAULT_CLIENTS = 1000
+DEFAULT_DURATION = 10
+DEFAULT_VARIANTS = ["", "coalesce-bytes=65536"]
+FANOUT_CONNECT_BATCH = 100
+FANOUT_WARMUP = 2
+SYSCALL_EVENT = "raw_syscalls:sys_enter"
+HLS_PIPELINE = (
+    "videotestsrc num-buffers={buffers} ! video/x-raw,width=320,height=180,framerate=25/1 ! "
+    "x264enc speed-preset=ultrafast key-int-max=25 ! mpegtsmux ! "
+    "hlssink target-duration=1 max-files=5 location={directory}/segment%05d.ts "
+    "playlist-location={directory}/playlist.m3u8 {messages}"
+)
+HLS_MODES = ["multifilesink", "all", "1000"]
+DEFAULT_HLS_SECONDS = 60
+HLS_FRAMERATE = 25
+CORE_PIPELINES = {
+    "buffers": "fakesrc num-buffers={buffers} sizetype=fixed sizemax=1316 filltype=nothing ! queue ! identity ! "
+               "identity ! tee ! queue ! fakesink sync=false",
+    "transcode": "videotestsrc num-buffers={frames} ! video/x-raw,width=1280,height=720,framerate=25/1 ! "
+                 "x264enc speed-preset=ultrafast key-int-max=50 ! h264parse ! avdec_h264 ! videoscale ! "
+                 "video/x-raw,width=640,height=360 ! x264enc speed-preset=ultrafast key-int-max=50 ! mpegtsmux ! "
+                 "fakesink sync=false",
+}
+DEFAULT_CORE_BUFFERS = 200000
+DEFAULT_CORE_FRAMES = 500
+DEFAULT_CORE_RUNS = 3
+LIB_DIRS = ("lib", "lib64", os.path.join("lib", "x86_64-linux-gnu"), os.path.join("lib", "aarch64-linux-gnu"))
+BUS_MESSAGE = re.compile(r'^Got message #\d+ from \w+ "[^"]*" \(([\w-]+)\)(?:: ([\w-]+))?')
+DEFAULT_SAMPLES = 20
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TIMEOUT = 5
+STARTUP_TIMEOUT = 10
+READ_SIZE = 64 * 1024
+# the original httpsink ends its header lines with a bare LF
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+
+class Target:
+    def __init__(self, url: str):
+        parsed = parse.urlsplit(url)
+        if parsed.scheme not in ("http", "tcp"):
+            raise ValueError(f"not an http or tcp url: {url}")
+        self.raw = parsed.scheme == "tcp"
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path or "/"
+        self.netloc = parsed.netloc
+
+    def request(self, method: str) -> bytes:
+        return f"{method} {self.path} HTTP/1.1\r\nHost: {self.netloc}\r\nUser-Agent: fastocloud-env\r\n\r\n".encode()
+
+
+class Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = b""
+
+    async def response(self, method: str, body_bytes: int) -> Tuple[int, Dict[str, str]]:
+        while True:
+            match = HEADER_END.search(self.buffer)
+            if match:
+                break
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("connection closed before the response")
+            self.buffer += data
+
+        head, self.buffer = self.buffer[:match.start()], self.buffer[match.end():]
+        status_line, *lines = head.decode("latin-1").splitlines()
+        status = int(status_line.split(" ", 2)[1])
+        headers = {}
+        for line in lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if method == "HEAD":
+            pass
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            await self._fill(length)
+            self.buffer = self.buffer[length:]
+        elif status == 200:
+            # the stream never ends, read its start to see that data flows
+            await self._fill(body_bytes)
+        return status, headers
+
+    async def _fill(self, size: int) -> None:
+        while len(self.buffer) < size:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("connection closed in the body")
+            self.buffer += data
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def connect(target: Target) -> Connection:
+    reader, writer = await asyncio.open_connection(target.host, target.port)
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return Connection(reader, writer)
+
+
+class Counters:
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.errors = 0
+        self.latencies = []  # type: List[float]
+        self.statuses = {}  # type: Dict[int, int]
+
+    def record(self, status: int, started: float) -> None:
+        self.requests += 1
+        self.latencies.append(time.monotonic() - started)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+async def worker(target: Target, mode: str, body_bytes: int, counters: Counters, left: List[int]) -> None:
+    conn = None
+    while left[0] > 0:
+        left[0] -= 1
+        started = time.monotonic()
+        try:
+            if conn is None:
+                conn = await asyncio.wait_for(connect(target), TIMEOUT)
+                counters.connections += 1
+
+            if mode == "keepalive":
+                conn.writer.write(target.request("HEAD"))
+                status, headers = await asyncio.wait_for(conn.response("HEAD", body_bytes), TIMEOUT)
+                counters.record(status, started)
+                if headers.get("connection", "").lower() == "close" or status >= 400:
+                    await conn.close()
+                    conn = None
+                continue
+
+            if mode == "pipelined":
+                conn.writer.write(target.request("HEAD") + target.request("GET"))
+                status, _ = await asyncio.wait_for(conn.response("HEAD", body_bytes), TIMEOUT)
+                counters.record(status, started)
+                started = time.monotonic()
+            else:
+                conn.writer.write(target.request("GET"))
+            status, _ = await asyncio.wait_for(conn.response("GET", body_bytes), TIMEOUT)
+            counters.record(status, started)
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError):
+            counters.errors += 1
+            if conn:
+                await conn.close()
+            conn = None
+            continue
+
+        await conn.close()
+        conn = None
+
+    if conn:
+        await conn.close()
+
+
+def process_cpu_seconds(pid: Optional[int]) -> float:
+    if not pid:
+        return 0.0
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+    except OSError:
+        return 0.0
+    fields = stat[stat.rindex(")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run_mode(target: Target, mode: str, requests: int, concurrency: int, body_bytes: int,
+                   pid: Optional[int]) -> Dict:
+    counters = Counters()
+    left = [requests]
+    cpu = process_cpu_seconds(pid)
+    started = time.monotonic()
+    await asyncio.gather(*(worker(target, mode, body_bytes, counters, left) for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    cpu = process_cpu_seconds(pid) - cpu
+
+    return {
+        "mode": mode,
+        "requests": counters.requests,
+        "connections": counters.connections,
+        "errors": counters.errors,
+        "rate": counters.requests / elapsed,
+        "connection_rate": counters.connections / elapsed,
+        "p50_ms": percentile(counters.latencies, 50) * 1000,
+        "p99_ms": percentile(counters.latencies, 99) * 1000,
+        "statuses": {str(status): count for status, count in sorted(counters.statuses.items())},
+        "cpu_ms_per_request": cpu * 1000 / max(1, counters.requests) if pid else None,
+    }
+
+
+def wait_listening(target: Target, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"pipeline exited with {process.returncode}")
+        try:
+            socket.create_connection((target.host, target.port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listens on {target.host}:{target.port}")
+
+
+def start_pipeline(description: str) -> subprocess.Popen:
+    launch = shutil.which("gst-launch-1.0")
+    if not launch:
+        raise RuntimeError("gst-launch-1.0 not found, build the environment first or pass --url")
+    return subprocess.Popen([launch, "-q"] + description.split(), stdout=subprocess.DEVNULL)
+
+
+class Dechunker:
+    def __init__(self):
+        self.raw = b""
+        self.left = 0  # payload bytes left in the current chunk
+
+    def feed(self, data: bytes) -> bytes:
+        self.raw += data
+        out = []
+        while self.raw:
+            if self.left:
+                part = self.raw[:self.left]
+                out.append(part)
+                self.left -= len(part)
+                self.raw = self.raw[len(part):]
+                continue
+            line_end = self.raw.find(b"\r\n")
+            if line_end < 0:
+                break
+            line = self.raw[:line_end]
+            self.raw = self.raw[line_end + 2:]
+            # the CRLF ending the previous chunk
+            if not line:
+                continue
+            self.left = int(line.split(b";")[0], 16)
+        return b"".join(out)
+
+
+def random_access_offset(data: bytes) -> int:
+    # offset of the first TS packet with the random_access_indicator set, or -1
+    offset = data.find(bytes([TS_SYNC_BYTE]))
+    while 0 <= offset <= len(data) - TS_PACKET_SIZE:
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        if packet[0] != TS_SYNC_BYTE:
+            offset = data.find(bytes([TS_SYNC_BYTE]), offset + 1)
+            continue
+        has_adaptation = packet[3] & 0x20
+        if has_adaptation and packet[4] > 0 and packet[5] & 0x40:
+            return offset
+        offset += TS_PACKET_SIZE
+    return -1
+
+
+async def time_to_keyframe(target: Target) -> float:
+    started = time.monotonic()
+    conn = await asyncio.wait_for(connect(target), TIMEOUT)
+    try:
+        dechunker = None
+        if not target.raw:
+            conn.writer.write(target.request("GET"))
+            status, headers = await asyncio.wait_for(conn.response("GET", 0), TIMEOUT)
+            if status != 200:
+                raise ValueError(f"status {status}")
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                dechunker = Dechunker()
+        stream = b""
+        data = conn.buffer
+        while True:
+            stream += dechunker.feed(data) if dechunker else data
+            if random_access_offset(stream) >= 0:
+                return time.monotonic() - started
+            # keep the tail, a packet may be split between reads
+            stream = stream[-(TS_PACKET_SIZE - 1):]
+            data = await asyncio.wait_for(conn.reader.read(READ_SIZE), TIMEOUT)
+            if not data:
+                raise ConnectionError("stream closed")
+    finally:
+        await conn.close()
+
+
+async def sample_startup(target: Target, samples: int) -> Tuple[List[float], int]:
+    waits, errors = [], 0
+    for _ in range(samples):
+        # land at a different position of the GOP each time
+        await asyncio.sleep(random.uniform(0, 1))
+        try:
+            waits.append(await time_to_keyframe(target))
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError):
+            errors += 1
+    return waits, errors
+
+
+def startup(argv: argparse.Namespace) -> None:
+    url = argv.url or (f"tcp://127.0.0.1:{argv.port}" if argv.tcp else f"http://127.0.0.1:{argv.port}{argv.key}")
+    target = Target(url)
+
+    process = None
+    if not argv.url:
+        process = start_pipeline(argv.pipeline.format(port=argv.port, key=argv.key))
+    try:
+        if process:
+            wait_listening(target, process)
+        waits, errors = asyncio.run(sample_startup(target, argv.samples))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    result = {
+        "samples": len(waits),
+        "errors": errors,
+        "p50_ms": percentile(waits, 50) * 1000,
+        "p90_ms": percentile(waits, 90) * 1000,
+        "max_ms": max(waits, default=0) * 1000,
+    }
+    previous = None
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            previous = json.load(f)
+
+    print("time to first keyframe  p50_ms  p90_ms  max_ms  errors")
+    for label, row in (("now", result), ("before", previous)):
+        if row:
+            print(f"{label:22s}  {row['p50_ms']:6.0f}  {row['p90_ms']:6.0f}  {row['max_ms']:6.0f}  {row['errors']:6d}")
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+def listening_sockets(pid: int) -> int:
+    inodes = set()
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table, "r") as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == TCP_LISTEN:
+                        inodes.add(fields[9])
+        except OSError:
+            continue
+
+    count = 0
+    fd_dir = f"/proc/{pid}/fd"
+    for fd in os.listdir(fd_dir):
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith("socket:[") and link[8:-1] in inodes:
+            count += 1
+    return count
+
+
+async def answered_keys(port: int, count: int) -> int:
+    answered = 0
+    for number in range(count):
+        target = Target(f"http://127.0.0.1:{port}/stream{number}")
+        try:
+            conn = await asyncio.wait_for(connect(target), TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            continue
+        try:
+            conn.writer.write(target.request("HEAD"))
+            status, _ = await asyncio.wait_for(conn.response("HEAD", 0), TIMEOUT)
+            answered += status == 200
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError):
+            pass
+        finally:
+            await conn.close()
+    return answered
+
+
+def streams(argv: argparse.Namespace) -> None:
+    print("streams  listening_sockets  threads  answered")
+    for count in argv.counts:
+        description = " ".join(
+            [STREAMS_SOURCE] + [STREAMS_SINK.format(port=argv.port, number=number) for number in range(count)]
+        )
+        process = start_pipeline(description)
+        try:
+            wait_listening(Target(f"http://127.0.0.1:{argv.port}/stream0"), process)
+            answered = asyncio.run(answered_keys(argv.port, count))
+            sockets = listening_sockets(process.pid)
+            threads = len(os.listdir(f"/proc/{process.pid}/task"))
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{count:7d}  {sockets:17d}  {threads:7d}  {answered:8d}")
+
+
+# /proc/<pid>/io only counts read and write calls, not the sendmsg of the
+# sockets, so the syscalls are counted with perf or, slowing the sink down,
+# with strace
+async def count_syscalls(pid: int, duration: float) -> Tuple[Optional[int], str]:
+    perf = shutil.which("perf")
+    if perf:
+        process = await asyncio.create_subprocess_exec(
+            perf, "stat", "-x", ",", "-e", SYSCALL_EVENT, "-p", str(pid), "--", "sleep", str(duration),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, err = await process.communicate()
+        for line in err.decode(errors="replace").splitlines():
+            fields = line.split(",")
+            if len(fields) > 2 and fields[2] == SYSCALL_EVENT and fields[0].isdigit():
+                return int(fields[0]), "perf"
+        return None, "perf"
+
+    strace = shutil.which("strace")
+    if strace:
+        process = await asyncio.create_subprocess_exec(
+            strace, "-c", "-f", "-q", "-p", str(pid), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        await asyncio.sleep(duration)
+        process.send_signal(signal.SIGINT)
+        _, err = await process.communicate()
+        for line in err.decode(errors="replace").splitlines():
+            fields = line.split()
+            if len(fields) > 4 and fields[-1] == "total":
+                return int(fields[3]), "strace"
+        return None, "strace"
+
+    await asyncio.sleep(duration)
+    return None, "-"
+
+
+def raise_open_files_limit(needed: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+
+
+async def viewer(target: Target, received: List[int], stop: asyncio.Event) -> bool:
+    try:
+        conn = await asyncio.wait_for(connect(target), TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        conn.writer.write(target.request("GET"))
+        status, _ = await asyncio.wait_for(conn.response("GET", 0), TIMEOUT)
+        if status != 200:
+            return False
+        received[0] += len(conn.buffer)
+        while not stop.is_set():
+            data = await asyncio.wait_for(conn.reader.read(READ_SIZE), TIMEOUT)
+            if not data:
+                return False
+            received[0] += len(data)
+        return True
+    except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError):
+        return False
+    finally:
+        await conn.close()
+
+
+async def measure_fanout(target: Target, clients: int, duration: float, pid: int) -> Dict:
+    received, stop = [0], asyncio.Event()
+    viewers = []
+    for start in range(0, clients, FANOUT_CONNECT_BATCH):
+        viewers += [asyncio.ensure_future(viewer(target, received, stop))
+                    for _ in range(start, min(clients, start + FANOUT_CONNECT_BATCH))]
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(FANOUT_WARMUP)
+
+    cpu, got = process_cpu_seconds(pid), received[0]
+    started = time.monotonic()
+    syscalls, counter = await count_syscalls(pid, duration)
+    elapsed = time.monotonic() - started
+    cpu = process_cpu_seconds(pid) - cpu
+    got = received[0] - got
+
+    stop.set()
+    streaming = sum(await asyncio.gather(*viewers))
+    per_thousand = 1000 / max(1, streaming)
+    return {
+        "clients": clients,
+        "streaming": streaming,
+        "counter": counter,
+        "syscalls_per_s": syscalls / elapsed if syscalls is not None else None,
+        "syscalls_per_client_per_s": syscalls / elapsed / max(1, streaming) if syscalls is not None else None,
+        "cpu_percent": cpu * 100 / elapsed,
+        "cpu_percent_per_1000_clients": cpu * 100 / elapsed * per_thousand,
+        "mbit_per_s": got * 8 / elapsed / 1e6,
+    }
+
+
+def fanout(argv: argparse.Namespace) -> None:
+    target = Target(f"http://127.0.0.1:{argv.port}{argv.key}")
+    raise_open_files_limit(argv.clients + 64)
+
+    results = []
+    for options in argv.variants:
+        process = start_pipeline(argv.pipeline.format(port=argv.port, key=argv.key) + " " + options)
+        try:
+            wait_listening(target, process)
+            result = asyncio.run(measure_fanout(target, argv.clients, argv.duration, process.pid))
+        finally:
+            process.terminate()
+            process.wait()
+        result["options"] = options
+        results.append(result)
+
+    before = {}
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            before = {result["options"]: result for result in json.load(f)}
+
+    def row(label: str, result: Dict) -> str:
+        rate, per_client = result["syscalls_per_s"], result["syscalls_per_client_per_s"]
+        rate = f"{rate:10.0f}" if rate is not None else "         -"
+        per_client = f"{per_client:8.1f}" if per_client is not None else "       -"
+        return (f"{label:26s}  {result['streaming']:9d}  {rate}  {per_client}  {result['cpu_percent']:6.1f}  "
+                f"{result['cpu_percent_per_1000_clients']:10.1f}  {result['mbit_per_s']:7.1f}  {result['counter']}")
+
+    print("sink options                streaming  syscalls/s  /client  cpu_%   cpu_%/1000  Mbit/s  counted by")
+    for result in results:
+        print(row(result["options"] or "(defaults)", result))
+        old = before.get(result["options"])
+        if old:
+            print(row("  before", old))
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def count_bus_messages(output: str) -> Dict[str, int]:
+    counts = {"total": 0}  # type: Dict[str, int]
+    for line in output.splitlines():
+        match = BUS_MESSAGE.match(line)
+        if not match:
+            continue
+        kind, name = match.groups()
+        counts["total"] += 1
+        key = f"{kind}:{name}" if kind == "element" and name else kind
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def busmessages(argv: argparse.Namespace) -> None:
+    launch = shutil.which("gst-launch-1.0")
+    if not launch:
+        raise RuntimeError("gst-launch-1.0 not found, build the environment first")
+
+    results = []
+    for mode in argv.hls_modes:
+        with tempfile.TemporaryDirectory() as directory:
+            if mode.isdigit():
+                messages = f"segment-messages=all segment-message-interval={mode}"
+            else:
+                messages = f"segment-messages={mode}"
+            description = HLS_PIPELINE.format(buffers=argv.seconds * HLS_FRAMERATE, directory=directory,
+                                              messages=messages)
+            started = time.monotonic()
+            process = subprocess.run([launch, "-m"] + description.split(), stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, universal_newlines=True)
+            elapsed = time.monotonic() - started
+        if process.returncode != 0:
+            raise RuntimeError(f"pipeline exited with {process.returncode} for {mode}")
+        results.append({"mode": mode, "seconds": elapsed, "messages": count_bus_messages(process.stdout)})
+
+    before = {}
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            before = {result["mode"]: result for result in json.load(f)}
+
+    def row(label: str, result: Dict) -> str:
+        messages = result["messages"]
+        return (f"{label:14s}  {messages['total']:8d}  {messages.get('element:hls-segment-added', 0):13d}  "
+                f"{messages.get('element:GstMultiFileSink', 0):15d}  {result['seconds']:7.1f}")
+
+    print("mode               total  segment-added  GstMultiFileSink  seconds")
+    for result in results:
+        print(row(result["mode"], result))
+        old = before.get(result["mode"])
+        if old:
+            print(row("  before", old))
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def prefix_env(prefix: str, registry: str) -> Dict[str, str]:
+    lib_dirs = [os.path.join(prefix, lib) for lib in LIB_DIRS
+                if os.path.isdir(os.path.join(prefix, lib, "gstreamer-1.0"))]
+    if not lib_dirs:
+        raise RuntimeError(f"no GStreamer plugins installed in {prefix}")
+
+    env = dict(os.environ)
+    for name in ("GST_PLUGIN_PATH", "GST_PLUGIN_PATH_1_0", "GST_DEBUG", "GST_TRACERS"):
+        env.pop(name, None)
+    env["PATH"] = os.path.join(prefix, "bin") + os.pathsep + env.get("PATH", "")
+    env["LD_LIBRARY_PATH"] = os.pathsep.join(lib_dirs + [env["LD_LIBRARY_PATH"]] if env.get("LD_LIBRARY_PATH")
+                                             else lib_dirs)
+    env["GST_PLUGIN_SYSTEM_PATH_1_0"] = os.pathsep.join(os.path.join(lib, "gstreamer-1.0") for lib in lib_dirs)
+    # a registry per install, the other one's plugins must not be picked up
+    env["GST_REGISTRY_1_0"] = registry
+    return env
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_core(prefix: str, description: str, env: Dict[str, str]) -> Tuple[float, float]:
+    launch = os.path.join(prefix, "bin", "gst-launch-1.0")
+    cpu, started = children_cpu_seconds(), time.monotonic()
+    process = subprocess.run([launch, "-q"] + description.split(), env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed, cpu = time.monotonic() - started, children_cpu_seconds() - cpu
+    if process.returncode != 0:
+        raise RuntimeError(f"pipeline failed with {prefix}: {process.stderr.strip()}")
+    return elapsed, cpu
+
+
+def core(argv: argparse.Namespace) -> None:
+    if not argv.prefixes:
+        raise ValueError("core needs --prefixes of the GStreamer installs to compare")
+    counts = {"buffers": argv.core_buffers, "transcode": argv.core_frames}
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        envs = {prefix: prefix_env(prefix, os.path.join(directory, f"registry{number}.bin"))
+                for number, prefix in enumerate(argv.prefixes)}
+        for name in argv.core_pipelines:
+            description = CORE_PIPELINES[name].format(buffers=counts["buffers"], frames=counts["transcode"])
+            for prefix in argv.prefixes:
+                # the first run also builds the registry
+                run_core(prefix, description, envs[prefix])
+                runs = sorted(run_core(prefix, description, envs[prefix]) for _ in range(argv.runs))
+                elapsed, cpu = runs[len(runs) // 2]
+                results.append({"pipeline": name, "prefix": prefix, "buffers": counts[name], "seconds": elapsed,
+                                "cpu_seconds": cpu, "cpu_ns_per_buffer": cpu * 1e9 / counts[name]})
+
+    before = {}
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            before = {(result["pipeline"], result["prefix"]): result for result in json.load(f)}
+
+    baseline = {}  # type: Dict[str, float]
+    print("pipeline   prefix                          seconds  cpu_s    ns/buffer  change")
+    for result in results:
+        first = baseline.setdefault(result["pipeline"], result["cpu_ns_per_buffer"])
+        change = (result["cpu_ns_per_buffer"] - first) * 100 / first if first else 0.0
+        print(f"{result['pipeline']:9s}  {result['prefix'][:30]:30s}  {result['seconds']:7.2f}  "
+              f"{result['cpu_seconds']:7.2f}  {result['cpu_ns_per_buffer']:9.0f}  {change:+5.1f}%")
+        old = before.get((result["pipeline"], result["prefix"]))
+        if old:
+            print(f"{'  before':9s}  {'':30s}  {old['seconds']:7.2f}  {old['cpu_seconds']:7.2f}  "
+                  f"{old['cpu_ns_per_buffer']:9.0f}")
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def print_results(results: List[Dict], previous: Optional[List[Dict]]) -> None:
+    before = {result["mode"]: result for result in previous or []}
+
+    def row(label: str, result: Dict) -> str:
+        cpu = result["cpu_ms_per_request"]
+        cpu = f"{cpu:7.3f}" if cpu is not None else "      -"
+        statuses = " ".join(f"{status}:{count}" for status, count in result["statuses"].items())
+        return (f"{label:10s}  {result['rate']:7.0f}  {result['connection_rate']:6.0f}  {result['p50_ms']:6.2f}  "
+                f"{result['p99_ms']:6.2f}  {cpu}  {result['errors']:6d}  "
+                f"{statuses}")
+
+    print("mode         req/s  conn/s  p50_ms  p99_ms  cpu_ms   errors  statuses")
+    for result in results:
+        print(row(result["mode"], result))
+        old = before.get(result["mode"])
+        if old:
+            print(row("  before", old))
+
+
+def connections(argv: argparse.Namespace) -> None:
+    url = argv.url or f"http://127.0.0.1:{argv.port}{argv.key}"
+    target = Target(url)
+
+    process = None
+    pid = argv.pid
+    if not argv.url:
+        process = start_pipeline(argv.pipeline.format(port=argv.port, key=argv.key))
+        pid = process.pid
+    try:
+        if process:
+            wait_listening(target, process)
+        results = [
+            asyncio.run(run_mode(target, mode, argv.requests, argv.concurrency, argv.body_bytes, pid))
+            for mode in argv.modes
+        ]
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    previous = None
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="gst_bench", usage="%(prog)s {connections,startup,streams,fanout,busmessages,core} [options]")
+    parser.add_argument("command", choices=["connections", "startup", "streams", "fanout", "busmessages", "core"])
+    parser.add_argument("--url", help="benchmark an already running httpsink instead of starting --pipeline")
+    parser.add_argument("--pid", help="process of the running sink, for its CPU time", type=int)
+    parser.add_argument("--pipeline", help="gst-launch description, {port} and {key} are filled in "
+                                           "(default: x264 test stream into httpsink)", default=DEFAULT_PIPELINE)
+    parser.add_argument("--port", help=f"httpsink port (default: {DEFAULT_PORT})", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--key", help=f"httpsink key (default: {DEFAULT_KEY})", default=DEFAULT_KEY)
+    parser.add_argument("--modes", help=f"modes to run (default: {' '.join(MODES)})", nargs="+", choices=MODES,
+                        default=list(MODES))
+    parser.add_argument("--requests", help=f"requests per mode (default: {DEFAULT_REQUESTS})", type=int,
+                        default=DEFAULT_REQUESTS)
+    parser.add_argument("--concurrency", help=f"parallel clients (default: {DEFAULT_CONCURRENCY})", type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--body-bytes", help=f"stream bytes read per GET (default: {DEFAULT_BODY_BYTES})", type=int,
+                        default=DEFAULT_BODY_BYTES)
+    parser.add_argument("--samples", help=f"startup: connections measured (default: {DEFAULT_SAMPLES})", type=int,
+                        default=DEFAULT_SAMPLES)
+    parser.add_argument("--tcp", help="startup: --pipeline ends in tcpserversink, read its stream without HTTP "
+                                      "(default: httpsink)", action="store_true")
+    parser.add_argument("--counts", help="streams: stream counts to start (default: "
+                                         f"{' '.join(map(str, DEFAULT_STREAM_COUNTS))})", nargs="+", type=int,
+                        default=DEFAULT_STREAM_COUNTS)
+    parser.add_argument("--clients", help=f"fanout: viewers reading the stream (default: {DEFAULT_CLIENTS})",
+                        type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument("--duration", help=f"fanout: seconds measured per variant (default: {DEFAULT_DURATION})",
+                        type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--variants", help="fanout: httpsink properties appended to --pipeline, one run each "
+                                           "(default: defaults and coalesce-bytes=65536)", nargs="+",
+                        default=DEFAULT_VARIANTS)
+    parser.add_argument("--hls-modes", help="busmessages: hlssink segment-messages modes or message "
+                                            "intervals in ms, one run each "
+                                            f"(default: {' '.join(HLS_MODES)})", nargs="+", default=HLS_MODES)
+    parser.add_argument("--seconds", help=f"busmessages: seconds of video per run (default: {DEFAULT_HLS_SECONDS})",
+                        type=int, default=DEFAULT_HLS_SECONDS)
+    parser.add_argument("--prefixes", help="core: GStreamer install prefixes to compare, the first is the baseline",
+                        nargs="+")
+    parser.add_argument("--core-pipelines", help=f"core: pipelines to run (default: {' '.join(CORE_PIPELINES)})",
+                        nargs="+", choices=list(CORE_PIPELINES), default=list(CORE_PIPELINES))
+    parser.add_argument("--core-buffers", help=f"core: buffers of the buffers pipeline (default: {DEFAULT_CORE_BUFFERS})",
+                        type=int, default=DEFAULT_CORE_BUFFERS)
+    parser.add_argument("--core-frames", help=f"core: frames of the transcode pipeline (default: {DEFAULT_CORE_FRAMES})",
+                        type=int, default=DEFAULT_CORE_FRAMES)
+    parser.add_argument("--runs", help=f"core: timed runs per install, the median is shown (default: {DEFAULT_CORE_RUNS})",
+                        type=int, default=DEFAULT_CORE_RUNS)
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run (--save) to compare with")
+    argv = parser.parse_args()
+
+    try:
+        if argv.command == "connections":
+            connections(argv)
+        elif argv.command == "startup":
+            startup(argv)
+        elif argv.command == "fanout":
+            fanout(argv)
+        elif argv.command == "busmessages":
+            busmessages(argv)
+        elif argv.command == "core":
+            core(argv)
+        else:
+            streams(argv)
+    except (RuntimeError, ValueError) as ex:
+        print(ex)
+        sys.exit(1)
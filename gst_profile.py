@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 7):
+    print(
+        "Tried to start script with an unsupported version of Python. gst_profile requires Python 3.7 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+# Per-element profile of a GStreamer pipeline from its tracers.
+#
+# "run" starts the pipeline description with gst-launch-1.0 and the tracers
+# writing to a trace log, stops it after --duration (EOS first, so the last
+# buffers are accounted) and prints the report. "report" prints the report of
+# a log written before, e.g. by the streaming service started with the same
+# GST_TRACERS and GST_DEBUG.
+#
+# The latency and rusage tracers of the core give the latency each element
+# adds, the pipeline latency and the CPU load. With GstShark installed
+# (build_env.py --with-gst-shark) its proctime, queuelevel and cpuusage
+# tracers add the processing time of every element, the fill of the queues
+# and the load per core. The report ranks the elements by processing time,
+# or by latency without GstShark. --folded writes the same weights as folded
+# stacks, the input of flamegraph.pl and speedscope.
+#
+# The tracers need a GStreamer core built with tracer hooks, the coretracers
+# plugin and the debug log (not --production-core of build_env.py).
+
+CORE_TRACERS = "latency(flags=pipeline+element);rusage"
+SHARK_TRACERS = "proctime;queuelevel;cpuusage"
+TRACER_DEBUG = "GST_TRACER:7"
+DEFAULT_DURATION = 30
+DEFAULT_TOP = 20
+STOP_TIMEOUT = 10
+ROOT_FRAME = "pipeline"
+# <time> <pid> <thread> TRACE GST_TRACER :0:: <record>, <fields>;
+TRACE_LINE = re.compile(r"\sGST_TRACER\s+:0::\s+([\w-]+),\s*(.*?);?\s*$")
+TRACE_FIELD = re.compile(r'([\w-]+)=\((\w+)\)("(?:[^"\\]|\\.)*"|[^,]*)')
+CLOCK_TIME = re.compile(r"^(\d+):(\d{2}):(\d{2})\.(\d{1,9})$")
+QUEUE_LIMITS = (("size_buffers", "max_size_buffers"), ("size_bytes", "max_size_bytes"),
+                ("size_time", "max_size_time"))
+
+
+class Stat:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value: int) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Profile:
+    def __init__(self):
+        self.proctime = {}  # type: Dict[str, Stat]
+        self.latency = {}  # type: Dict[str, Stat]
+        self.queue_fill = {}  # type: Dict[str, Stat]
+        self.pipeline_latency = {}  # type: Dict[str, Stat]
+        self.thread_load = {}  # type: Dict[str, int]
+        self.process_load = None  # type: Optional[int]
+        self.core_load = {}  # type: Dict[str, Stat]
+        self.records = 0
+
+    def add(self, record: str, fields: Dict[str, str]) -> None:
+        self.records += 1
+        if record == "proctime":
+            self._stat(self.proctime, fields["element"]).add(clock_time(fields["time"]))
+        elif record == "element-latency":
+            self._stat(self.latency, fields["element"]).add(clock_time(fields["time"]))
+        elif record == "latency":
+            path = f"{fields['src-element']} -> {fields['sink-element']}"
+            self._stat(self.pipeline_latency, path).add(clock_time(fields["time"]))
+        elif record == "queuelevel":
+            fill = queue_fill(fields)
+            if fill is not None:
+                self._stat(self.queue_fill, fields["queue"]).add(fill)
+        elif record == "thread-rusage":
+            # the averages grow over the run, the last one covers all of it
+            self.thread_load[fields["thread-id"]] = int(fields["average-cpuload"])
+        elif record == "proc-rusage":
+            self.process_load = int(fields["average-cpuload"])
+        elif record == "cpuusage":
+            # one record per core or one with a field per core, in percent
+            loads = {f"cpu{fields['number']}": fields["load"]} if "load" in fields else \
+                {name: value for name, value in fields.items() if name.startswith("cpu")}
+            for core, load in loads.items():
+                self._stat(self.core_load, core).add(int(float(load) * 10))
+        else:
+            self.records -= 1
+
+    @staticmethod
+    def _stat(stats: Dict[str, Stat], name: str) -> Stat:
+        if name not in stats:
+            stats[name] = Stat()
+        return stats[name]
+
+    def elements(self) -> List[Dict]:
+        names = set(self.proctime) | set(self.latency) | set(self.queue_fill)
+        total = sum(stat.total for stat in self.proctime.values()) or 1
+        rows = []
+        for name in names:
+            proc = self.proctime.get(name, Stat())
+            latency = self.latency.get(name, Stat())
+            fill = self.queue_fill.get(name)
+            rows.append({
+                "element": name,
+                "proctime_ms": proc.total / 1e6,
+                "proctime_percent": proc.total * 100 / total,
+                "proctime_mean_us": proc.mean / 1e3,
+                "buffers": proc.count,
+                "latency_mean_ms": latency.mean / 1e6,
+                "latency_max_ms": latency.max / 1e6,
+                # fill is kept in per mille to stay integral
+                "queue_fill_mean_percent": fill.mean / 10 if fill else None,
+                "queue_fill_max_percent": fill.max / 10 if fill else None,
+            })
+        rows.sort(key=lambda row: (row["proctime_ms"], row["latency_mean_ms"]), reverse=True)
+        return rows
+
+    def to_json(self) -> Dict:
+        return {
+            "records": self.records,
+            "elements": self.elements(),
+            "pipeline_latency": {path: {"mean_ms": stat.mean / 1e6, "max_ms": stat.max / 1e6, "buffers": stat.count}
+                                 for path, stat in self.pipeline_latency.items()},
+            # rusage reports per mille of one CPU
+            "process_cpu_percent": self.process_load / 10 if self.process_load is not None else None,
+            "thread_cpu_percent": {thread: load / 10 for thread, load in self.thread_load.items()},
+            "core_cpu_percent": {core: stat.mean / 10 for core, stat in self.core_load.items()},
+        }
+
+
+def clock_time(value: str) -> int:
+    # the core logs nanoseconds, GstShark formatted times
+    match = CLOCK_TIME.match(value)
+    if not match:
+        return int(value)
+    hours, minutes, seconds, fraction = match.groups()
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000000000 + int(fraction.ljust(9, "0"))
+
+
+def queue_fill(fields: Dict[str, str]) -> Optional[int]:
+    # the fullest of the limits that are set, in per mille
+    fills = []
+    for level, limit in QUEUE_LIMITS:
+        if level in fields and int(fields.get(limit, "0") or 0) > 0:
+            fills.append(int(fields[level]) * 1000 // int(fields[limit]))
+    return max(fills) if fills else None
+
+
+def parse_fields(text: str) -> Dict[str, str]:
+    fields = {}
+    for name, _, value in TRACE_FIELD.findall(text):
+        if value.startswith('"'):
+            value = value[1:-1].replace('\\"', '"')
+        fields[name] = value.strip()
+    return fields
+
+
+def parse_log(path: str) -> Profile:
+    profile = Profile()
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            match = TRACE_LINE.search(line)
+            if not match:
+                continue
+            record, text = match.groups()
+            try:
+                profile.add(record, parse_fields(text))
+            except (KeyError, ValueError):
+                continue
+    return profile
+
+
+def write_folded(profile: Profile, path: str) -> None:
+    # one frame per element below the pipeline, weighted in microseconds
+    with open(path, "w") as f:
+        for name, stat in sorted(profile.proctime.items()):
+            weight = stat.total // 1000
+            if weight > 0:
+                frame = name.replace(";", "_").replace(" ", "_")
+                f.write(f"{ROOT_FRAME};{frame} {weight}\n")
+
+
+def print_report(profile: Profile, top: int) -> None:
+    if not profile.records:
+        print("no tracer records found, is GStreamer built with tracer hooks, coretracers and the debug log?")
+        return
+
+    def optional(value: Optional[float], width: int) -> str:
+        return f"{value:{width}.1f}" if value is not None else " " * (width - 1) + "-"
+
+    print("element                     proc_ms  proc_%  mean_us  buffers  lat_ms  lat_max_ms  fill_%  fill_max_%")
+    for row in profile.elements()[:top]:
+        print(f"{row['element'][:26]:26s}  {row['proctime_ms']:7.1f}  {row['proctime_percent']:6.1f}  "
+              f"{row['proctime_mean_us']:7.1f}  {row['buffers']:7d}  {row['latency_mean_ms']:6.2f}  "
+              f"{row['latency_max_ms']:10.2f}  {optional(row['queue_fill_mean_percent'], 6)}  "
+              f"{optional(row['queue_fill_max_percent'], 10)}")
+
+    if profile.pipeline_latency:
+        print()
+        print("pipeline latency                                     mean_ms   max_ms")
+        for path, stat in sorted(profile.pipeline_latency.items()):
+            print(f"{path[:50]:50s}  {stat.mean / 1e6:8.2f} {stat.max / 1e6:8.2f}")
+
+    if profile.process_load is not None:
+        print()
+        threads = sorted(profile.thread_load.items(), key=lambda item: item[1], reverse=True)[:5]
+        busiest = ", ".join(f"{thread} {load / 10:.1f}%" for thread, load in threads)
+        print(f"process cpu {profile.process_load / 10:.1f}%, busiest threads: {busiest or '-'}")
+    if profile.core_load:
+        cores = ", ".join(f"{core} {stat.mean / 10:.1f}%" for core, stat in sorted(profile.core_load.items()))
+        print(f"cpu load per core: {cores}")
+
+
+def has_plugin(name: str) -> bool:
+    inspect = shutil.which("gst-inspect-1.0")
+    return not inspect or subprocess.run([inspect, name], stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL).returncode == 0
+
+
+def select_tracers(shark: bool) -> str:
+    if not has_plugin("coretracers"):
+        raise RuntimeError("the coretracers plugin is missing, rebuild GStreamer with build_env.py")
+    if shark and has_plugin("sharktracers"):
+        return f"{CORE_TRACERS};{SHARK_TRACERS}"
+    if shark:
+        print("GstShark not found, profiling with the core tracers only")
+    return CORE_TRACERS
+
+
+def run_pipeline(description: List[str], duration: float, log: str, tracers: str) -> int:
+    launch = shutil.which("gst-launch-1.0")
+    if not launch:
+        raise RuntimeError("gst-launch-1.0 not found, build the environment first")
+
+    env = dict(os.environ, GST_TRACERS=tracers, GST_DEBUG=TRACER_DEBUG, GST_DEBUG_FILE=log,
+               GST_DEBUG_NO_COLOR="1")
+    # -e turns the interrupt into an EOS, so the pipeline drains before it stops
+    process = subprocess.Popen([launch, "-e", "-q"] + description, env=env, stdout=subprocess.DEVNULL)
+    try:
+        process.wait(duration)
+    except subprocess.TimeoutExpired:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return process.returncode
+
+
+def profile_run(argv: argparse.Namespace) -> Tuple[Profile, str]:
+    if not argv.pipeline:
+        raise ValueError("run needs a pipeline description")
+
+    log = argv.log
+    if not log:
+        handle, log = tempfile.mkstemp(prefix="gst_profile_", suffix=".log")
+        os.close(handle)
+    tracers = select_tracers(argv.shark)
+    started = time.monotonic()
+    returncode = run_pipeline(argv.pipeline, argv.duration, log, tracers)
+    print(f"pipeline ran {time.monotonic() - started:.1f}s (exit {returncode}), trace log {log}")
+    return parse_log(log), log
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="gst_profile", usage="%(prog)s {run,report} [options] [pipeline ...]")
+    parser.add_argument("command", choices=["run", "report"])
+    parser.add_argument("pipeline", help="run: gst-launch description of the pipeline", nargs="*")
+    parser.add_argument("--log", help="run: trace log to write (default: temporary file), report: trace log to read")
+    parser.add_argument("--duration", help=f"run: seconds before the pipeline is stopped (default: {DEFAULT_DURATION})",
+                        type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--no-shark", help="run: core tracers only, without the GstShark tracers",
+                        dest="shark", action="store_false")
+    parser.add_argument("--top", help=f"elements shown (default: {DEFAULT_TOP})", type=int, default=DEFAULT_TOP)
+    parser.add_argument("--folded", help="write the processing time as folded stacks for flamegraph.pl")
+    parser.add_argument("--json", help="write the report as json to this file")
+    argv = parser.parse_args()
+
+    try:
+        if argv.command == "run":
+            profile, _ = profile_run(argv)
+        else:
+            if not argv.log:
+                raise ValueError("report needs --log")
+            profile = parse_log(argv.log)
+    except (RuntimeError, ValueError, OSError) as ex:
+        print(ex)
+        sys.exit(1)
+
+    print_report(profile, argv.top)
+    if argv.folded:
+        write_folded(profile, argv.folded)
+    if argv.json:
+        with open(argv.json, "w") as f:
+            json.dump(profile.to_json(), f, indent=2)
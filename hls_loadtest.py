@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 7):
+    print(
+        "Tried to start script with an unsupported version of Python. hls_loadtest requires Python 3.7 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import threading
+import time
+
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from async_http import HttpClient, HttpError
+
+# Capacity test for one node: simulated HLS viewers against the shipped nginx sites.
+#
+# "generate" writes test streams the sites serve: live channels into the HLS tree
+# (a sliding playlist with EXT-X-PROGRAM-DATE-TIME, rewritten at the segment
+# cadence) and one VOD file into the VODS tree, addressed with EXT-X-BYTERANGE.
+# "run" starts viewers that behave like players: live viewers reload the playlist
+# once per target duration and fetch every new segment, VOD viewers play the file
+# range by range. Load is ramped in steps until the SLO breaks.
+
+STREAMER_DIR = "/home/fastocloud/streamer"
+HLS_DIR = os.path.join(STREAMER_DIR, "hls")
+VODS_DIR = os.path.join(STREAMER_DIR, "vods")
+LIVE_PREFIX = "loadtest_"
+VOD_NAME = "loadtest_vod"
+PLAYLIST = "index.m3u8"
+
+DEFAULT_HLS_URL = "http://127.0.0.1:82"
+DEFAULT_VODS_URL = "http://127.0.0.1:83"
+DEFAULT_CHANNELS = 4
+DEFAULT_BITRATE_KBPS = 3000
+DEFAULT_SEGMENT_DURATION = 2
+DEFAULT_WINDOW = 6
+DEFAULT_VOD_DURATION = 600
+
+DEFAULT_START = 50
+DEFAULT_STEP = 50
+DEFAULT_STEP_DURATION = 30
+DEFAULT_MAX_CLIENTS = 5000
+DEFAULT_VOD_SHARE = 0.2
+DEFAULT_SLO_TTFB = 0.5
+DEFAULT_SLO_ERRORS = 1.0
+# playlist staleness SLO in segment durations
+DEFAULT_SLO_STALENESS_SEGMENTS = 3
+# segments a player fetches back to back before it starts playing
+PREBUFFER = 3
+
+
+class Segment:
+    __slots__ = ("uri", "duration", "start", "byterange")
+
+    def __init__(self, uri: str, duration: float, start: Optional[float], byterange: Optional[Tuple[int, int]]):
+        self.uri = uri
+        self.duration = duration
+        # EXT-X-PROGRAM-DATE-TIME as unix time
+        self.start = start
+        # (offset, length)
+        self.byterange = byterange
+
+
+class Playlist:
+    def __init__(self, data: str, target_duration: float = DEFAULT_SEGMENT_DURATION):
+        self.media_sequence = 0
+        self.target_duration = target_duration
+        self.segments = []  # type: List[Segment]
+        self.ended = False
+
+        duration = None
+        start = None
+        byterange = None
+        next_offset = 0
+        for line in data.splitlines():
+            line = line.strip()
+            if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                self.media_sequence = int(line[22:])
+            elif line.startswith("#EXT-X-TARGETDURATION:"):
+                self.target_duration = float(line[22:])
+            elif line.startswith("#EXTINF:"):
+                duration = float(line[8:].split(",")[0])
+            elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+                start = parse_date(line[25:])
+            elif line.startswith("#EXT-X-BYTERANGE:"):
+                length, _, offset = line[17:].partition("@")
+                offset = int(offset) if offset else next_offset
+                byterange = (offset, int(length))
+                next_offset = offset + int(length)
+            elif line == "#EXT-X-ENDLIST":
+                self.ended = True
+            elif line and not line.startswith("#"):
+                self.segments.append(Segment(line, duration or self.target_duration, start, byterange))
+                if start is not None:
+                    start += duration or self.target_duration
+                duration = None
+                byterange = None
+
+    @property
+    def last_sequence(self) -> int:
+        return self.media_sequence + len(self.segments) - 1
+
+
+def parse_date(value: str) -> Optional[float]:
+    try:
+        return datetime.strptime(value.replace("Z", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+    except ValueError:
+        return None
+
+
+def format_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class LiveGenerator(threading.Thread):
+    def __init__(self, channels: int, bitrate_kbps: int, segment_duration: int, window: int):
+        super().__init__(daemon=True)
+        self.channels = channels
+        self.segment_duration = segment_duration
+        self.window = window
+        # same payload for every segment: nginx only moves bytes
+        self.payload = os.urandom(bitrate_kbps * 1000 // 8 * segment_duration)
+        self.stopped = threading.Event()
+
+    def channel_dir(self, channel: int) -> str:
+        return os.path.join(HLS_DIR, f"{LIVE_PREFIX}{channel}")
+
+    def write_segment(self, sequence: int, now: float) -> None:
+        first = max(0, sequence - self.window + 1)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+                 f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for number in range(first, sequence + 1):
+            start = now - (sequence + 1 - number) * self.segment_duration
+            lines += [f"#EXT-X-PROGRAM-DATE-TIME:{format_date(start)}",
+                      f"#EXTINF:{self.segment_duration:.3f},", f"segment_{number}.ts"]
+        playlist = ("\n".join(lines) + "\n").encode()
+
+        for channel in range(self.channels):
+            directory = self.channel_dir(channel)
+            write_atomic(os.path.join(directory, f"segment_{sequence}.ts"), self.payload)
+            write_atomic(os.path.join(directory, PLAYLIST), playlist)
+            expired = os.path.join(directory, f"segment_{first - 2}.ts")
+            if os.path.exists(expired):
+                os.remove(expired)
+
+    def run(self) -> None:
+        for channel in range(self.channels):
+            directory = self.channel_dir(channel)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
+        sequence = 0
+        deadline = time.time()
+        while not self.stopped.is_set():
+            self.write_segment(sequence, time.time())
+            sequence += 1
+            deadline += self.segment_duration
+            self.stopped.wait(max(0.0, deadline - time.time()))
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        for channel in range(self.channels):
+            shutil.rmtree(self.channel_dir(channel), ignore_errors=True)
+
+
+def generate_vod(bitrate_kbps: int, segment_duration: int, duration: int) -> None:
+    directory = os.path.join(VODS_DIR, VOD_NAME)
+    os.makedirs(directory, exist_ok=True)
+    segment_size = bitrate_kbps * 1000 // 8 * segment_duration
+    segments = duration // segment_duration
+    payload = os.urandom(segment_size)
+    with open(os.path.join(directory, "stream.ts"), "wb") as f:
+        for _ in range(segments):
+            f.write(payload)
+
+    lines = ["#EXTM3U", "#EXT-X-VERSION:4", f"#EXT-X-TARGETDURATION:{segment_duration}",
+             "#EXT-X-PLAYLIST-TYPE:VOD", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for number in range(segments):
+        lines += [f"#EXTINF:{segment_duration:.3f},", f"#EXT-X-BYTERANGE:{segment_size}@{number * segment_size}",
+                  "stream.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    write_atomic(os.path.join(directory, PLAYLIST), ("\n".join(lines) + "\n").encode())
+    print(f"VOD test stream: {directory} ({segments} segments of {segment_size} bytes)")
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.ttfb = []  # type: List[float]
+        self.staleness = []  # type: List[float]
+
+    def record(self, response, segment: bool) -> None:
+        self.requests += 1
+        self.bytes += response.size
+        if response.status >= 400:
+            self.errors += 1
+        elif segment:
+            self.ttfb.append(response.ttfb)
+
+    def error(self) -> None:
+        self.requests += 1
+        self.errors += 1
+
+
+def segment_headers(segment: Segment) -> Optional[dict]:
+    if not segment.byterange:
+        return None
+    offset, length = segment.byterange
+    return {"Range": f"bytes={offset}-{offset + length - 1}"}
+
+
+def join_path(playlist_path: str, uri: str) -> str:
+    if uri.startswith("/"):
+        return uri
+    return playlist_path.rsplit("/", 1)[0] + "/" + uri
+
+
+async def fetch(http: HttpClient, stats: Stats, path: str, segment: bool, headers: Optional[dict] = None):
+    try:
+        response = await http.request("GET", path, headers, keep_body=not segment)
+    except HttpError:
+        stats.error()
+        return None
+    stats.record(response, segment)
+    return response if response.status < 400 else None
+
+
+async def live_viewer(base_url: str, path: str, stats: Stats, segment_duration: float) -> None:
+    http = HttpClient(base_url)
+    last_sequence = None
+    # viewers do not all reload at the same moment
+    await asyncio.sleep(random.uniform(0, segment_duration))
+    try:
+        while True:
+            started = time.monotonic()
+            response = await fetch(http, stats, path, False)
+            target = segment_duration
+            if response:
+                playlist = Playlist(response.body.decode(errors="replace"), segment_duration)
+                target = playlist.target_duration
+                if playlist.segments:
+                    last = playlist.segments[-1]
+                    if last.start is not None:
+                        # how far the served playlist is behind the live edge
+                        stats.staleness.append(max(0.0, time.time() - last.start - last.duration))
+
+                if last_sequence is None:
+                    last_sequence = playlist.last_sequence - PREBUFFER
+                for number, segment in enumerate(playlist.segments, playlist.media_sequence):
+                    if number > last_sequence:
+                        await fetch(http, stats, join_path(path, segment.uri), True)
+                last_sequence = max(last_sequence, playlist.last_sequence)
+            await asyncio.sleep(max(0.0, target - (time.monotonic() - started)))
+    finally:
+        await http.close()
+
+
+async def vod_viewer(base_url: str, path: str, stats: Stats, segment_duration: float) -> None:
+    http = HttpClient(base_url)
+    try:
+        response = None
+        while not response:
+            response = await fetch(http, stats, path, False)
+            if not response:
+                await asyncio.sleep(segment_duration)
+        playlist = Playlist(response.body.decode(errors="replace"), segment_duration)
+
+        # start at a random position, as viewers of a catalogue do
+        position = random.randrange(len(playlist.segments))
+        buffered = 0
+        while True:
+            segment = playlist.segments[position]
+            started = time.monotonic()
+            await fetch(http, stats, join_path(path, segment.uri), True, segment_headers(segment))
+            position = (position + 1) % len(playlist.segments)
+            buffered += 1
+            if buffered > PREBUFFER:
+                await asyncio.sleep(max(0.0, segment.duration - (time.monotonic() - started)))
+    finally:
+        await http.close()
+
+
+def cpu_times() -> Tuple[int, int]:
+    with open("/proc/stat", "r") as f:
+        fields = [int(value) for value in f.readline().split()[1:]]
+    idle = fields[3] + fields[4]
+    return sum(fields) - idle, sum(fields)
+
+
+async def ramp(argv) -> int:
+    stats = Stats()
+    tasks = []  # type: List[asyncio.Task]
+    clients = 0
+    last_good = 0
+
+    print("clients  mbit/s  req/s  ttfb_p50  ttfb_p99  stale_p99  errors%  node_cpu%  tool_cpu%")
+    while clients < argv.max_clients:
+        target = min(argv.max_clients, argv.start if not clients else clients + argv.step)
+        for number in range(clients, target):
+            if random.random() < argv.vod_share:
+                viewer = vod_viewer(argv.vods_url, f"/{VOD_NAME}/{PLAYLIST}", stats, argv.segment_duration)
+            else:
+                channel = number % argv.channels
+                viewer = live_viewer(argv.hls_url, f"/{LIVE_PREFIX}{channel}/{PLAYLIST}", stats,
+                                     argv.segment_duration)
+            tasks.append(asyncio.ensure_future(viewer))
+        clients = target
+
+        # let the new viewers get through their prebuffering first
+        await asyncio.sleep(min(argv.step_duration / 4, 2 * argv.segment_duration))
+        stats.reset()
+        busy, total = cpu_times()
+        tool_cpu = time.process_time()
+        await asyncio.sleep(argv.step_duration)
+        elapsed = time.monotonic() - stats.started
+        busy_now, total_now = cpu_times()
+        node_cpu = 100.0 * (busy_now - busy) / max(1, total_now - total)
+        tool_cpu = 100.0 * (time.process_time() - tool_cpu) / elapsed
+
+        errors = 100.0 * stats.errors / max(1, stats.requests)
+        ttfb_p50 = percentile(stats.ttfb, 50)
+        ttfb_p99 = percentile(stats.ttfb, 99)
+        stale_p99 = percentile(stats.staleness, 99)
+        print(f"{clients:7d}  {stats.bytes * 8 / elapsed / 1000000:6.1f}  {stats.requests / elapsed:5.0f}  "
+              f"{ttfb_p50:8.3f}  {ttfb_p99:8.3f}  {stale_p99:9.2f}  {errors:7.2f}  {node_cpu:9.1f}  "
+              f"{tool_cpu:9.1f}", flush=True)
+        if tool_cpu > 90:
+            print("Warning: the load generator is CPU bound, results are limited by this machine")
+
+        broken = []
+        if ttfb_p99 > argv.slo_ttfb:
+            broken.append(f"ttfb p99 {ttfb_p99:.3f}s > {argv.slo_ttfb}s")
+        if errors > argv.slo_errors:
+            broken.append(f"errors {errors:.2f}% > {argv.slo_errors}%")
+        if stale_p99 > argv.slo_staleness:
+            broken.append(f"staleness p99 {stale_p99:.2f}s > {argv.slo_staleness}s")
+        if broken:
+            print(f"SLO broken at {clients} clients: {', '.join(broken)}")
+            break
+        last_good = clients
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"Capacity: {last_good} concurrent viewers within the SLO")
+    return last_good
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="hls_loadtest", usage="%(prog)s [options] {generate,run}")
+    parser.add_argument("command", choices=["generate", "run"])
+    parser.add_argument("--channels", help=f"live test channels (default: {DEFAULT_CHANNELS})", type=int,
+                        default=DEFAULT_CHANNELS)
+    parser.add_argument("--bitrate", help=f"test stream bitrate in kbit/s (default: {DEFAULT_BITRATE_KBPS})",
+                        type=int, default=DEFAULT_BITRATE_KBPS)
+    parser.add_argument("--segment-duration", help=f"seconds (default: {DEFAULT_SEGMENT_DURATION})", type=int,
+                        default=DEFAULT_SEGMENT_DURATION)
+    parser.add_argument("--window", help=f"segments in the live playlist (default: {DEFAULT_WINDOW})", type=int,
+                        default=DEFAULT_WINDOW)
+    parser.add_argument("--vod-duration", help=f"seconds of VOD test content (default: {DEFAULT_VOD_DURATION})",
+                        type=int, default=DEFAULT_VOD_DURATION)
+    parser.add_argument("--generate", help="write the live test channels while running", action="store_true")
+    parser.add_argument("--hls-url", help=f"HLS site (default: {DEFAULT_HLS_URL})", default=DEFAULT_HLS_URL)
+    parser.add_argument("--vods-url", help=f"VODS site (default: {DEFAULT_VODS_URL})", default=DEFAULT_VODS_URL)
+    parser.add_argument("--vod-share", help=f"fraction of VOD viewers (default: {DEFAULT_VOD_SHARE})", type=float,
+                        default=DEFAULT_VOD_SHARE)
+    parser.add_argument("--start", help=f"viewers of the first step (default: {DEFAULT_START})", type=int,
+                        default=DEFAULT_START)
+    parser.add_argument("--step", help=f"viewers added per step (default: {DEFAULT_STEP})", type=int,
+                        default=DEFAULT_STEP)
+    parser.add_argument("--step-duration", help=f"seconds per step (default: {DEFAULT_STEP_DURATION})", type=int,
+                        default=DEFAULT_STEP_DURATION)
+    parser.add_argument("--max-clients", help=f"(default: {DEFAULT_MAX_CLIENTS})", type=int,
+                        default=DEFAULT_MAX_CLIENTS)
+    parser.add_argument("--slo-ttfb", help=f"segment ttfb p99 in seconds (default: {DEFAULT_SLO_TTFB})", type=float,
+                        default=DEFAULT_SLO_TTFB)
+    parser.add_argument("--slo-errors", help=f"error percent (default: {DEFAULT_SLO_ERRORS})", type=float,
+                        default=DEFAULT_SLO_ERRORS)
+    parser.add_argument("--slo-staleness", help="playlist staleness p99 in seconds "
+                        f"(default: {DEFAULT_SLO_STALENESS_SEGMENTS} segment durations)", type=float)
+    argv = parser.parse_args()
+    if argv.slo_staleness is None:
+        argv.slo_staleness = DEFAULT_SLO_STALENESS_SEGMENTS * argv.segment_duration
+
+    live = LiveGenerator(argv.channels, argv.bitrate, argv.segment_duration, argv.window)
+    if argv.command == "generate":
+        generate_vod(argv.bitrate, argv.segment_duration, argv.vod_duration)
+        print(f"Live test channels: {live.channel_dir(0)}..{live.channel_dir(argv.channels - 1)}, Ctrl+C to stop")
+        live.start()
+        try:
+            live.join()
+        except KeyboardInterrupt:
+            live.stop()
+    else:
+        if argv.generate:
+            generate_vod(argv.bitrate, argv.segment_duration, argv.vod_duration)
+            live.start()
+        try:
+            asyncio.run(ramp(argv))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if argv.generate:
+                live.stop()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. live_storage requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import os
+import pwd
+import shutil
+import subprocess
+import syslog
+
+from typing import Dict, List, Tuple
+
+import fastocloud_service
+
+# RAM-backed (tmpfs) storage for the live trees the streamer rewrites continuously.
+# VODS and timeshift directories are deliberately not listed: they hold long-lived
+# content and stay on disk.
+
+FASTOCLOUD_USER = "fastocloud"
+STREAMER_DIR = "/home/fastocloud/streamer"
+LIVE_DIRS = {
+    "hls": os.path.join(STREAMER_DIR, "hls"),
+    "cods": os.path.join(STREAMER_DIR, "cods"),
+    "proxy": os.path.join(STREAMER_DIR, "proxy"),
+}
+
+FSTAB_PATH = "/etc/fstab"
+FSTAB_MARKER = "# fastocloud live storage"
+
+MONITOR_UNIT = "fastocloud-live-storage-monitor"
+
+DEFAULT_BITRATE_KBPS = 5000
+DEFAULT_WINDOW_SECONDS = 60
+# Segments being written, and expired segments the streamer has not removed yet
+DEFAULT_HEADROOM = 1.5
+DEFAULT_THRESHOLD = 90
+MIN_SIZE_MB = 64
+
+MONITOR_SERVICE_TEMPLATE = """[Unit]
+Description=FastoCloud live storage overflow monitor
+
+[Service]
+Type=oneshot
+ExecStart={python} {script} monitor --threshold {threshold}
+"""
+
+MONITOR_TIMER_TEMPLATE = """[Unit]
+Description=Check FastoCloud live storage usage every minute
+
+[Timer]
+OnBootSec=1min
+OnUnitActiveSec=1min
+
+[Install]
+WantedBy=timers.target
+"""
+
+
+def live_dir_size_mb(channels: int, bitrate_kbps: int, window_seconds: int, headroom: float) -> int:
+    # every channel keeps a window worth of segments at its total (all renditions) bitrate
+    window_bytes = channels * bitrate_kbps * 1000 / 8 * window_seconds
+    size_mb = int(window_bytes * headroom / (1024 * 1024)) + 1
+    return max(MIN_SIZE_MB, size_mb)
+
+
+def fastocloud_ids() -> Tuple[int, int]:
+    try:
+        user = pwd.getpwnam(FASTOCLOUD_USER)
+    except KeyError:
+        # same as fast_build_fastocloud_env_*.sh, which runs after build_env.py
+        subprocess.check_call(
+            ["useradd", "-m", "-U", "-d", f"/home/{FASTOCLOUD_USER}", FASTOCLOUD_USER, "-s", "/bin/bash"]
+        )
+        user = pwd.getpwnam(FASTOCLOUD_USER)
+    return user.pw_uid, user.pw_gid
+
+
+def fstab_line(path: str, size_mb: int, uid: int, gid: int) -> str:
+    options = f"rw,nosuid,nodev,noexec,size={size_mb}m,uid={uid},gid={gid},mode=0755"
+    return f"tmpfs {path} tmpfs {options} 0 0\n"
+
+
+def write_fstab(entries: Dict[str, str]) -> None:
+    with open(FSTAB_PATH, "r") as f:
+        lines = f.readlines()
+
+    # replace previous fastocloud entries for the same mount points
+    kept = []
+    for line in lines:
+        fields = line.split()
+        if line.strip() == FSTAB_MARKER:
+            continue
+        if len(fields) > 2 and fields[2] == "tmpfs" and fields[1] in entries:
+            continue
+        kept.append(line)
+
+    if kept and not kept[-1].endswith("\n"):
+        kept[-1] += "\n"
+    kept.append(FSTAB_MARKER + "\n")
+    kept.extend(entries.values())
+
+    tmp_path = FSTAB_PATH + ".fastocloud"
+    with open(tmp_path, "w") as f:
+        f.writelines(kept)
+    shutil.copymode(FSTAB_PATH, tmp_path)
+    os.replace(tmp_path, FSTAB_PATH)
+
+
+def is_mountpoint(path: str) -> bool:
+    return os.path.ismount(path)
+
+
+def mount_live_dir(path: str, size_mb: int) -> None:
+    os.makedirs(path, exist_ok=True)
+    if is_mountpoint(path):
+        # live data is kept, the new size applies immediately
+        subprocess.check_call(["mount", "-o", f"remount,size={size_mb}m", path])
+    else:
+        if os.listdir(path):
+            print(f"Warning: {path} is not empty, its files are hidden while tmpfs is mounted")
+        subprocess.check_call(["mount", path])
+
+
+def install_monitor(threshold: int, prefix: str) -> None:
+    service = MONITOR_SERVICE_TEMPLATE.format(
+        python=sys.executable, script=fastocloud_service.install_script(__file__, prefix), threshold=threshold
+    )
+    fastocloud_service.install_units(
+        {MONITOR_UNIT + ".service": service, MONITOR_UNIT + ".timer": MONITOR_TIMER_TEMPLATE}, MONITOR_UNIT + ".timer"
+    )
+
+
+def setup(channels: Dict[str, int], bitrate_kbps: int, window_seconds: int, headroom: float,
+          threshold: int, prefix: str) -> None:
+    uid, gid = fastocloud_ids()
+    os.makedirs(STREAMER_DIR, exist_ok=True)
+    os.chown(STREAMER_DIR, uid, gid)
+
+    entries = {}
+    sizes = {}
+    for name, path in LIVE_DIRS.items():
+        size_mb = live_dir_size_mb(channels[name], bitrate_kbps, window_seconds, headroom)
+        print(f"Live storage {path}: {channels[name]} channels, tmpfs {size_mb}m")
+        entries[path] = fstab_line(path, size_mb, uid, gid)
+        sizes[path] = size_mb
+
+    write_fstab(entries)
+    for path, size_mb in sizes.items():
+        mount_live_dir(path, size_mb)
+
+    install_monitor(threshold, prefix)
+
+
+def usage(paths: List[str]) -> Dict[str, float]:
+    result = {}
+    for path in paths:
+        if not is_mountpoint(path):
+            continue
+        stat = os.statvfs(path)
+        total = stat.f_blocks * stat.f_frsize
+        if not total:
+            continue
+        free = stat.f_bavail * stat.f_frsize
+        result[path] = 100.0 * (total - free) / total
+    return result
+
+
+def monitor(threshold: int) -> int:
+    overflow = False
+    for path, used in usage(list(LIVE_DIRS.values())).items():
+        if used >= threshold:
+            overflow = True
+            message = f"live storage {path} is {used:.1f}% full (threshold {threshold}%)"
+            syslog.syslog(syslog.LOG_WARNING, message)
+            print(message, file=sys.stderr)
+        else:
+            print(f"live storage {path} is {used:.1f}% full")
+    return 1 if overflow else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="live_storage", usage="%(prog)s [options] {setup,size,monitor}")
+    parser.add_argument("command", choices=["setup", "size", "monitor"])
+    for name in LIVE_DIRS:
+        parser.add_argument(f"--{name}-channels", help=f"number of {name} channels (default: 0)", type=int,
+                            default=0)
+    parser.add_argument("--bitrate", help=f"total bitrate of one channel in kbit/s (default: {DEFAULT_BITRATE_KBPS})",
+                        type=int, default=DEFAULT_BITRATE_KBPS)
+    parser.add_argument("--window", help=f"seconds of segments kept per channel (default: {DEFAULT_WINDOW_SECONDS})",
+                        type=int, default=DEFAULT_WINDOW_SECONDS)
+    parser.add_argument("--headroom", help=f"size multiplier over the window (default: {DEFAULT_HEADROOM})",
+                        type=float, default=DEFAULT_HEADROOM)
+    parser.add_argument("--threshold", help=f"usage percent reported as overflow (default: {DEFAULT_THRESHOLD})",
+                        type=int, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--prefix", help=f"setup: environment prefix the monitor is installed into "
+                                         f"(default: {fastocloud_service.DEFAULT_PREFIX})",
+                        default=fastocloud_service.DEFAULT_PREFIX)
+    argv = parser.parse_args()
+
+    channels = {name: getattr(argv, f"{name}_channels") for name in LIVE_DIRS}
+    if argv.command == "setup":
+        setup(channels, argv.bitrate, argv.window, argv.headroom, argv.threshold, argv.prefix)
+    elif argv.command == "size":
+        for name, path in LIVE_DIRS.items():
+            print(f"{path}: {live_dir_size_mb(channels[name], argv.bitrate, argv.window, argv.headroom)}m")
+    else:
+        sys.exit(monitor(argv.threshold))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. log_analytics requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import time
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Incremental per-stream analytics over the FastoCloud nginx access logs.
+#
+# Every run continues each log from the offset saved in the state file, so a log
+# is only ever read once. Lines are matched in bulk with one compiled pattern per
+# chunk and folded into fixed-size time buckets: per stream a request count, the
+# egress bytes and a HyperLogLog sketch of the viewers (client address + user
+# agent). A bucket is written to the time series once the logs have moved past
+# it; buckets still open when a run ends are kept in the state file.
+#
+# Sites may log only a sample of the segment hits (nginx/fastocloud_common);
+# each logged line carries the weight it stands for, requests and egress are
+# scaled by it. Playlists are never sampled, so every viewer is still seen.
+
+LOG_GLOB = "/var/log/nginx/fastocloud_*_access.log"
+STATE_PATH = "/var/lib/fastocloud/log_analytics.json"
+
+DEFAULT_STEP = 60
+# nginx flushes the access log buffers every 5s, lines of a bucket may arrive that late
+DEFAULT_LATENESS = 30
+DEFAULT_MAX_STREAMS = 10000
+DEFAULT_INTERVAL = 10
+CHUNK_SIZE = 8 * 1024 * 1024
+
+OTHER_STREAM = "_other"
+TOTAL_STREAM = "_total"
+
+# JSON string value (escape=json) and bare number, unrolled for speed
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_NUMBER = rb"[^,]*"
+
+# fastocloud_json (nginx/fastocloud_common), field for field; keep in sync with the log_format
+JSON_PATTERN = re.compile(
+    rb'^\{"time":"[^"]*","msec":(\d+)\.\d+,"remote_addr":"([^"]*)","method":' + _STRING + rb',"uri":' + _STRING
+    + rb',"args":' + _STRING + rb',"status":\d+,"bytes_sent":(\d+),"body_bytes_sent":' + _NUMBER
+    + rb',"request_time":' + _NUMBER + rb',"upstream_response_time":' + _STRING
+    + rb',"stream_id":"([^"\\]*(?:\\.[^"\\]*)*)","range":' + _STRING + rb',"connection":' + _NUMBER
+    + rb',"connection_requests":' + _NUMBER + rb',"server_port":' + _NUMBER
+    + rb',"user_agent":"([^"\\]*(?:\\.[^"\\]*)*)"(?:,"referer":' + _STRING + rb',"weight":([\d.]+))?',
+    re.MULTILINE,
+)
+
+# nginx "combined" format, written by the sites before fastocloud_json
+COMBINED_PATTERN = re.compile(
+    rb'^(\S+) \S+ \S+ \[([^\]]+)\] "\S+ /([^/ ?"]+)/[^"]*" \d{3} (\d+) "[^"]*" "([^"\\]*(?:\\.[^"\\]*)*)"',
+    re.MULTILINE,
+)
+
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+
+
+class ViewerSketch:
+    # HyperLogLog: 1 KiB per stream and bucket, ~3% error on the distinct viewer count
+    __slots__ = ("registers",)
+
+    def __init__(self, registers: Optional[bytearray] = None):
+        self.registers = registers if registers is not None else bytearray(HLL_REGISTERS)
+
+    def add(self, key: bytes) -> None:
+        value = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+        index = value & (HLL_REGISTERS - 1)
+        rank = 64 - HLL_PRECISION - (value >> HLL_PRECISION).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "ViewerSketch") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        estimate = HLL_ALPHA * HLL_REGISTERS * HLL_REGISTERS / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return int(round(estimate))
+
+
+class StreamBucket:
+    __slots__ = ("requests", "egress", "viewers")
+
+    def __init__(self):
+        self.requests = 0
+        self.egress = 0
+        self.viewers = ViewerSketch()
+
+
+class Aggregator:
+    def __init__(self, step: int, lateness: int, max_streams: int):
+        self.step = step
+        self.lateness = lateness
+        self.max_streams = max_streams
+        # bucket start -> stream id -> StreamBucket
+        self.buckets = {}  # type: Dict[int, Dict[str, StreamBucket]]
+        self.watermark = 0
+        self.closed_before = 0
+
+    def add(self, second: int, stream: str, requests: int, egress: int, viewers: Iterable[bytes]) -> None:
+        start = second // self.step * self.step
+        if start < self.closed_before:
+            # arrived after its bucket was written, count it in the oldest open one
+            start = self.closed_before
+        streams = self.buckets.get(start)
+        if streams is None:
+            streams = self.buckets[start] = {}
+        bucket = streams.get(stream)
+        if bucket is None:
+            if len(streams) >= self.max_streams:
+                stream = OTHER_STREAM
+                bucket = streams.get(stream)
+            if bucket is None:
+                bucket = streams[stream] = StreamBucket()
+        bucket.requests += requests
+        bucket.egress += egress
+        for viewer in viewers:
+            bucket.viewers.add(viewer)
+        if second > self.watermark:
+            self.watermark = second
+
+    def close(self, flush_all: bool = False) -> Iterator[Tuple[int, str, StreamBucket]]:
+        limit = self.watermark - self.lateness - self.step
+        for start in sorted(self.buckets):
+            if not flush_all and start > limit:
+                break
+            streams = self.buckets.pop(start)
+            total = StreamBucket()
+            for stream in sorted(streams):
+                bucket = streams[stream]
+                total.requests += bucket.requests
+                total.egress += bucket.egress
+                total.viewers.merge(bucket.viewers)
+                yield start, stream, bucket
+            yield start, TOTAL_STREAM, total
+            self.closed_before = start + self.step
+
+    def dump(self) -> dict:
+        return {
+            "watermark": self.watermark,
+            "closed_before": self.closed_before,
+            "buckets": {
+                str(start): {
+                    stream: [bucket.requests, bucket.egress, base64.b64encode(bucket.viewers.registers).decode()]
+                    for stream, bucket in streams.items()
+                }
+                for start, streams in self.buckets.items()
+            },
+        }
+
+    def load(self, state: dict) -> None:
+        self.watermark = state.get("watermark", 0)
+        self.closed_before = state.get("closed_before", 0)
+        for start, streams in state.get("buckets", {}).items():
+            loaded = self.buckets[int(start)] = {}
+            for stream, (requests, egress, registers) in streams.items():
+                bucket = loaded[stream] = StreamBucket()
+                bucket.requests = requests
+                bucket.egress = egress
+                bucket.viewers = ViewerSketch(bytearray(base64.b64decode(registers)))
+
+
+_combined_times = {}  # type: Dict[bytes, float]
+
+
+def combined_time(value: bytes) -> float:
+    # one strptime per distinct second
+    result = _combined_times.get(value)
+    if result is None:
+        if len(_combined_times) > 4096:
+            _combined_times.clear()
+        result = datetime.strptime(value.decode(), "%d/%b/%Y:%H:%M:%S %z").timestamp()
+        _combined_times[value] = result
+    return result
+
+
+def parse_chunk(data: bytes, aggregator: Aggregator) -> int:
+    # pre-aggregate the chunk per second and stream, so the sketches only see
+    # each viewer once per chunk instead of once per segment request
+    step = aggregator.step
+    groups = {}  # type: Dict[Tuple[int, bytes], list]
+    lines = 0
+    if data[:1] == b"{":
+        matches = ((int(msec), addr, sent, stream, agent, float(weight) if weight else 1.0)
+                   for msec, addr, sent, stream, agent, weight in JSON_PATTERN.findall(data))
+    else:
+        matches = ((int(combined_time(stamp)), addr, sent, stream, agent, 1.0)
+                   for addr, stamp, stream, sent, agent in COMBINED_PATTERN.findall(data))
+
+    for second, addr, sent, stream, agent, weight in matches:
+        if not stream:
+            continue
+        key = (second - second % step, stream)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0.0, 0.0, set()]
+        group[0] += weight
+        group[1] += int(sent) * weight
+        group[2].add(addr + b"\0" + agent)
+        lines += 1
+
+    for (second, stream), (requests, egress, viewers) in groups.items():
+        aggregator.add(second, stream.decode(errors="replace"), int(round(requests)), int(round(egress)), viewers)
+    return lines
+
+
+def read_from(path: str, offset: int, aggregator: Aggregator) -> Tuple[int, int]:
+    lines = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        rest = b""
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            data = rest + chunk
+            end = data.rfind(b"\n") + 1
+            # a partially written last line is read again on the next run
+            rest = data[end:]
+            if end:
+                lines += parse_chunk(data[:end], aggregator)
+                offset += end
+    return offset, lines
+
+
+def rotated_path(path: str, inode: int) -> Optional[str]:
+    # logrotate renames the live log to <log>.1 (delaycompress keeps it uncompressed)
+    for candidate in (path + ".1", path + "-" + time.strftime("%Y%m%d")):
+        try:
+            if os.stat(candidate).st_ino == inode:
+                return candidate
+        except OSError:
+            continue
+    return None
+
+
+def process_log(path: str, files: Dict[str, dict], aggregator: Aggregator) -> int:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+
+    saved = files.get(path, {})
+    offset = saved.get("offset", 0)
+    lines = 0
+    if saved and saved.get("inode") != stat.st_ino:
+        # rotated since the last run: finish the old file first
+        old = rotated_path(path, saved["inode"])
+        if old:
+            _, lines = read_from(old, offset, aggregator)
+        offset = 0
+    elif stat.st_size < offset:
+        # truncated (copytruncate)
+        offset = 0
+
+    offset, read = read_from(path, offset, aggregator)
+    files[path] = {"inode": stat.st_ino, "offset": offset}
+    return lines + read
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path: str, state: dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def format_row(start: int, stream: str, bucket: StreamBucket, step: int, output_format: str) -> str:
+    stamp = datetime.fromtimestamp(start, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    viewers = bucket.viewers.count()
+    rps = bucket.requests / step
+    mbps = bucket.egress * 8 / step / 1000000
+    if output_format == "jsonl":
+        return json.dumps({"time": stamp, "stream": stream, "viewers": viewers, "requests": bucket.requests,
+                           "rps": round(rps, 3), "egress_bytes": bucket.egress, "egress_mbps": round(mbps, 3)})
+    return f"{stamp},{stream},{viewers},{bucket.requests},{rps:.3f},{bucket.egress},{mbps:.3f}"
+
+
+def restore(state_path: str, aggregator: Aggregator) -> Dict[str, dict]:
+    state = load_state(state_path)
+    if state.get("step", aggregator.step) == aggregator.step:
+        aggregator.load(state.get("aggregator", {}))
+    return state.get("files", {})
+
+
+def run_once(logs: List[str], files: Dict[str, dict], state_path: str, aggregator: Aggregator, output,
+             output_format: str, flush_all: bool) -> int:
+    lines = 0
+    for path in logs:
+        lines += process_log(path, files, aggregator)
+
+    for start, stream, bucket in aggregator.close(flush_all):
+        print(format_row(start, stream, bucket, aggregator.step, output_format), file=output)
+    output.flush()
+
+    save_state(state_path, {"step": aggregator.step, "files": files, "aggregator": aggregator.dump()})
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="log_analytics", usage="%(prog)s [options] {once,follow}")
+    parser.add_argument("command", choices=["once", "follow"])
+    parser.add_argument("logs", nargs="*", help=f"access logs (default: {LOG_GLOB})")
+    parser.add_argument("--state", help=f"offsets and open buckets (default: {STATE_PATH})", default=STATE_PATH)
+    parser.add_argument("--step", help=f"bucket size in seconds (default: {DEFAULT_STEP})", type=int,
+                        default=DEFAULT_STEP)
+    parser.add_argument("--lateness", help=f"seconds a bucket stays open (default: {DEFAULT_LATENESS})", type=int,
+                        default=DEFAULT_LATENESS)
+    parser.add_argument("--max-streams", help=f"streams tracked per bucket (default: {DEFAULT_MAX_STREAMS})",
+                        type=int, default=DEFAULT_MAX_STREAMS)
+    parser.add_argument("--interval", help=f"seconds between passes in follow mode (default: {DEFAULT_INTERVAL})",
+                        type=int, default=DEFAULT_INTERVAL)
+    parser.add_argument("--format", help="time series format (default: csv)", choices=["csv", "jsonl"],
+                        default="csv")
+    parser.add_argument("--output", help="append the time series to this file (default: stdout)")
+    parser.add_argument("--flush", help="write open buckets too (once mode)", action="store_true")
+    argv = parser.parse_args()
+
+    logs = argv.logs or sorted(glob.glob(LOG_GLOB))
+    aggregator = Aggregator(argv.step, argv.lateness, argv.max_streams)
+    output = open(argv.output, "a") if argv.output else sys.stdout
+    if argv.format == "csv" and (not argv.output or output.tell() == 0):
+        print("time,stream,viewers,requests,rps,egress_bytes,egress_mbps", file=output)
+
+    files = restore(argv.state, aggregator)
+    if argv.command == "once":
+        started = time.monotonic()
+        lines = run_once(logs, files, argv.state, aggregator, output, argv.format, argv.flush)
+        print(f"{lines} requests in {time.monotonic() - started:.2f}s", file=sys.stderr)
+    else:
+        while True:
+            run_once(logs, files, argv.state, aggregator, output, argv.format, False)
+            time.sleep(argv.interval)
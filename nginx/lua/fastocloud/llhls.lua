@@ -0,0 +1,299 @@
+-- Low-latency HLS (RFC 8216bis) support for statically written playlists.
+--
+-- Only playlist requests carrying _HLS_msn/_HLS_part come here (see
+-- $fastocloud_llhls_blocking), every other playlist request is served from
+-- disk. A blocking request is held until the playlist on disk contains the
+-- requested media segment or partial segment, then redirected internally to
+-- the same playlist without the query, so it is served from disk as well.
+-- Requests for a preload hint the packager advertised are held until the
+-- playlist moves on past it.
+--
+-- Playlists are served unchanged: EXT-X-SERVER-CONTROL and EXT-X-PRELOAD-HINT
+-- are the packager's to write.
+--
+-- Waiters neither reread nor poll the playlist themselves. One timer per
+-- playlist and worker checks it while requests wait, and posts a semaphore
+-- those requests sleep on whenever the playlist changes. The parsed state of
+-- every playlist is cached in the llhls_playlists shared dict for cache_ttl
+-- seconds, and only the worker that takes the refresh lock rereads the file,
+-- so however many players block on a channel it is read about once per
+-- cache_ttl.
+local semaphore = require("ngx.semaphore")
+
+local _M = {}
+
+local STATE_PREFIX = "state:"
+local LOCK_PREFIX = "lock:"
+local HINT_PREFIX = "hint:"
+
+local config = {
+  -- seconds between the playlist checks of the timer watching a playlist
+  poll_interval = 0.05,
+  -- parsed playlist state is shared between workers for this long
+  cache_ttl = 0.05,
+  -- upper bound for blocking when the playlist has no target duration yet
+  max_block = 6,
+  -- seconds a preload hint request waits for its part
+  preload_timeout = 3
+}
+
+-- path -> { sema, waiting, watching, state } of the playlists requests of
+-- this worker are blocked on
+local watched = {}
+
+function _M.configure(options)
+  for key, value in pairs(options) do
+    if config[key] == nil then
+      error("unknown LL-HLS option: " .. key)
+    end
+    config[key] = value
+  end
+end
+
+local function read_file(path)
+  local file = io.open(path, "rb")
+  if not file then
+    return nil
+  end
+  local data = file:read("*a")
+  file:close()
+  return data
+end
+
+local function file_exists(path)
+  local file = io.open(path, "rb")
+  if not file then
+    return false
+  end
+  file:close()
+  return true
+end
+
+-- Media sequence number of the last complete segment, number of parts of the
+-- segment in progress and the timing the spec derives limits from.
+local function parse_playlist(data)
+  local media_sequence = 0
+  local segments = 0
+  local parts = 0
+  local target_duration
+  local part_target
+  local preload_hint
+
+  for line in string.gmatch(data, "[^\r\n]+") do
+    if string.sub(line, 1, 8) == "#EXTINF:" then
+      segments = segments + 1
+      parts = 0
+    elseif string.sub(line, 1, 12) == "#EXT-X-PART:" then
+      parts = parts + 1
+    elseif string.sub(line, 1, 22) == "#EXT-X-MEDIA-SEQUENCE:" then
+      media_sequence = tonumber(string.sub(line, 23)) or 0
+    elseif string.sub(line, 1, 22) == "#EXT-X-TARGETDURATION:" then
+      target_duration = tonumber(string.sub(line, 23))
+    elseif string.sub(line, 1, 16) == "#EXT-X-PART-INF:" then
+      part_target = tonumber(string.match(line, "PART%-TARGET=([%d%.]+)"))
+    elseif string.sub(line, 1, 20) == "#EXT-X-PRELOAD-HINT:" then
+      preload_hint = string.match(line, 'URI="([^"]+)"')
+    end
+  end
+
+  return {
+    last_msn = media_sequence + segments - 1,
+    parts = parts,
+    target_duration = target_duration,
+    part_target = part_target,
+    preload_hint = preload_hint
+  }
+end
+
+local function encode_state(state)
+  return table.concat({ state.last_msn, state.parts, state.target_duration or "", state.part_target or "" }, ":")
+end
+
+local function decode_state(value)
+  local last_msn, parts, target_duration, part_target = string.match(value, "^(-?%d+):(%d+):([^:]*):(.*)$")
+  return {
+    last_msn = tonumber(last_msn),
+    parts = tonumber(parts),
+    target_duration = tonumber(target_duration),
+    part_target = tonumber(part_target)
+  }
+end
+
+-- The hint written by the packager, by file path; preload requests for
+-- anything else get 404 right away.
+local function register_hint(dict, path, root, hint)
+  if string.find(hint, "://", 1, true) then
+    return
+  end
+  local hint_path
+  if string.sub(hint, 1, 1) == "/" then
+    hint_path = root .. hint
+  else
+    hint_path = (string.match(path, "^(.*/)") or "") .. hint
+  end
+  dict:set(HINT_PREFIX .. hint_path, path, config.preload_timeout * 2)
+end
+
+-- Cached playlist state; only the lock holder rereads the file. Returns nil
+-- while another worker refreshes it and false when the playlist is missing.
+local function playlist_state(dict, path, root)
+  local value = dict:get(STATE_PREFIX .. path)
+  if value then
+    return decode_state(value)
+  end
+
+  if not dict:add(LOCK_PREFIX .. path, true, config.cache_ttl) then
+    return nil
+  end
+
+  local data = read_file(path)
+  if not data then
+    return false
+  end
+  local state = parse_playlist(data)
+  if state.preload_hint then
+    register_hint(dict, path, root, state.preload_hint)
+  end
+  dict:set(STATE_PREFIX .. path, encode_state(state), config.cache_ttl)
+  return state
+end
+
+local function wake(entry)
+  local count = entry.sema:count()
+  if count < 0 then
+    entry.sema:post(-count)
+  end
+end
+
+-- Timer checking a playlist while requests of this worker wait on it
+local function watch(premature, dict, path, root)
+  local entry = watched[path]
+  local version
+  while not premature and entry.waiting > 0 and not ngx.worker.exiting() do
+    local state = playlist_state(dict, path, root)
+    if state ~= nil then
+      local current = state and (state.last_msn .. ":" .. state.parts) or "missing"
+      if current ~= version then
+        version = current
+        entry.state = state
+        wake(entry)
+      end
+    end
+    ngx.sleep(config.poll_interval)
+  end
+
+  -- nothing yields from here on, so no request can start waiting unnoticed
+  entry.watching = false
+  if watched[path] == entry then
+    watched[path] = nil
+  end
+  wake(entry)
+end
+
+-- Sleeps until the playlist changes or timeout passes, returns the last
+-- state seen by the watching timer (nil if it has not read one yet).
+local function wait_for_change(dict, path, root, timeout)
+  local entry = watched[path]
+  if not entry then
+    entry = { sema = semaphore.new(), waiting = 0, watching = false }
+    watched[path] = entry
+  end
+  if not entry.watching then
+    local ok, err = ngx.timer.at(0, watch, dict, path, root)
+    if ok then
+      entry.watching = true
+    else
+      ngx.log(ngx.WARN, "failed to watch playlist ", path, ": ", err)
+      timeout = math.min(timeout, config.poll_interval)
+    end
+  end
+
+  entry.waiting = entry.waiting + 1
+  entry.sema:wait(timeout)
+  entry.waiting = entry.waiting - 1
+  return entry.state
+end
+
+local function is_ready(state, msn, part)
+  if msn <= state.last_msn then
+    return true
+  end
+  if part ~= nil and msn == state.last_msn + 1 then
+    return part < state.parts
+  end
+  return false
+end
+
+-- Named location for playlist requests with _HLS_msn or _HLS_part
+function _M.serve_playlist()
+  local dict = ngx.shared.llhls_playlists
+  local path = ngx.var.request_filename
+  local root = ngx.var.document_root
+  local args = ngx.req.get_uri_args()
+  local msn = tonumber(args._HLS_msn)
+  local part = tonumber(args._HLS_part)
+
+  if not msn then
+    -- _HLS_part without _HLS_msn, or not a number
+    return ngx.exit(ngx.HTTP_BAD_REQUEST)
+  end
+
+  local deadline = ngx.now() + config.max_block
+  local limited = false
+  local state = playlist_state(dict, path, root)
+  while true do
+    if state == false then
+      return ngx.exit(ngx.HTTP_NOT_FOUND)
+    end
+    if state then
+      if msn > state.last_msn + 2 then
+        return ngx.exit(ngx.HTTP_BAD_REQUEST)
+      end
+      if is_ready(state, msn, part) then
+        break
+      end
+      if not limited and state.target_duration then
+        -- the spec lets a server give up after three target durations
+        deadline = math.min(deadline, ngx.now() + state.target_duration * 3)
+        limited = true
+      end
+    end
+    local remaining = deadline - ngx.now()
+    if remaining <= 0 then
+      return ngx.exit(ngx.HTTP_SERVICE_UNAVAILABLE)
+    end
+    state = wait_for_change(dict, path, root, remaining)
+  end
+
+  -- without the query the playlist is served from disk
+  return ngx.exec(ngx.var.uri)
+end
+
+-- Named location behind try_files: the part was announced in a preload hint
+-- but is not written yet. The packager lists a part once it is complete, so
+-- the request is woken by the playlist changes.
+function _M.serve_preload()
+  local dict = ngx.shared.llhls_playlists
+  local path = ngx.var.request_filename
+  local playlist = dict:get(HINT_PREFIX .. path)
+  if not playlist then
+    return ngx.exit(ngx.HTTP_NOT_FOUND)
+  end
+
+  local root = ngx.var.document_root
+  local deadline = ngx.now() + config.preload_timeout
+  while true do
+    if file_exists(path) then
+      return ngx.exec(ngx.var.uri, ngx.var.args)
+    end
+    local remaining = deadline - ngx.now()
+    if remaining <= 0 then
+      return ngx.exit(ngx.HTTP_NOT_FOUND)
+    end
+    if wait_for_change(dict, playlist, root, remaining) == false then
+      return ngx.exit(ngx.HTTP_NOT_FOUND)
+    end
+  end
+end
+
+return _M
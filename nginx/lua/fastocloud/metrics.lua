@@ -0,0 +1,287 @@
+-- Per-stream request metrics in Prometheus text format.
+--
+-- fastocloud_metrics holds counters for every site, port and stream:
+--   <site>\t<port>\t<stream>\trequests\t<code class> -> requests
+--   <site>\t<port>\t<stream>\tbytes                 -> bytes sent
+--   <site>\t<port>\t<stream>\tsum                   -> total request time
+--   <site>\t<port>\t<stream>\tbucket\t<index>       -> requests in the histogram bucket
+--
+-- and an index of the streams of every site and port, so /metrics reads only
+-- the keys it exposes instead of listing the whole dict under its lock:
+--   streams\t<site>\t<port>\t                     -> number of streams
+--   index\t<site>\t<port>\t<n>                    -> name of the nth stream
+--
+-- and counters of the node written by other modules:
+--   node\ttouch_index_dropped                      -> touch records dropped (fastocloud.touched)
+--
+-- The log phase only updates plain Lua tables in the worker. Every worker adds
+-- its counts to the shared dict from a timer, so the per-request cost is a few
+-- table lookups and no shared memory locking.
+local _M = {}
+
+-- upper bounds of the request_time histogram in seconds; the last bucket is +Inf
+local BUCKETS = { 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 }
+local OTHER_STREAM = "_other"
+local STREAMS_PREFIX = "streams\t"
+local KNOWN_PREFIX = "known\t"
+local INDEX_PREFIX = "index\t"
+local CODE_CLASSES = { "1xx", "2xx", "3xx", "4xx", "5xx" }
+
+local config = {
+  -- worker counts are added to shared memory every flush_interval seconds
+  flush_interval = 1,
+  -- streams tracked per site and port, the rest are counted as _other
+  max_streams = 2000
+}
+
+-- site -> port -> stream -> counts
+local pending = {}
+
+function _M.configure(options)
+  for key, value in pairs(options) do
+    if config[key] == nil then
+      error("unknown metrics option: " .. key)
+    end
+    config[key] = value
+  end
+end
+
+local function new_counts()
+  local buckets = {}
+  for i = 1, #BUCKETS + 1 do
+    buckets[i] = 0
+  end
+  return { requests = {}, bytes = 0, sum = 0, buckets = buckets }
+end
+
+-- log_by_lua_block { require("fastocloud.metrics").log("hls") }
+function _M.log(site)
+  local var = ngx.var
+  local stream = var.fastocloud_stream_id
+  if not stream or stream == "" then
+    -- /status, /metrics and other requests outside of a stream
+    return
+  end
+
+  local ports = pending[site]
+  if not ports then
+    ports = {}
+    pending[site] = ports
+  end
+  local port = var.server_port
+  local streams = ports[port]
+  if not streams then
+    streams = {}
+    ports[port] = streams
+  end
+  local counts = streams[stream]
+  if not counts then
+    counts = new_counts()
+    streams[stream] = counts
+  end
+
+  local code = string.sub(var.status, 1, 1) .. "xx"
+  counts.requests[code] = (counts.requests[code] or 0) + 1
+  counts.bytes = counts.bytes + (tonumber(var.bytes_sent) or 0)
+
+  local elapsed = tonumber(var.request_time) or 0
+  counts.sum = counts.sum + elapsed
+  local index = #BUCKETS + 1
+  for i = 1, #BUCKETS do
+    if elapsed <= BUCKETS[i] then
+      index = i
+      break
+    end
+  end
+  counts.buckets[index] = counts.buckets[index] + 1
+end
+
+-- Stream label the counts are stored under, _other once the site has
+-- max_streams streams
+local function tracked_stream(dict, prefix, stream)
+  if dict:get(KNOWN_PREFIX .. prefix .. stream) then
+    return stream
+  end
+  local count = dict:get(STREAMS_PREFIX .. prefix) or 0
+  if count >= config.max_streams then
+    return OTHER_STREAM
+  end
+  if dict:add(KNOWN_PREFIX .. prefix .. stream, true) then
+    local n = dict:incr(STREAMS_PREFIX .. prefix, 1, 0)
+    if n then
+      dict:set(INDEX_PREFIX .. prefix .. n, stream)
+    end
+  end
+  return stream
+end
+
+local function add(dict, key, value)
+  if value == 0 then
+    return
+  end
+  local ok, err = dict:incr(key, value, 0)
+  if not ok then
+    ngx.log(ngx.WARN, "failed to update metric ", key, ": ", err)
+  end
+end
+
+function _M.flush()
+  if next(pending) == nil then
+    return
+  end
+
+  local batch = pending
+  pending = {}
+
+  local dict = ngx.shared.fastocloud_metrics
+  for site, ports in pairs(batch) do
+    for port, streams in pairs(ports) do
+      local prefix = site .. "\t" .. port .. "\t"
+      for stream, counts in pairs(streams) do
+        local key = prefix .. tracked_stream(dict, prefix, stream) .. "\t"
+        for code, requests in pairs(counts.requests) do
+          add(dict, key .. "requests\t" .. code, requests)
+        end
+        add(dict, key .. "bytes", counts.bytes)
+        add(dict, key .. "sum", counts.sum)
+        for i, requests in ipairs(counts.buckets) do
+          add(dict, key .. "bucket\t" .. i, requests)
+        end
+      end
+    end
+  end
+end
+
+local function flush_timer(premature)
+  -- also runs on worker shutdown (premature) so pending counts are not lost
+  _M.flush()
+end
+
+function _M.init_worker()
+  local ok, err = ngx.timer.every(config.flush_interval, flush_timer)
+  if not ok then
+    ngx.log(ngx.ERR, "failed to start metrics flush timer: ", err)
+  end
+end
+
+local function label(value)
+  value = string.gsub(value, "\\", "\\\\")
+  value = string.gsub(value, "\n", "\\n")
+  return (string.gsub(value, '"', '\\"'))
+end
+
+local function format_number(value)
+  if value == math.floor(value) and value < 1e15 then
+    return string.format("%d", value)
+  end
+  return string.format("%.6f", value)
+end
+
+-- location = /metrics { content_by_lua_block { require("fastocloud.metrics").serve("hls") } }
+--
+-- Only the counters of the serving site and port are exposed, so every site
+-- is scraped on its own port.
+function _M.serve(site)
+  local dict = ngx.shared.fastocloud_metrics
+  local port = ngx.var.server_port
+  local prefix = site .. "\t" .. port .. "\t"
+
+  -- the indexed streams and _other, each read with its fixed set of keys
+  local candidates = { OTHER_STREAM }
+  for n = 1, dict:get(STREAMS_PREFIX .. prefix) or 0 do
+    local stream = dict:get(INDEX_PREFIX .. prefix .. n)
+    -- nil while the stream is being added
+    if stream then
+      candidates[#candidates + 1] = stream
+    end
+  end
+
+  local streams = {}
+  local names = {}
+  for _, stream in ipairs(candidates) do
+    local key = prefix .. stream .. "\t"
+    local counts = new_counts()
+    local seen = false
+    for _, code in ipairs(CODE_CLASSES) do
+      local requests = dict:get(key .. "requests\t" .. code)
+      if requests then
+        counts.requests[code] = requests
+        seen = true
+      end
+    end
+    if seen and not streams[stream] then
+      counts.bytes = dict:get(key .. "bytes") or 0
+      counts.sum = dict:get(key .. "sum") or 0
+      for i = 1, #BUCKETS + 1 do
+        counts.buckets[i] = dict:get(key .. "bucket\t" .. i) or 0
+      end
+      streams[stream] = counts
+      names[#names + 1] = stream
+    end
+  end
+  table.sort(names)
+
+  local base = 'site="' .. label(site) .. '",port="' .. port .. '"'
+  local out = {}
+  local function emit(line)
+    out[#out + 1] = line
+  end
+
+  emit("# HELP fastocloud_requests_total Requests per stream and status class.")
+  emit("# TYPE fastocloud_requests_total counter")
+  for _, stream in ipairs(names) do
+    local labels = base .. ',stream="' .. label(stream) .. '"'
+    local codes = {}
+    for code in pairs(streams[stream].requests) do
+      codes[#codes + 1] = code
+    end
+    table.sort(codes)
+    for _, code in ipairs(codes) do
+      emit("fastocloud_requests_total{" .. labels .. ',code="' .. code .. '"} '
+        .. format_number(streams[stream].requests[code]))
+    end
+  end
+
+  emit("# HELP fastocloud_sent_bytes_total Bytes sent per stream, headers included.")
+  emit("# TYPE fastocloud_sent_bytes_total counter")
+  for _, stream in ipairs(names) do
+    emit("fastocloud_sent_bytes_total{" .. base .. ',stream="' .. label(stream) .. '"} '
+      .. format_number(streams[stream].bytes))
+  end
+
+  emit("# HELP fastocloud_request_duration_seconds Request time per stream.")
+  emit("# TYPE fastocloud_request_duration_seconds histogram")
+  for _, stream in ipairs(names) do
+    local labels = base .. ',stream="' .. label(stream) .. '"'
+    local counts = streams[stream]
+    local total = 0
+    for i = 1, #BUCKETS + 1 do
+      total = total + counts.buckets[i]
+      local le = BUCKETS[i] and tostring(BUCKETS[i]) or "+Inf"
+      emit("fastocloud_request_duration_seconds_bucket{" .. labels .. ',le="' .. le .. '"} ' .. format_number(total))
+    end
+    emit("fastocloud_request_duration_seconds_sum{" .. labels .. "} " .. format_number(counts.sum))
+    emit("fastocloud_request_duration_seconds_count{" .. labels .. "} " .. format_number(total))
+  end
+
+  emit("# HELP fastocloud_streams Streams with counters on this site.")
+  emit("# TYPE fastocloud_streams gauge")
+  emit("fastocloud_streams{" .. base .. "} " .. #names)
+
+  emit("# HELP fastocloud_touch_index_dropped_total CODS touch records the full touched_files_log zone dropped.")
+  emit("# TYPE fastocloud_touch_index_dropped_total counter")
+  emit("fastocloud_touch_index_dropped_total " .. format_number(dict:get("node\ttouch_index_dropped") or 0))
+
+  -- node totals, the same numbers as stub_status on /status
+  emit("# HELP fastocloud_nginx_connections Client connections of the node by state.")
+  emit("# TYPE fastocloud_nginx_connections gauge")
+  for _, state in ipairs({ "active", "reading", "writing", "waiting" }) do
+    emit('fastocloud_nginx_connections{state="' .. state .. '"} '
+      .. (ngx.var["connections_" .. state] or 0))
+  end
+
+  ngx.header.content_type = "text/plain; version=0.0.4"
+  ngx.print(table.concat(out, "\n"), "\n")
+end
+
+return _M
@@ -0,0 +1,280 @@
+-- Touch tracking for on-demand (CODS) streams.
+--
+-- touched_files holds the last touch time of every stream:
+--   stream:<id> -> unix time of the last request
+--
+-- touched_files_log is a time-ordered change index:
+--   seq         -> sequence number of the last recorded change
+--   log:<seq>   -> "<time>:<id>"
+--
+-- Requests never write shared memory directly. Every worker remembers when it
+-- last recorded a stream in a local LRU cache, records it again only after
+-- touch_interval seconds, and flushes the pending touches to the shared dicts
+-- in batches (from a timer, or early once batch_size streams are pending).
+-- The workers share the stream entry, so however many of them see a stream,
+-- it gets at most one index record per touch_interval.
+--
+-- Records the full index has no room for are counted in fastocloud_metrics
+-- (fastocloud_touch_index_dropped_total on /metrics): pollers get "reset"
+-- after such a gap, so the count should stay at 0 with a correctly sized zone.
+--
+-- Index records are keyed by a monotonically increasing sequence number.
+-- Pollers resume from a cursor (or locate a timestamp with a binary search),
+-- so the cost of a poll depends on the number of changes since the last one,
+-- not on the number of streams in the zone.
+local cjson = require "cjson.safe"
+local lrucache = require "resty.lrucache"
+
+local _M = {}
+
+local STREAM_PREFIX = "stream:"
+local LOG_PREFIX = "log:"
+local SEQ_KEY = "seq"
+-- in the fastocloud_metrics zone, exposed by fastocloud.metrics
+local DROPPED_KEY = "node\ttouch_index_dropped"
+
+local DEFAULT_LIMIT = 500
+local MAX_LIMIT = 5000
+
+local config = {
+  -- lifetime of a stream touch in touched_files
+  stream_ttl = 3600,
+  -- lifetime of a record in the touched_files_log index
+  log_ttl = 120,
+  -- a worker records the same stream at most once per touch_interval seconds
+  touch_interval = 5,
+  -- pending touches are written to shared memory every flush_interval seconds
+  flush_interval = 1,
+  -- ... or as soon as batch_size streams are pending
+  batch_size = 256,
+  -- streams remembered by the per-worker LRU cache
+  lru_size = 10000
+}
+
+local recent
+local pending = {}
+local pending_count = 0
+
+local function parse_record(record)
+  if not record then
+    return nil
+  end
+  local timestamp, stream_id = string.match(record, "^(%d+):(.*)$")
+  return tonumber(timestamp), stream_id
+end
+
+function _M.extract_stream_id(uri)
+  -- Match patterns like /stream123/segment001.ts
+  return string.match(uri, "^/([^/]+)/")
+end
+
+function _M.configure(options)
+  for key, value in pairs(options) do
+    if config[key] == nil then
+      error("unknown touch tracking option: " .. key)
+    end
+    config[key] = value
+  end
+end
+
+local function count_dropped()
+  local metrics = ngx.shared.fastocloud_metrics
+  if metrics then
+    metrics:incr(DROPPED_KEY, 1, 0)
+  end
+end
+
+local function write_touch(touched, log, stream_id, timestamp)
+  local key = STREAM_PREFIX .. stream_id
+  local current = touched:get(key)
+  if current and timestamp - current < config.touch_interval then
+    -- this or another worker recorded the stream less than touch_interval ago
+    return
+  end
+
+  touched:set(key, timestamp, config.stream_ttl)
+
+  local seq, err = log:incr(SEQ_KEY, 1, 0)
+  if not seq then
+    ngx.log(ngx.ERR, "failed to allocate touch sequence: ", err)
+    count_dropped()
+    return
+  end
+
+  -- safe_set never evicts live records to make room, which keeps the index
+  -- ordered: only the oldest records disappear (by expiry)
+  local ok, set_err = log:safe_set(LOG_PREFIX .. seq, timestamp .. ":" .. stream_id, config.log_ttl)
+  if not ok then
+    ngx.log(ngx.WARN, "touch index is full, dropping record: ", set_err)
+    count_dropped()
+  end
+end
+
+function _M.flush()
+  if pending_count == 0 then
+    return
+  end
+
+  local batch = pending
+  pending = {}
+  pending_count = 0
+
+  local touched = ngx.shared.touched_files
+  local log = ngx.shared.touched_files_log
+  for stream_id, timestamp in pairs(batch) do
+    write_touch(touched, log, stream_id, timestamp)
+  end
+end
+
+local function flush_timer(premature)
+  -- also runs on worker shutdown (premature) so pending touches are not lost
+  _M.flush()
+end
+
+function _M.init_worker()
+  local err
+  recent, err = lrucache.new(config.lru_size)
+  if not recent then
+    error("failed to create touch cache: " .. (err or "unknown"))
+  end
+
+  local ok, timer_err = ngx.timer.every(config.flush_interval, flush_timer)
+  if not ok then
+    ngx.log(ngx.ERR, "failed to start touch flush timer: ", timer_err)
+  end
+end
+
+function _M.touch(stream_id, now)
+  local last = recent:get(stream_id)
+  if last and now - last < config.touch_interval then
+    return
+  end
+  recent:set(stream_id, now)
+
+  if not pending[stream_id] then
+    pending_count = pending_count + 1
+  end
+  pending[stream_id] = now
+
+  if pending_count >= config.batch_size then
+    _M.flush()
+  end
+end
+
+function _M.record(uri)
+  local stream_id = _M.extract_stream_id(uri)
+  if stream_id then
+    _M.touch(stream_id, ngx.time())
+  end
+end
+
+-- Last sequence number in [lo, hi] before the first record that is still alive
+-- and not older than since. Records expire oldest first and are written in
+-- time order up to the flush batching, so the predicate is monotonic to within
+-- flush_interval seconds.
+local function find_since(log, lo, hi, since)
+  while lo < hi do
+    local mid = math.floor((lo + hi) / 2) + 1
+    local timestamp = parse_record(log:get(LOG_PREFIX .. mid))
+    if timestamp and timestamp >= since then
+      hi = mid - 1
+    else
+      lo = mid
+    end
+  end
+  return lo
+end
+
+local function serve_all()
+  local touched = ngx.shared.touched_files
+  local files = {}
+
+  -- Get all keys from shared memory
+  local keys = touched:get_keys(0)
+  for _, key in ipairs(keys) do
+    if string.sub(key, 1, 7) == STREAM_PREFIX then
+      local stream_id = string.sub(key, 8)  -- Remove "stream:" prefix
+      local timestamp = touched:get(key)
+      table.insert(files, {
+        stream_id = stream_id,
+        timestamp = timestamp
+      })
+    end
+  end
+
+  ngx.say(cjson.encode(files))
+end
+
+-- GET /touched-files?since=<unix time>&limit=<n>
+-- GET /touched-files?cursor=<cursor>&limit=<n>
+--
+-- Returns {"files": [...], "cursor": <cursor>, "more": <bool>, "reset": <bool>}.
+-- Pass the returned cursor to the next poll; "more" means another page is
+-- ready right away. "reset" is set when records after the cursor have already
+-- expired (or the node restarted) and the caller should resync with a full
+-- listing (no parameters).
+function _M.serve()
+  local args = ngx.req.get_uri_args()
+  local cursor = tonumber(args.cursor)
+  local since = tonumber(args.since)
+  if not cursor and not since then
+    return serve_all()
+  end
+
+  local limit = tonumber(args.limit) or DEFAULT_LIMIT
+  limit = math.max(1, math.min(math.floor(limit), MAX_LIMIT))
+
+  local log = ngx.shared.touched_files_log
+  local head = log:get(SEQ_KEY) or 0
+  local reset = false
+
+  local start
+  if cursor then
+    if cursor > head then
+      -- sequence restarted (reload with an empty zone or an evicted counter)
+      cursor = 0
+      reset = true
+    end
+    start = cursor
+    if start < head and not log:get(LOG_PREFIX .. (start + 1)) then
+      -- the records right after the cursor are gone, skip to the oldest alive
+      start = find_since(log, start, head, 0)
+      reset = reset or cursor > 0
+    end
+  else
+    start = find_since(log, 0, head, since)
+  end
+
+  local last = math.min(head, start + limit)
+  local latest = {}
+  local order = {}
+  for seq = start + 1, last do
+    local timestamp, stream_id = parse_record(log:get(LOG_PREFIX .. seq))
+    if timestamp then
+      local previous = latest[stream_id]
+      if not previous then
+        order[#order + 1] = stream_id
+      end
+      if not previous or timestamp > previous then
+        latest[stream_id] = timestamp
+      end
+    end
+  end
+
+  local files = {}
+  for i, stream_id in ipairs(order) do
+    files[i] = {
+      stream_id = stream_id,
+      timestamp = latest[stream_id]
+    }
+  end
+
+  ngx.say(cjson.encode({
+    files = setmetatable(files, cjson.empty_array_mt),
+    cursor = last,
+    more = last < head,
+    reset = reset
+  }))
+end
+
+return _M
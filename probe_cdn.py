@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 7):
+    print(
+        "Tried to start script with an unsupported version of Python. probe_cdn requires Python 3.7 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import re
+import time
+
+from typing import Dict, List, Optional
+
+from async_http import HttpClient, HttpError
+
+# Health and latency check of the CDN nodes written by setup_cdn.py.
+#
+# Nodes come from the fastocloud config (hls_nodes, vods_nodes, cods_nodes) and
+# from the listen directives of the FastoCloud nginx sites. Every node gets its
+# own connection and is checked concurrently: /status, /touched-files on the
+# CODS nodes (the only sites serving it) and optionally a sample file for
+# throughput.
+#
+# Nodes are probed through loopback; HTTPS nodes are asked for the alias of
+# the fastocloud config (the name their certificate is issued for) as SNI and
+# Host, or --server-name.
+
+FASTOCLOUD_CONFIGS = ("/etc/fastocloud_pro.conf", "/etc/fastocloud_pro_ml.conf")
+NGINX_SITES_GLOB = "/etc/nginx/sites-enabled/fastocloud_*"
+NODE_SECTIONS = ("hls_nodes", "vods_nodes", "cods_nodes")
+
+DEFAULT_TIMEOUT = 2
+DEFAULT_CONCURRENCY = 512
+DEFAULT_SLOW_MS = 200
+
+ALIAS_PATTERN = re.compile(r"^alias:\s*(\S+)", re.MULTILINE)
+LISTEN_PATTERN = re.compile(r"^\s*listen\s+(?:\S+:)?(\d+)([^;]*);", re.MULTILINE)
+ACTIVE_PATTERN = re.compile(rb"Active connections:\s*(\d+)")
+
+
+def config_nodes(path: str) -> List[Dict[str, str]]:
+    with open(path, "r") as f:
+        data = f.read()
+
+    nodes = []
+    try:
+        import yaml
+
+        config = yaml.safe_load(data) or {}
+        for section in NODE_SECTIONS:
+            for node in config.get(section) or []:
+                nodes.append({"url": str(node["host"]), "kind": section[:-6], "source": path})
+    except ImportError:
+        # yaml.dump writes one "- host: <url>" item per node under its section
+        section = None
+        for line in data.splitlines():
+            if re.match(r"^\w", line):
+                section = line.split(":", 1)[0]
+            match = re.match(r"^\s*-?\s*host:\s*(\S+)", line)
+            if match and section in NODE_SECTIONS:
+                nodes.append({"url": match.group(1), "kind": section[:-6], "source": path})
+    return nodes
+
+
+def config_alias(path: str) -> Optional[str]:
+    with open(path, "r") as f:
+        match = ALIAS_PATTERN.search(f.read())
+    return match.group(1) if match else None
+
+
+def site_nodes(pattern: str) -> List[Dict[str, str]]:
+    nodes = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r") as f:
+            data = f.read()
+        kind = os.path.basename(path).split("_")[1]
+        for port, params in LISTEN_PATTERN.findall(data):
+            scheme = "https" if "ssl" in params.split() else "http"
+            nodes.append({"url": f"{scheme}://127.0.0.1:{port}", "kind": kind, "source": path})
+    return nodes
+
+
+def local_url(url: str) -> str:
+    # nodes listen on all interfaces, probe them through loopback
+    return url.replace("://0.0.0.0", "://127.0.0.1").rstrip("/")
+
+
+async def probe(node: Dict[str, str], sample: Optional[str], timeout: float, slow_ms: float,
+                server_name: Optional[str], verify: bool, semaphore: asyncio.Semaphore) -> Dict:
+    result = dict(node, ok=False, slow=False, connect_ms=None, ttfb_ms=None, active=None, touched=None,
+                  mbps=None, error="")
+    async with semaphore:
+        http = HttpClient(node["url"], timeout, server_name, verify)
+        try:
+            status = await http.request("GET", "/status")
+            result["connect_ms"] = http.connect_time * 1000
+            result["ttfb_ms"] = status.ttfb * 1000
+            match = ACTIVE_PATTERN.search(status.body or b"")
+            if status.status != 200 or not match:
+                result["error"] = f"/status returned {status.status}"
+                return result
+            result["active"] = int(match.group(1))
+
+            if node["kind"] == "cods":
+                touched = await http.request("GET", "/touched-files")
+                try:
+                    json.loads(touched.body)
+                    result["touched"] = touched.status == 200
+                except ValueError:
+                    result["touched"] = False
+                if not result["touched"]:
+                    result["error"] = f"/touched-files returned {touched.status}"
+                    return result
+
+            if sample:
+                started = time.monotonic()
+                response = await http.request("GET", sample, keep_body=False)
+                if response.status == 200:
+                    result["mbps"] = response.size * 8 / max(1e-6, time.monotonic() - started) / 1000000
+                else:
+                    result["error"] = f"{sample} returned {response.status}"
+                    return result
+
+            result["ok"] = True
+            result["slow"] = result["connect_ms"] > slow_ms or result["ttfb_ms"] > slow_ms
+        except (HttpError, OSError, ValueError) as ex:
+            result["error"] = str(ex) or type(ex).__name__
+        finally:
+            await http.close()
+    return result
+
+
+async def probe_all(nodes: List[Dict[str, str]], sample: Optional[str], timeout: float, slow_ms: float,
+                    server_name: Optional[str], verify: bool, concurrency: int) -> List[Dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(probe(node, sample, timeout, slow_ms, server_name, verify, semaphore)
+                                  for node in nodes))
+
+
+def format_ms(value: Optional[float]) -> str:
+    return f"{value:.1f}" if value is not None else "-"
+
+
+def print_results(results: List[Dict], elapsed: float) -> None:
+    print("state  kind   url                              connect_ms  ttfb_ms  active  mbit/s  error")
+    for result in sorted(results, key=lambda r: (r["ok"], not r["slow"], r["url"])):
+        state = "DOWN" if not result["ok"] else "SLOW" if result["slow"] else "ok"
+        mbps = f"{result['mbps']:.1f}" if result["mbps"] is not None else "-"
+        active = str(result["active"]) if result["active"] is not None else "-"
+        print(f"{state:5s}  {result['kind']:5s}  {result['url']:32s} {format_ms(result['connect_ms']):>10s}  "
+              f"{format_ms(result['ttfb_ms']):>7s}  {active:>6s}  {mbps:>6s}  {result['error']}")
+
+    down = sum(not result["ok"] for result in results)
+    slow = sum(result["ok"] and result["slow"] for result in results)
+    print(f"{len(results)} nodes in {elapsed:.2f}s: {len(results) - down - slow} ok, {slow} slow, {down} down")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="probe_cdn", usage="%(prog)s [options] [url ...]")
+    parser.add_argument("urls", nargs="*", help="nodes to probe (default: the configured nodes)")
+    parser.add_argument("--config", help="fastocloud config (default: the installed one)", action="append")
+    parser.add_argument("--sites", help=f"nginx sites (default: {NGINX_SITES_GLOB})", default=NGINX_SITES_GLOB)
+    parser.add_argument("--sample", help="path fetched from every node to measure throughput")
+    parser.add_argument("--timeout", help=f"seconds per request (default: {DEFAULT_TIMEOUT})", type=float,
+                        default=DEFAULT_TIMEOUT)
+    parser.add_argument("--slow-ms", help=f"connect or ttfb considered slow (default: {DEFAULT_SLOW_MS})",
+                        type=float, default=DEFAULT_SLOW_MS)
+    parser.add_argument("--concurrency", help=f"nodes probed at once (default: {DEFAULT_CONCURRENCY})", type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--server-name", help="SNI and Host of HTTPS nodes (default: the alias of the config)")
+    parser.add_argument("--insecure", help="do not verify the certificates of HTTPS nodes", action="store_true")
+    parser.add_argument("--json", help="print the results as JSON", action="store_true")
+    argv = parser.parse_args()
+
+    server_name = argv.server_name
+    nodes = [{"url": url, "kind": "-", "source": "argv"} for url in argv.urls]
+    for path in argv.config or FASTOCLOUD_CONFIGS:
+        if os.path.exists(path):
+            server_name = server_name or config_alias(path)
+            if not argv.urls:
+                nodes += config_nodes(path)
+    if not argv.urls:
+        nodes += site_nodes(argv.sites)
+
+    unique = {}
+    for node in nodes:
+        node["url"] = local_url(node["url"])
+        unique.setdefault(node["url"], node)
+    if not unique:
+        print("No nodes found")
+        sys.exit(1)
+
+    started = time.monotonic()
+    results = asyncio.run(probe_all(list(unique.values()), argv.sample, argv.timeout, argv.slow_ms, server_name,
+                                    not argv.insecure, argv.concurrency))
+    elapsed = time.monotonic() - started
+
+    if argv.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, elapsed)
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
@@ -17,6 +17,8 @@ except ImportError:
 
 import yaml
 
+import re
+import math
 import socket
 import random
 
@@ -25,23 +27,55 @@ from urllib import parse
 from collections import defaultdict
 from contextlib import closing
 
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 
 
+# Zones are per node: their rates follow the bandwidth of the node
+NGINX_LIMIT_ZONES_TEMPLATE = """
+limit_req_zone $binary_remote_addr zone={zone}_client:{zone_size} rate={client_rate}r/s;
+limit_req_zone $fastocloud_stream_id zone={zone}_stream:{zone_size} rate={stream_rate}r/s;
+limit_conn_zone $binary_remote_addr zone={zone}_client_conn:{zone_size};
+limit_conn_zone $fastocloud_stream_id zone={zone}_stream_conn:{zone_size};
+"""
+
 NGINX_TEMPLATE = """
 server {{
-    access_log {access_log};
+    access_log {access_log} fastocloud_json buffer={log_buffer} flush={log_flush} if=$fastocloud_loggable;
     error_log {error_log};
 
     {listen_port} 
 
     server_name _;
 
+    # Per client and per stream limits, rejections are logged as warnings
+    # in the error log and with status 429 in the access log
+    limit_req zone={zone}_client burst={client_burst} nodelay;
+    limit_req zone={zone}_stream burst={stream_burst} nodelay;
+    limit_conn {zone}_client_conn {client_connections};
+    limit_conn {zone}_stream_conn {stream_connections};
+    limit_req_status 429;
+    limit_conn_status 429;
+    limit_req_log_level warn;
+    limit_conn_log_level warn;
+
+    # Per-stream counters exposed on /metrics
+    log_by_lua_block {{
+        require("fastocloud.metrics").log("{site}")
+    }}
+
     location = /status {{
         stub_status;
     }}
 
-    location / {{
+    # Prometheus metrics of this site: per-stream requests, bytes and request time
+    location = /metrics {{
+        access_log off;
+        content_by_lua_block {{
+            require("fastocloud.metrics").serve("{site}")
+        }}
+    }}
+
+    location / {{{location_limits}
         # Disable cache
         add_header Cache-Control no-cache;
 
@@ -92,14 +126,41 @@ report_node_stats: 10
 
 {nodes}
 
-#https:
+{https}"""
+
+FASTOCLOUD_HTTPS_TEMPLATE = """https:
+    key: {key}
+    cert: {cert}
+"""
+
+FASTOCLOUD_HTTPS_DISABLED = """#https:
 #    key: /etc/letsencrypt/live/fastocloud.com-0001/privkey.pem
 #    cert: /etc/letsencrypt/live/fastocloud.com-0001/fullchain.pem
 """
 
+# http-level settings of the HTTPS sites, the certificates are set per server
+NGINX_TLS_TEMPLATE = """# TLS settings shared by the HTTPS FastoCloud sites
+ssl_protocols TLSv1.2 TLSv1.3;
+ssl_prefer_server_ciphers off;
+
+# Players reconnecting for every playlist poll resume their session instead of
+# doing a full handshake: one cache for all sites and workers (~4000 sessions per MB)
+ssl_session_cache shared:fastocloud_tls:{session_cache};
+ssl_session_timeout {session_timeout};
+ssl_session_tickets on;
+
+# OCSP responses are fetched by nginx and stapled to the handshake
+ssl_stapling on;
+ssl_stapling_verify on;
+ssl_trusted_certificate {trusted_certificate};
+resolver {resolver} valid=300s;
+resolver_timeout 5s;
+"""
+
 HLS_TEMPLATE = {
     "name": "hls_nodes",
     "filename": "fastocloud_hls",
+    "site": "hls",
     "access_log": "/var/log/nginx/fastocloud_hls_{port}_access.log",
     "error_log": "/var/log/nginx/fastocloud_hls_{port}_error.log",
     "alias": "/home/fastocloud/streamer/hls/",
@@ -108,6 +169,7 @@ HLS_TEMPLATE = {
 VODS_TEMPLATE = {
     "name": "vods_nodes",
     "filename": "fastocloud_vods",
+    "site": "vods",
     "access_log": "/var/log/nginx/fastocloud_vods_{port}_access.log",
     "error_log": "/var/log/nginx/fastocloud_vods_{port}_error.log",
     "alias": "/home/fastocloud/streamer/vods/",
@@ -116,6 +178,7 @@ VODS_TEMPLATE = {
 CODS_TEMPLATE = {
     "name": "cods_nodes",
     "filename": "fastocloud_cods",
+    "site": "cods",
     "access_log": "/var/log/nginx/fastocloud_cods_{port}_access.log",
     "error_log": "/var/log/nginx/fastocloud_cods_{port}_error.log",
     "alias": "/home/fastocloud/streamer/cods/",
@@ -135,8 +198,48 @@ FASTOCLOUD_PRO_ML_TEMPLATE = {
 
 FASTOCLOUD_CONFIG_DIR = "/etc"
 
+# http-level log format and sampling maps shared with the shipped sites
+NGINX_COMMON_CONFIG = "fastocloud_common"
+NGINX_COMMON_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "nginx", NGINX_COMMON_CONFIG
+)
+
+NGINX_LOG_BUFFER = "64k"
+NGINX_LOG_FLUSH = "5s"
+
+# A player polls the playlist and fetches one segment per segment duration, so
+# a viewer makes about one request per second and a stream can have as many
+# viewers as the node bandwidth carries at the stream bitrate. An LL-HLS player
+# (HLS site) makes a blocking playlist reload and a part request per part
+# duration instead, and holds both open while it waits.
+DEFAULT_NODE_BANDWIDTH_MBPS = 1000
+DEFAULT_STREAM_BITRATE_KBPS = 5000
+DEFAULT_STREAM_SHARE = 50
+DEFAULT_PART_DURATION_MS = 0
+LLHLS_REQUESTS_PER_PART = 2
+NGINX_VIEWER_CONNECTIONS = 2
+NGINX_LIMIT_ZONE_SIZE = "10m"
+NGINX_LIMIT_MIN = 10
+# requests per second and concurrent requests of one client (players behind a NAT share an address)
+NGINX_CLIENT_RATE = 10
+NGINX_CLIENT_BURST = 40
+NGINX_CLIENT_CONNECTIONS = 16
+# VOD downloads: seconds of content sent at full speed, then the rate as a multiple of the bitrate
+NGINX_VOD_BURST_SECONDS = 30
+NGINX_VOD_RATE_FACTOR = 2
+
+NGINX_TLS_CONFIG = "fastocloud_tls"
+NGINX_TLS_SESSION_CACHE = "20m"
+NGINX_TLS_SESSION_TIMEOUT = "4h"
+# "http2 on;" replaced the http2 listen parameter in 1.25.1
+NGINX_HTTP2_DIRECTIVE_VERSION = (1, 25, 1)
+DEFAULT_RESOLVER = "1.1.1.1 8.8.8.8"
+RESOLV_CONF_PATH = "/etc/resolv.conf"
+
 NGINX_SITES_AVAILABLE_FOLDER = "/etc/nginx/sites-available"
 NGINX_SITES_ENABLED_FOLDER = "/etc/nginx/sites-enabled"
+# included before sites-enabled, the common config has to be parsed before the first site
+NGINX_CONF_FOLDER = "/etc/nginx/conf.d"
 
 
 def is_open_socket(host, port) -> bool:
@@ -147,6 +250,33 @@ def is_open_socket(host, port) -> bool:
             return True
 
 
+def nginx_version() -> Optional[Tuple[int, ...]]:
+    try:
+        output = subprocess.run(
+            ["nginx", "-v"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ).stdout.decode()
+    except OSError:
+        return None
+
+    match = re.search(r"nginx/(\d+)\.(\d+)\.(\d+)", output)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def system_resolver() -> str:
+    nameservers = []
+    try:
+        with open(RESOLV_CONF_PATH, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == "nameserver":
+                    address = fields[1]
+                    nameservers.append(f"[{address}]" if ":" in address else address)
+    except OSError:
+        pass
+
+    return " ".join(nameservers) or DEFAULT_RESOLVER
+
+
 class CdnConfigBuilder:
     def __init__(self) -> None:
         self.__already_used_ports: List[int] = []
@@ -158,6 +288,31 @@ class CdnConfigBuilder:
         silence = True if input("Silence [Y/n]") != "n" else False
         ml_version = True if input("ML version [Y/n]: ") != "n" else False
 
+        while True:
+            try:
+                segment_log_sample = float(
+                    input("Percent of segment requests to log [100]: ") or 100
+                )
+            except ValueError:
+                print("Percent should be a number")
+                continue
+
+            if segment_log_sample <= 0 or segment_log_sample > 100:
+                print("Percent should be in (0, 100]")
+                continue
+
+            break
+
+        stream_bitrate = self.__get_int_input(
+            "Max stream bitrate kbit/s", DEFAULT_STREAM_BITRATE_KBPS
+        )
+        stream_share = self.__get_int_input(
+            "Max share of a node one stream can use, %", DEFAULT_STREAM_SHARE
+        )
+        part_duration = self.__get_int_input(
+            "LL-HLS part duration ms, 0 without LL-HLS", DEFAULT_PART_DURATION_MS
+        )
+
         print()
 
         self._is_open_port = partial(is_open_socket, "0.0.0.0")
@@ -213,9 +368,15 @@ class CdnConfigBuilder:
 
                     break
 
+                bandwidth = self.__get_int_input(
+                    "Bandwidth Mbit/s", DEFAULT_NODE_BANDWIDTH_MBPS
+                )
+
                 print()
 
-                acc[template["name"]].append({"url": url, "type": type})
+                acc[template["name"]].append(
+                    {"url": url, "type": type, "bandwidth": bandwidth}
+                )
 
             return acc
 
@@ -225,12 +386,22 @@ class CdnConfigBuilder:
             defaultdict(list),
         )
 
+        tls = None
+        if any(
+            node["url"].scheme == "https" for nodes in data.values() for node in nodes
+        ):
+            tls = self.__get_tls_input(alias)
+
         print("Start building Fastocloud config...")
-        self._build_fastocloud_config(host, alias, data, ml_version)
+        self._build_fastocloud_config(host, alias, data, ml_version, tls)
         print("Successfully build Fastocloud config")
 
         print("Start building NGINX configs for HLS, VODS, CODS...")
-        self._build_nginx_config(data)
+        self._build_nginx_common_config(segment_log_sample)
+        self._build_nginx_tls_config(tls)
+        self._build_nginx_config(
+            data, tls, stream_bitrate, stream_share, part_duration
+        )
         print("Successfully build NGINX configs")
 
     def _build_fastocloud_config(
@@ -239,6 +410,7 @@ class CdnConfigBuilder:
         alias: str,
         data: Dict[str, List[Dict[str, Any]]],
         ml_version: bool,
+        tls: Optional[Dict[str, str]] = None,
     ) -> None:
         template = FASTOCLOUD_PRO_ML_TEMPLATE if ml_version else FASTOCLOUD_PRO_TEMPLATE
 
@@ -254,8 +426,14 @@ class CdnConfigBuilder:
 
         nodes = str(yaml.dump(ports))
 
+        https = (
+            FASTOCLOUD_HTTPS_TEMPLATE.format(key=tls["key"], cert=tls["cert"])
+            if tls
+            else FASTOCLOUD_HTTPS_DISABLED
+        )
+
         new_config = FASTOCLOUD_CONFIG_TEMPLATE.format(
-            host=host, alias=alias, nodes=nodes
+            host=host, alias=alias, nodes=nodes, https=https
         )
 
         return self._write_fastocloud_config(template["filename"], new_config)
@@ -266,7 +444,61 @@ class CdnConfigBuilder:
         with open(config_path, "w+") as f:
             f.write(config)
 
-    def _build_nginx_config(self, data: Dict[str, List[Dict[str, Any]]]) -> None:
+    def _build_nginx_common_config(self, segment_log_sample: float) -> None:
+        with open(NGINX_COMMON_CONFIG_PATH, "r") as f:
+            config = f.read()
+
+        config = re.sub(
+            r"\d+(\.\d+)?% 1;", f"{segment_log_sample:g}% 1;", config, count=1
+        )
+        # logged segment hits stand for 100 / percent requests
+        config = re.sub(
+            r"(map \$uri \$fastocloud_segment_weight \{\n\s+\S+ )[\d.]+;",
+            rf"\g<1>{100 / segment_log_sample:.6g};",
+            config,
+        )
+
+        # drop the sites-enabled copies of previous runs, they would define everything twice
+        for folder in (NGINX_SITES_AVAILABLE_FOLDER, NGINX_SITES_ENABLED_FOLDER):
+            path = os.path.join(folder, NGINX_COMMON_CONFIG)
+            if os.path.exists(path):
+                os.remove(path)
+
+        os.makedirs(NGINX_CONF_FOLDER, exist_ok=True)
+        with open(
+            os.path.join(NGINX_CONF_FOLDER, NGINX_COMMON_CONFIG + ".conf"), "w"
+        ) as f:
+            f.write(config)
+
+    def _build_nginx_tls_config(self, tls: Optional[Dict[str, str]]) -> None:
+        if not tls:
+            # no HTTPS nodes: drop the settings of a previous run
+            for folder in (NGINX_SITES_AVAILABLE_FOLDER, NGINX_SITES_ENABLED_FOLDER):
+                path = os.path.join(folder, NGINX_TLS_CONFIG)
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        config = NGINX_TLS_TEMPLATE.format(
+            session_cache=NGINX_TLS_SESSION_CACHE,
+            session_timeout=NGINX_TLS_SESSION_TIMEOUT,
+            trusted_certificate=tls["chain"],
+            resolver=system_resolver(),
+        )
+
+        self._write_nginx_config(NGINX_TLS_CONFIG, config)
+
+    def _build_nginx_config(
+        self,
+        data: Dict[str, List[Dict[str, Any]]],
+        tls: Optional[Dict[str, str]] = None,
+        stream_bitrate: int = DEFAULT_STREAM_BITRATE_KBPS,
+        stream_share: int = DEFAULT_STREAM_SHARE,
+        part_duration_ms: int = DEFAULT_PART_DURATION_MS,
+    ) -> None:
+        version = nginx_version()
+        http2_directive = bool(version and version >= NGINX_HTTP2_DIRECTIVE_VERSION)
+
         for template in (HLS_TEMPLATE, VODS_TEMPLATE, CODS_TEMPLATE):
             nodes = data[template["name"]]
 
@@ -274,12 +506,54 @@ class CdnConfigBuilder:
 
             for node in nodes:
                 port = node["url"].port
-                port_string = self.__get_listen_port_string(port)
+                if node["url"].scheme == "https":
+                    port_string = self.__get_listen_tls_port_string(
+                        port, tls, http2_directive
+                    )
+                else:
+                    port_string = self.__get_listen_port_string(port)
+
+                zone = f"{template['filename']}_{port}"
+                # requests per second of one viewer
+                viewer_rate = 1.0
+                if template is HLS_TEMPLATE and part_duration_ms > 0:
+                    viewer_rate = max(
+                        viewer_rate, LLHLS_REQUESTS_PER_PART * 1000 / part_duration_ms
+                    )
+                limits = self.__get_limits(
+                    node.get("bandwidth", DEFAULT_NODE_BANDWIDTH_MBPS),
+                    stream_bitrate,
+                    stream_share,
+                    viewer_rate,
+                )
+                location_limits = ""
+                if template is VODS_TEMPLATE:
+                    # players prebuffer at full speed, downloaders are throttled after that
+                    location_limits = (
+                        f"\n        limit_rate_after {limits['vod_rate_after']};"
+                        f"\n        limit_rate {limits['vod_rate']};\n"
+                    )
+
+                new_config += NGINX_LIMIT_ZONES_TEMPLATE.format(
+                    zone=zone,
+                    zone_size=NGINX_LIMIT_ZONE_SIZE,
+                    client_rate=limits["client_rate"],
+                    stream_rate=limits["stream_rate"],
+                )
 
                 server = NGINX_TEMPLATE.format(
+                    zone=zone,
+                    client_burst=limits["client_burst"],
+                    stream_burst=limits["stream_burst"],
+                    client_connections=NGINX_CLIENT_CONNECTIONS,
+                    stream_connections=limits["stream_connections"],
+                    location_limits=location_limits,
                     access_log=template["access_log"].format(port=port),
+                    log_buffer=NGINX_LOG_BUFFER,
+                    log_flush=NGINX_LOG_FLUSH,
                     error_log=template["error_log"].format(port=port),
                     listen_port=port_string,
+                    site=template["site"],
                     alias=template["alias"],
                 ).expandtabs(4)
 
@@ -303,9 +577,83 @@ class CdnConfigBuilder:
             if self._is_open_port(port) and port not in self.__already_used_ports:
                 return port
 
+    def __get_limits(
+        self,
+        bandwidth_mbps: int,
+        stream_bitrate_kbps: int,
+        stream_share: int,
+        viewer_rate: float,
+    ) -> Dict[str, Any]:
+        viewers = bandwidth_mbps * 1000 // max(1, stream_bitrate_kbps)
+        stream_viewers = max(NGINX_LIMIT_MIN, viewers * stream_share // 100)
+        stream_bytes = stream_bitrate_kbps * 1000 // 8
+        stream_rate = math.ceil(stream_viewers * viewer_rate)
+
+        return {
+            "client_rate": math.ceil(NGINX_CLIENT_RATE * viewer_rate),
+            "client_burst": math.ceil(NGINX_CLIENT_BURST * viewer_rate),
+            "stream_rate": stream_rate,
+            "stream_burst": stream_rate * 2,
+            "stream_connections": stream_viewers * NGINX_VIEWER_CONNECTIONS,
+            "vod_rate_after": f"{stream_bytes * NGINX_VOD_BURST_SECONDS // 1024}k",
+            "vod_rate": f"{stream_bytes * NGINX_VOD_RATE_FACTOR // 1024}k",
+        }
+
+    def __get_int_input(self, prompt: str, default: int) -> int:
+        while True:
+            try:
+                value = int(input(f"{prompt} [{default}]: ") or default)
+            except ValueError:
+                print("Value should be an int value")
+                continue
+
+            if value <= 0:
+                print("Value should be positive")
+                continue
+
+            return value
+
     def __get_listen_port_string(self, port: int) -> str:
         return f"listen {port};\n\tlisten [::]:{port};\n"
 
+    def __get_listen_tls_port_string(
+        self, port: int, tls: Dict[str, str], http2_directive: bool
+    ) -> str:
+        if http2_directive:
+            listen = f"listen {port} ssl;\n\tlisten [::]:{port} ssl;\n\thttp2 on;\n"
+        else:
+            listen = f"listen {port} ssl http2;\n\tlisten [::]:{port} ssl http2;\n"
+
+        return (
+            listen
+            + f"\tssl_certificate {tls['cert']};\n"
+            + f"\tssl_certificate_key {tls['key']};\n"
+        )
+
+    def __get_tls_input(self, alias: str) -> Dict[str, str]:
+        live_dir = os.path.join("/etc/letsencrypt/live", alias)
+        defaults = {
+            "cert": os.path.join(live_dir, "fullchain.pem"),
+            "key": os.path.join(live_dir, "privkey.pem"),
+            # issuer chain, used to verify stapled OCSP responses
+            "chain": os.path.join(live_dir, "chain.pem"),
+        }
+        prompts = {
+            "cert": "TLS certificate",
+            "key": "TLS certificate key",
+            "chain": "TLS issuer chain",
+        }
+
+        tls = {}
+        for name, default in defaults.items():
+            path = input(f"{prompts[name]} [{default}]: ") or default
+            if not os.path.exists(path):
+                print(f"Warning: {path} does not exist, nginx will not start without it")
+            tls[name] = path
+
+        print()
+        return tls
+
 
 if __name__ == "__main__":
     app = CdnConfigBuilder()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. system_tuning requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import json
+import os
+import subprocess
+import time
+
+from typing import Dict, Optional
+
+# Kernel and limits profile for streaming nodes.
+#
+# The profile is written as files owned by this tool (sysctl.d, modules-load.d,
+# limits.d and an nginx systemd drop-in) and carries a version, so applying a
+# newer profile replaces the old one. The values before the first apply are
+# kept in a snapshot that "revert" restores.
+
+PROFILE_VERSION = 2
+
+FASTOCLOUD_USER = "fastocloud"
+STATE_DIR = "/var/lib/fastocloud/tuning"
+SNAPSHOT_PATH = os.path.join(STATE_DIR, "before.json")
+
+SYSCTL_PATH = "/etc/sysctl.d/90-fastocloud.conf"
+MODULES_PATH = "/etc/modules-load.d/fastocloud.conf"
+LIMITS_PATH = "/etc/security/limits.d/90-fastocloud.conf"
+NGINX_DROPIN_PATH = "/etc/systemd/system/nginx.service.d/fastocloud-limits.conf"
+
+NOFILE = 1048576
+
+SYSCTL_PROFILE = {
+    # accept queues of the nginx listeners
+    "net.core.somaxconn": "65535",
+    "net.ipv4.tcp_max_syn_backlog": "65535",
+    "net.core.netdev_max_backlog": "65536",
+    # UDP/SRT ingest: the receive buffer gstreamer and SRT ask for is capped by rmem_max
+    "net.core.rmem_max": "67108864",
+    "net.core.wmem_max": "67108864",
+    "net.core.rmem_default": "1048576",
+    "net.core.wmem_default": "1048576",
+    "net.ipv4.udp_rmem_min": "16384",
+    "net.ipv4.udp_wmem_min": "16384",
+    "net.ipv4.tcp_rmem": "4096 87380 67108864",
+    "net.ipv4.tcp_wmem": "4096 65536 67108864",
+    # BBR paced by fq for segment delivery over lossy links
+    "net.core.default_qdisc": "fq",
+    "net.ipv4.tcp_congestion_control": "bbr",
+    # players fetch a segment every few seconds, keep the window between them
+    "net.ipv4.tcp_slow_start_after_idle": "0",
+    # outgoing connections (proxy pulls, CODS origins) take ports above the ones services listen on:
+    # nginx sites, the fastocloud API on 6317, hls on 8000 and the stream outputs stay below 10240
+    "net.ipv4.ip_local_port_range": "10240 65535",
+    "net.ipv4.tcp_fin_timeout": "15",
+    "net.ipv4.tcp_tw_reuse": "1",
+    "fs.file-max": "4194304",
+    # ttl_janitor.py watches every stream directory
+    "fs.inotify.max_user_watches": "1048576",
+    # write segments back early and in small batches instead of stalling on a large flush
+    "vm.dirty_background_ratio": "5",
+    "vm.dirty_ratio": "10",
+    "vm.dirty_expire_centisecs": "1000",
+    "vm.swappiness": "10",
+}
+
+HEADER = "# FastoCloud streaming tuning profile v{version}, written by system_tuning.py\n"
+
+LIMITS_TEMPLATE = HEADER + """{user} soft nofile {nofile}
+{user} hard nofile {nofile}
+root soft nofile {nofile}
+root hard nofile {nofile}
+"""
+
+NGINX_DROPIN_TEMPLATE = HEADER + """[Service]
+LimitNOFILE={nofile}
+"""
+
+
+def sysctl_path(key: str) -> str:
+    return os.path.join("/proc/sys", key.replace(".", "/"))
+
+
+def read_sysctl(key: str) -> Optional[str]:
+    try:
+        with open(sysctl_path(key), "r") as f:
+            return " ".join(f.read().split())
+    except OSError:
+        return None
+
+
+def read_file(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def snapshot() -> Dict:
+    return {
+        "time": int(time.time()),
+        "profile": installed_version(),
+        "sysctl": {key: read_sysctl(key) for key in SYSCTL_PROFILE},
+        "files": {path: read_file(path) for path in (SYSCTL_PATH, MODULES_PATH, LIMITS_PATH, NGINX_DROPIN_PATH)},
+    }
+
+
+def installed_version() -> Optional[int]:
+    data = read_file(SYSCTL_PATH)
+    if data and data.startswith("# FastoCloud streaming tuning profile v"):
+        return int(data.split()[5][1:].rstrip(","))
+    return None
+
+
+def bbr_available() -> bool:
+    subprocess.call(["modprobe", "tcp_bbr"], stderr=subprocess.DEVNULL)
+    available = read_sysctl("net.ipv4.tcp_available_congestion_control") or ""
+    return "bbr" in available.split()
+
+
+def write(path: str, data: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def print_diff(before: Dict[str, Optional[str]], after: Dict[str, Optional[str]]) -> None:
+    width = max(len(key) for key in before)
+    for key in before:
+        marker = " " if before[key] == after[key] else "*"
+        print(f"{marker} {key:{width}s}  {before[key] or '-':>24s}  ->  {after[key] or '-'}")
+
+
+def apply() -> None:
+    before = snapshot()
+    os.makedirs(STATE_DIR, exist_ok=True)
+    if not os.path.exists(SNAPSHOT_PATH):
+        # only the first apply records the distro values, re-applying must not overwrite them
+        with open(SNAPSHOT_PATH, "w") as f:
+            json.dump(before, f, indent=2)
+    with open(os.path.join(STATE_DIR, f"snapshot-{before['time']}.json"), "w") as f:
+        json.dump(before, f, indent=2)
+
+    profile = dict(SYSCTL_PROFILE)
+    if bbr_available():
+        write(MODULES_PATH, HEADER.format(version=PROFILE_VERSION) + "tcp_bbr\n")
+    else:
+        print("Warning: tcp_bbr is not available, keeping the congestion control")
+        del profile["net.ipv4.tcp_congestion_control"]
+
+    lines = [HEADER.format(version=PROFILE_VERSION)]
+    lines += [f"{key} = {value}\n" for key, value in profile.items()]
+    write(SYSCTL_PATH, "".join(lines))
+    subprocess.check_call(["sysctl", "-q", "-p", SYSCTL_PATH])
+
+    write(LIMITS_PATH, LIMITS_TEMPLATE.format(version=PROFILE_VERSION, user=FASTOCLOUD_USER, nofile=NOFILE))
+    write(NGINX_DROPIN_PATH, NGINX_DROPIN_TEMPLATE.format(version=PROFILE_VERSION, nofile=NOFILE))
+    subprocess.call(["systemctl", "daemon-reload"])
+
+    print(f"Applied tuning profile v{PROFILE_VERSION}:")
+    print_diff(before["sysctl"], snapshot()["sysctl"])
+    print("Restart nginx and log in again as fastocloud for the file descriptor limits to apply")
+
+
+def revert() -> None:
+    if not os.path.exists(SNAPSHOT_PATH):
+        print("Nothing to revert: the tuning profile was never applied")
+        return
+    with open(SNAPSHOT_PATH, "r") as f:
+        before = json.load(f)
+
+    current = snapshot()["sysctl"]
+    for path, data in before["files"].items():
+        if data is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            write(path, data)
+
+    for key, value in before["sysctl"].items():
+        if value is not None and value != current.get(key):
+            subprocess.call(["sysctl", "-q", "-w", f"{key}={value}"])
+    subprocess.call(["systemctl", "daemon-reload"])
+    os.remove(SNAPSHOT_PATH)
+
+    print("Reverted the tuning profile:")
+    print_diff(current, snapshot()["sysctl"])
+    print("Restart nginx for the previous file descriptor limit to apply")
+
+
+def status() -> None:
+    version = installed_version()
+    print(f"Installed profile: {'v' + str(version) if version else 'none'} (current v{PROFILE_VERSION})")
+    print("  profile value -> running value")
+    print_diff(SYSCTL_PROFILE, snapshot()["sysctl"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="system_tuning", usage="%(prog)s {apply,revert,status,snapshot}")
+    parser.add_argument("command", choices=["apply", "revert", "status", "snapshot"])
+    argv = parser.parse_args()
+
+    if argv.command == "apply":
+        apply()
+    elif argv.command == "revert":
+        revert()
+    elif argv.command == "status":
+        status()
+    else:
+        print(json.dumps(snapshot(), indent=2))
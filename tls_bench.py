@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. tls_bench requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib import parse
+
+# Handshake benchmark for the HTTPS sites generated by setup_cdn.py.
+#
+# Every connection sends one HEAD request, the way a player polls a playlist.
+# "full" opens every connection without a session, "resumed" offers the session
+# of a previous connection (session cache or ticket). Rates and the CPU time
+# nginx spent per connection are reported for both; --save and --compare put
+# a run before and after a config change side by side.
+
+DEFAULT_CONNECTIONS = 500
+DEFAULT_CONCURRENCY = 8
+TIMEOUT = 10
+# client connection preface and an empty SETTINGS frame, answered with the server SETTINGS
+H2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n" + bytes([0, 0, 0, 4, 0, 0, 0, 0, 0])
+
+
+def nginx_cpu_seconds() -> float:
+    # utime + stime of all local nginx processes
+    ticks = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        name = stat[stat.index("(") + 1:stat.rindex(")")]
+        if name == "nginx":
+            fields = stat[stat.rindex(")") + 2:].split()
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+class Target:
+    def __init__(self, url: str, server_name: Optional[str], insecure: bool):
+        parsed = parse.urlsplit(url)
+        if parsed.scheme != "https":
+            raise ValueError(f"not an https url: {url}")
+        self.host = parsed.hostname
+        self.port = parsed.port or 443
+        self.path = parsed.path or "/"
+        self.server_name = server_name or self.host
+        self.context = ssl.create_default_context()
+        self.context.set_alpn_protocols(["h2", "http/1.1"])
+        if insecure:
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+    def connect(self, session: Optional[ssl.SSLSession] = None) -> Dict:
+        started = time.monotonic()
+        with socket.create_connection((self.host, self.port), TIMEOUT) as sock:
+            with self.context.wrap_socket(sock, server_hostname=self.server_name, session=session) as tls:
+                handshake = time.monotonic() - started
+                protocol = tls.selected_alpn_protocol() or "http/1.1"
+                version = tls.version()
+                reused = tls.session_reused
+                # TLS 1.3 tickets arrive after the handshake, read a response to receive them
+                if protocol == "h2":
+                    tls.sendall(H2_PREFACE)
+                    tls.recv(4096)
+                else:
+                    tls.sendall(f"HEAD {self.path} HTTP/1.1\r\nHost: {self.server_name}\r\n"
+                                f"Connection: close\r\n\r\n".encode())
+                    while tls.recv(4096):
+                        pass
+                return {"handshake": handshake, "reused": reused, "session": tls.session,
+                        "protocol": protocol, "version": version}
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run_mode(target: Target, mode: str, connections: int, concurrency: int) -> Dict:
+    # every thread resumes the session of its previous connection, the first
+    # one that of a priming connection
+    primed = target.connect()["session"] if mode == "resumed" else None
+    sessions = {}
+
+    def one(_) -> Dict:
+        worker = threading.get_ident()
+        result = target.connect(sessions.get(worker, primed) if mode == "resumed" else None)
+        if result["session"] is not None:
+            sessions[worker] = result["session"]
+        return result
+
+    cpu = nginx_cpu_seconds()
+    started = time.monotonic()
+    errors = 0
+    results = []
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(one, number) for number in range(connections)]:
+            try:
+                results.append(future.result())
+            except (OSError, ssl.SSLError):
+                errors += 1
+    elapsed = time.monotonic() - started
+    cpu = nginx_cpu_seconds() - cpu
+
+    handshakes = [result["handshake"] for result in results]
+    return {
+        "mode": mode,
+        "connections": len(results),
+        "errors": errors,
+        "rate": len(results) / elapsed,
+        "handshake_p50_ms": percentile(handshakes, 50) * 1000,
+        "handshake_p99_ms": percentile(handshakes, 99) * 1000,
+        "reused_percent": 100.0 * sum(result["reused"] for result in results) / max(1, len(results)),
+        "nginx_cpu_ms_per_connection": cpu * 1000 / max(1, len(results)),
+        "protocol": results[0]["protocol"] if results else "",
+        "version": results[0]["version"] if results else "",
+    }
+
+
+def ocsp_stapled(target: Target) -> Optional[bool]:
+    if not shutil.which("openssl"):
+        return None
+    try:
+        result = subprocess.run(
+            ["openssl", "s_client", "-connect", f"{target.host}:{target.port}", "-servername", target.server_name,
+             "-status"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        return False
+    return b"OCSP Response Status: successful" in result.stdout
+
+
+def print_results(results: List[Dict], previous: Optional[List[Dict]]) -> None:
+    before = {result["mode"]: result for result in previous or []}
+    print("mode      conn/s  p50_ms  p99_ms  reused%  nginx_cpu_ms/conn  protocol  version")
+    for result in results:
+        print(f"{result['mode']:8s}  {result['rate']:6.0f}  {result['handshake_p50_ms']:6.2f}  "
+              f"{result['handshake_p99_ms']:6.2f}  {result['reused_percent']:7.1f}  "
+              f"{result['nginx_cpu_ms_per_connection']:17.3f}  {result['protocol']:8s}  {result['version']}")
+        old = before.get(result["mode"])
+        if old:
+            print(f"  before  {old['rate']:6.0f}  {old['handshake_p50_ms']:6.2f}  {old['handshake_p99_ms']:6.2f}  "
+                  f"{old['reused_percent']:7.1f}  {old['nginx_cpu_ms_per_connection']:17.3f}  "
+                  f"{old['protocol']:8s}  {old['version']}")
+        if result["errors"]:
+            print(f"  {result['errors']} connections failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="tls_bench", usage="%(prog)s [options] https://host:port/path")
+    parser.add_argument("url")
+    parser.add_argument("--connections", help=f"connections per mode (default: {DEFAULT_CONNECTIONS})", type=int,
+                        default=DEFAULT_CONNECTIONS)
+    parser.add_argument("--concurrency", help=f"parallel connections (default: {DEFAULT_CONCURRENCY})", type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--server-name", help="SNI and Host header (default: host of the url)")
+    parser.add_argument("--insecure", help="do not verify the certificate", action="store_true")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run (--save) to compare with")
+    argv = parser.parse_args()
+
+    target = Target(argv.url, argv.server_name, argv.insecure)
+    results = [run_mode(target, mode, argv.connections, argv.concurrency) for mode in ("full", "resumed")]
+
+    previous = None
+    if argv.compare:
+        with open(argv.compare, "r") as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    stapled = ocsp_stapled(target)
+    if stapled is not None:
+        print(f"OCSP stapling: {'yes' if stapled else 'not stapled or unreachable'}")
+
+    if argv.save:
+        with open(argv.save, "w") as f:
+            json.dump(results, f, indent=2)
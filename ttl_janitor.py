@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 6):
+    print(
+        "Tried to start script with an unsupported version of Python. ttl_janitor requires Python 3.6 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import json
+import os
+import re
+import select
+import shutil
+import struct
+import time
+import urllib.request
+
+from typing import Dict, List, Optional, Tuple
+
+import fastocloud_service
+
+# Expiry of stream directories in the generated trees without rescanning them.
+#
+# Stream directories are the first level of cods/, hls/ and proxy/. The janitor
+# lists them once at start, then keeps their last activity up to date from
+# inotify (segments created, written or moved into a stream directory) and from
+# the /touched-files feed of the CODS site (viewer requests). Streams are kept
+# in a heap ordered by expiry, last activity + the TTL of their tree. Heap
+# entries are refreshed lazily: an entry whose stream was active since it was
+# pushed is pushed again with the new expiry instead of being deleted.
+#
+# When a filesystem goes over the high watermark, the least recently active
+# streams are evicted before their TTL until it is back under the low one.
+#
+# The trees belong to the fastocloud user and are created by the streamer, the
+# janitor never creates them: a tree that does not exist yet is picked up from
+# the inotify watch on the streamer directory once it appears.
+
+STREAMER_DIR = "/home/fastocloud/streamer"
+TREES = ("cods", "hls", "proxy")
+FASTOCLOUD_CONFIGS = ("/etc/fastocloud_pro.conf", "/etc/fastocloud_pro_ml.conf")
+TOUCHED_FILES_URL = "http://127.0.0.1:84/touched-files"
+
+SERVICE_UNIT = "fastocloud-ttl-janitor"
+
+# same as FASTOCLOUD_CONFIG_TEMPLATE in setup_cdn.py
+DEFAULT_CODS_TTL = 60
+DEFAULT_FILES_TTL = 8640000
+DEFAULT_BATCH = 100
+DEFAULT_TOUCH_INTERVAL = 5
+DEFAULT_HIGH_WATERMARK = 90
+DEFAULT_LOW_WATERMARK = 80
+# streams active this recently are never evicted for disk pressure
+DEFAULT_MIN_IDLE = 30
+TICK = 1.0
+TOUCH_LIMIT = 5000
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR
+STREAM_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+class Inotify:
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str, mask: int) -> Optional[int]:
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                print(f"Warning: out of inotify watches, raise fs.inotify.max_user_watches ({path})")
+            return None
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> List[Tuple[int, int, str]]:
+        # (wd, mask, name) of the pending events
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+
+class Stream:
+    __slots__ = ("path", "tree", "activity", "watches")
+
+    def __init__(self, path: str, tree: str, activity: float):
+        self.path = path
+        self.tree = tree
+        self.activity = activity
+        self.watches = []  # type: List[int]
+
+
+class Janitor:
+    def __init__(self, root: str, ttls: Dict[str, int], batch: int, high_watermark: float, low_watermark: float,
+                 min_idle: float, dry_run: bool):
+        self.root = root
+        self.ttls = ttls
+        self.batch = batch
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.min_idle = min_idle
+        self.dry_run = dry_run
+        self.inotify = Inotify()
+        self.streams = {}  # type: Dict[str, Stream]
+        # (expiry, path)
+        self.heap = []  # type: List[Tuple[float, str]]
+        # wd -> (tree, stream path or None for a tree root, watched directory)
+        self.watches = {}  # type: Dict[int, Tuple[str, Optional[str], str]]
+        # trees not created by the streamer yet
+        self.missing = set(TREES)
+        self.deleted = 0
+
+    def tree_dir(self, tree: str) -> str:
+        return os.path.join(self.root, tree)
+
+    def watch(self, path: str, mask: int, tree: str, stream: Optional[Stream]) -> None:
+        wd = self.inotify.add_watch(path, mask)
+        if wd is None:
+            return
+        self.watches[wd] = (tree, stream.path if stream else None, path)
+        if stream:
+            stream.watches.append(wd)
+
+    def track(self, tree: str, path: str, activity: float) -> None:
+        stream = self.streams.get(path)
+        if stream:
+            stream.activity = max(stream.activity, activity)
+            return
+        stream = self.streams[path] = Stream(path, tree, activity)
+        # variant playlists may keep their segments in subdirectories
+        for directory, dirs, _ in os.walk(path):
+            self.watch(directory, STREAM_MASK, tree, stream)
+            if directory != path:
+                del dirs[:]
+        heapq.heappush(self.heap, (activity + self.ttls[tree], path))
+
+    def forget(self, path: str) -> None:
+        stream = self.streams.pop(path, None)
+        if stream:
+            for wd in stream.watches:
+                self.watches.pop(wd, None)
+                self.inotify.remove_watch(wd)
+            # its heap entry is dropped when it reaches the top
+
+    def watched(self, directory: str) -> bool:
+        return any(path == directory for _, _, path in self.watches.values())
+
+    def scan_tree(self, tree: str) -> None:
+        # first level only: the stream directories, never their segments
+        directory = self.tree_dir(tree)
+        if not self.watched(directory):
+            self.watch(directory, ROOT_MASK, tree, None)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.track(tree, entry.path, entry.stat(follow_symlinks=False).st_mtime)
+        except FileNotFoundError:
+            return
+        self.missing.discard(tree)
+
+    def scan(self) -> None:
+        # the streamer directory is watched first, so a tree created while
+        # scanning is not missed
+        if os.path.isdir(self.root) and not self.watched(self.root):
+            self.watch(self.root, ROOT_MASK, "", None)
+        for tree in TREES:
+            if os.path.isdir(self.tree_dir(tree)):
+                self.scan_tree(tree)
+            else:
+                self.missing.add(tree)
+        if self.missing:
+            print(f"Waiting for {', '.join(sorted(self.missing))} in {self.root}", flush=True)
+        print(f"Tracking {len(self.streams)} streams", flush=True)
+
+    def scan_missing(self) -> None:
+        # without the streamer directory there is nothing to watch yet
+        if self.missing and not self.watched(self.root) and os.path.isdir(self.root):
+            self.scan()
+
+    def handle_events(self) -> None:
+        now = time.time()
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, the stream directories are listed again
+                print("Warning: inotify queue overflow, rescanning stream directories")
+                self.scan()
+                continue
+            watch = self.watches.get(wd)
+            if not watch:
+                continue
+            tree, stream_path, directory = watch
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if not tree:
+                # the streamer directory, where the trees appear
+                if name not in TREES:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                    print(f"Tree {name} created, tracking its streams", flush=True)
+                    self.scan_tree(name)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    prefix = self.tree_dir(name) + os.sep
+                    for path in [path for path in self.streams if path.startswith(prefix)]:
+                        self.forget(path)
+                    self.missing.add(name)
+                continue
+            if stream_path is None:
+                path = os.path.join(directory, name)
+                if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                    self.track(tree, path, now)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.forget(path)
+                continue
+
+            stream = self.streams.get(stream_path)
+            if not stream:
+                continue
+            stream.activity = now
+            if mask & IN_CREATE and mask & IN_ISDIR:
+                self.watch(os.path.join(directory, name), STREAM_MASK, tree, stream)
+
+    def touch(self, stream_id: str, timestamp: float) -> None:
+        stream = self.streams.get(os.path.join(self.tree_dir("cods"), stream_id))
+        if stream:
+            stream.activity = max(stream.activity, timestamp)
+
+    def delete(self, stream: Stream, reason: str) -> None:
+        print(f"Deleting {stream.path} ({reason}, idle {time.time() - stream.activity:.0f}s)", flush=True)
+        self.forget(stream.path)
+        if not self.dry_run:
+            shutil.rmtree(stream.path, ignore_errors=True)
+        self.deleted += 1
+
+    def expire(self, now: float) -> None:
+        deleted = 0
+        while self.heap and self.heap[0][0] <= now and deleted < self.batch:
+            _, path = heapq.heappop(self.heap)
+            stream = self.streams.get(path)
+            if not stream:
+                continue
+            expiry = stream.activity + self.ttls[stream.tree]
+            if expiry > now:
+                # active since the entry was pushed
+                heapq.heappush(self.heap, (expiry, path))
+                continue
+            self.delete(stream, "ttl")
+            deleted += 1
+
+    def usage(self, tree: str) -> float:
+        stat = os.statvfs(self.tree_dir(tree))
+        total = stat.f_blocks * stat.f_frsize
+        if not total:
+            return 0.0
+        return 100.0 * (total - stat.f_bavail * stat.f_frsize) / total
+
+    def relieve_pressure(self, now: float) -> None:
+        # trees on the same filesystem are relieved together
+        filesystems = {}  # type: Dict[int, List[str]]
+        for tree in TREES:
+            if tree in self.missing:
+                continue
+            try:
+                filesystems.setdefault(os.stat(self.tree_dir(tree)).st_dev, []).append(tree)
+            except FileNotFoundError:
+                continue
+
+        for trees in filesystems.values():
+            if self.usage(trees[0]) < self.high_watermark:
+                continue
+            candidates = sorted((stream for stream in self.streams.values()
+                                 if stream.tree in trees and now - stream.activity >= self.min_idle),
+                                key=lambda stream: stream.activity)
+            deleted = 0
+            for stream in candidates:
+                if deleted >= self.batch or self.usage(trees[0]) < self.low_watermark:
+                    break
+                self.delete(stream, f"disk over {self.high_watermark}%")
+                deleted += 1
+
+
+class TouchFeed:
+    def __init__(self, url: str):
+        self.url = url
+        self.cursor = None  # type: Optional[int]
+
+    def fetch(self, query: str):
+        with urllib.request.urlopen(f"{self.url}{query}", timeout=2) as response:
+            return json.loads(response.read())
+
+    def poll(self, janitor: Janitor) -> None:
+        try:
+            if self.cursor is None:
+                # full listing, then follow the index from now on
+                started = int(time.time())
+                for record in self.fetch(""):
+                    janitor.touch(record["stream_id"], record["timestamp"])
+                self.cursor = self.fetch(f"?since={started}&limit=1")["cursor"] - 1
+                self.cursor = max(0, self.cursor)
+
+            while True:
+                page = self.fetch(f"?cursor={self.cursor}&limit={TOUCH_LIMIT}")
+                for record in page["files"]:
+                    janitor.touch(record["stream_id"], record["timestamp"])
+                self.cursor = page["cursor"]
+                if page["reset"]:
+                    self.cursor = None
+                    return
+                if not page["more"]:
+                    return
+        except (OSError, ValueError, KeyError) as ex:
+            # CODS site down or not installed, inotify still tracks segment writes
+            print(f"Warning: touched files feed unavailable: {ex}")
+            self.cursor = None
+
+
+def config_ttls() -> Dict[str, int]:
+    cods_ttl = DEFAULT_CODS_TTL
+    files_ttl = DEFAULT_FILES_TTL
+    for path in FASTOCLOUD_CONFIGS:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as f:
+            data = f.read()
+        match = re.search(r"^cods_ttl:\s*(\d+)", data, re.MULTILINE)
+        if match:
+            cods_ttl = int(match.group(1))
+        match = re.search(r"^files_ttl:\s*(\d+)", data, re.MULTILINE)
+        if match:
+            files_ttl = int(match.group(1))
+        break
+    return {"cods": cods_ttl, "hls": files_ttl, "proxy": files_ttl}
+
+
+def run(janitor: Janitor, feed: Optional[TouchFeed], touch_interval: float) -> None:
+    janitor.scan()
+    next_touch = 0.0
+    while True:
+        readable, _, _ = select.select([janitor.inotify.fd], [], [], TICK)
+        if readable:
+            janitor.handle_events()
+        janitor.scan_missing()
+        now = time.time()
+        if feed and now >= next_touch:
+            feed.poll(janitor)
+            next_touch = now + touch_interval
+        janitor.expire(now)
+        janitor.relieve_pressure(now)
+
+
+SERVICE_TEMPLATE = """[Unit]
+Description=FastoCloud TTL janitor for the cods, hls and proxy trees
+After=nginx.service
+
+[Service]
+ExecStart={python} {script} run
+Nice=10
+IOSchedulingClass=idle
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def install(prefix: str) -> None:
+    service = SERVICE_TEMPLATE.format(python=sys.executable, script=fastocloud_service.install_script(__file__, prefix))
+    fastocloud_service.install_units({SERVICE_UNIT + ".service": service}, SERVICE_UNIT + ".service")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="ttl_janitor", usage="%(prog)s [options] {run,install}")
+    parser.add_argument("command", choices=["run", "install"])
+    parser.add_argument("--root", help=f"streamer directory (default: {STREAMER_DIR})", default=STREAMER_DIR)
+    parser.add_argument("--cods-ttl", help="seconds (default: cods_ttl of the fastocloud config)", type=int)
+    parser.add_argument("--files-ttl", help="seconds for hls and proxy (default: files_ttl of the fastocloud config)",
+                        type=int)
+    parser.add_argument("--touched-files-url", help=f"CODS touch feed, empty to disable "
+                                                    f"(default: {TOUCHED_FILES_URL})", default=TOUCHED_FILES_URL)
+    parser.add_argument("--touch-interval", help=f"seconds between feed polls (default: {DEFAULT_TOUCH_INTERVAL})",
+                        type=float, default=DEFAULT_TOUCH_INTERVAL)
+    parser.add_argument("--batch", help=f"deletions per tick (default: {DEFAULT_BATCH})", type=int,
+                        default=DEFAULT_BATCH)
+    parser.add_argument("--high-watermark", help=f"disk usage percent that starts eviction "
+                                                 f"(default: {DEFAULT_HIGH_WATERMARK})", type=float,
+                        default=DEFAULT_HIGH_WATERMARK)
+    parser.add_argument("--low-watermark", help=f"disk usage percent that stops eviction "
+                                                f"(default: {DEFAULT_LOW_WATERMARK})", type=float,
+                        default=DEFAULT_LOW_WATERMARK)
+    parser.add_argument("--min-idle", help=f"seconds of inactivity before a stream can be evicted "
+                                           f"(default: {DEFAULT_MIN_IDLE})", type=float, default=DEFAULT_MIN_IDLE)
+    parser.add_argument("--dry-run", help="log deletions without deleting", action="store_true")
+    parser.add_argument("--prefix", help=f"install: environment prefix the service is installed into "
+                                         f"(default: {fastocloud_service.DEFAULT_PREFIX})",
+                        default=fastocloud_service.DEFAULT_PREFIX)
+    argv = parser.parse_args()
+
+    if argv.command == "install":
+        install(argv.prefix)
+        sys.exit(0)
+
+    ttls = config_ttls()
+    if argv.cods_ttl is not None:
+        ttls["cods"] = argv.cods_ttl
+    if argv.files_ttl is not None:
+        ttls["hls"] = ttls["proxy"] = argv.files_ttl
+
+    janitor = Janitor(argv.root, ttls, argv.batch, argv.high_watermark, argv.low_watermark, argv.min_idle,
+                      argv.dry_run)
+    feed = TouchFeed(argv.touched_files_url) if argv.touched_files_url else None
+    run(janitor, feed, argv.touch_interval)
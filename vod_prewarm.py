@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+import sys
+
+if sys.version_info < (3, 8):
+    print(
+        "Tried to start script with an unsupported version of Python. vod_prewarm requires Python 3.8 or greater"
+    )
+    sys.exit(1)
+
+import argparse
+import ctypes
+import ctypes.util
+import glob
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import time
+
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib import parse
+
+import fastocloud_service
+
+# Page-cache prewarming of the popular VOD files served by fastocloud_vods_83.
+#
+# Files are ranked by the bytes viewers fetched from them in the VODS access
+# logs, with an exponential decay so recent requests count most. Within the
+# memory budget the index atoms (moov/sidx/mfra) of every ranked MP4 are loaded
+# first, since a player needs them before its first seek, then whole files in
+# rank order. Residency is measured with mincore(2).
+#
+# The decayed scores and the offset reached in every log are kept in a state
+# file, so each run only reads the lines logged since the previous one.
+
+VODS_DIR = "/home/fastocloud/streamer/vods"
+LOG_GLOB = "/var/log/nginx/fastocloud_vods_*_access.log"
+STATE_PATH = "/var/lib/fastocloud/vod_prewarm.json"
+
+SERVICE_UNIT = "fastocloud-vod-prewarm"
+
+DEFAULT_BUDGET = "25%"
+DEFAULT_HALF_LIFE_HOURS = 6
+DEFAULT_TOP = 200
+DEFAULT_INTERVAL = 300
+# uris kept in the state per ranked file, the others have decayed out of reach
+STATE_URIS_PER_TOP = 20
+READ_SIZE = 4 * 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+INDEX_ATOMS = (b"moov", b"sidx", b"mfra")
+
+# fastocloud_json (nginx/fastocloud_common): time, uri, status, bytes sent and the weight of sampled lines
+JSON_PATTERN = re.compile(
+    rb'^\{"time":"[^"]*","msec":(\d+)\.\d+,"remote_addr":"[^"]*","method":"[^"]*","uri":"([^"\\]*(?:\\.[^"\\]*)*)",'
+    rb'"args":"[^"\\]*(?:\\.[^"\\]*)*","status":(\d+),"bytes_sent":(\d+),[^\n]*?(?:"weight":([\d.]+))?\}$',
+    re.MULTILINE,
+)
+# nginx "combined"
+COMBINED_PATTERN = re.compile(rb'^\S+ \S+ \S+ \[([^\]]+)\] "\S+ ([^ ?"]+)[^"]*" (\d{3}) (\d+) ', re.MULTILINE)
+
+PROT_READ = 1
+MAP_SHARED = 1
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+_libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+_libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+
+
+def parse_size(value: str) -> int:
+    if value.endswith("%"):
+        return int(mem_available() * float(value[:-1]) / 100)
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    suffix = value[-1:].lower()
+    if suffix in units:
+        return int(float(value[:-1]) * units[suffix])
+    return int(value)
+
+
+def mem_available() -> int:
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def read_chunks(path: str, offset: int):
+    # whole lines from offset, READ_SIZE at a time, with the offset after them
+    with open(path, "rb") as f:
+        f.seek(offset)
+        rest = b""
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            data = rest + chunk
+            end = data.rfind(b"\n") + 1
+            # a partially written last line is read again on the next run
+            rest = data[end:]
+            if end:
+                offset += end
+                yield data[:end], offset
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path: str, state: dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def popularity(logs: List[str], root: str, half_life: float, now: float, state: dict, top: int) -> Dict[str, float]:
+    # decayed bytes per file; a byte fetched half_life seconds ago counts half.
+    # state holds the uri weights as of its "time" and the offset reached in every log, it is updated in place
+    decay = math.log(2) / half_life
+    factor = math.exp(-decay * max(0.0, now - state.get("time", now)))
+    weights = {uri.encode(): weight * factor for uri, weight in state.get("uris", {}).items()}
+    offsets = state.get("offsets", {})  # type: Dict[str, int]
+    combined_times = {}  # type: Dict[bytes, float]
+    seen = {}  # type: Dict[str, int]
+    for path in logs:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # keyed by inode: a rotated log keeps its offset under its new name
+        key = f"{stat.st_dev}:{stat.st_ino}"
+        offset = offsets.get(key, 0)
+        if stat.st_size < offset:
+            # truncated (copytruncate)
+            offset = 0
+        seen[key] = offset
+        for data, offset in read_chunks(path, offset):
+            seen[key] = offset
+            if data[:1] == b"{":
+                # sampled segment hits stand for weight requests
+                matches = ((float(second), uri, status, int(sent) * (float(weight) if weight else 1.0))
+                           for second, uri, status, sent, weight in JSON_PATTERN.findall(data))
+            else:
+                matches = []
+                for stamp, uri, status, sent in COMBINED_PATTERN.findall(data):
+                    second = combined_times.get(stamp)
+                    if second is None:
+                        second = datetime.strptime(stamp.decode(), "%d/%b/%Y:%H:%M:%S %z").timestamp()
+                        combined_times[stamp] = second
+                    matches.append((second, uri, status, int(sent)))
+
+            for second, uri, status, sent in matches:
+                if status[:1] == b"2":
+                    weights[uri] = weights.get(uri, 0.0) + sent * math.exp(-decay * max(0.0, now - second))
+
+    kept = sorted(weights, key=weights.get, reverse=True)[:top * STATE_URIS_PER_TOP]
+    state["time"] = now
+    state["uris"] = {uri.decode(errors="replace"): weights[uri] for uri in kept}
+    state["offsets"] = seen
+
+    # paths are resolved once per uri, not per request
+    scores = {}  # type: Dict[str, float]
+    for uri, weight in weights.items():
+        file_path = os.path.normpath(os.path.join(root, parse.unquote(uri.decode(errors="replace")).lstrip("/")))
+        if file_path.startswith(root + os.sep) and os.path.isfile(file_path):
+            scores[file_path] = scores.get(file_path, 0.0) + weight
+    return scores
+
+
+def index_ranges(path: str) -> List[Tuple[int, int]]:
+    # (offset, length) of the top level MP4 index boxes
+    ranges = []
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = 0
+            while offset + 8 <= size:
+                f.seek(offset)
+                header = f.read(16)
+                box_size, box_type = struct.unpack(">I4s", header[:8])
+                if box_size == 1:
+                    box_size = struct.unpack(">Q", header[8:16])[0]
+                elif box_size == 0:
+                    box_size = size - offset
+                if box_size < 8 or not box_type.isalnum():
+                    # not an MP4 (MPEG-TS, broken file)
+                    break
+                if box_type in INDEX_ATOMS:
+                    ranges.append((offset, min(box_size, size - offset)))
+                offset += box_size
+    except (OSError, struct.error):
+        pass
+    return ranges
+
+
+def residency(path: str) -> Tuple[int, int]:
+    # (resident pages, total pages) from mincore(2)
+    size = os.path.getsize(path)
+    pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+    if not size:
+        return 0, 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = _libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if address in (None, MAP_FAILED):
+            raise OSError(ctypes.get_errno(), "mmap failed", path)
+        try:
+            vector = (ctypes.c_ubyte * pages)()
+            if _libc.mincore(address, size, vector) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed", path)
+            return sum(page & 1 for page in vector), pages
+        finally:
+            _libc.munmap(address, size)
+    finally:
+        os.close(fd)
+
+
+def warm(path: str, offset: int, length: int, method: str) -> None:
+    if not length:
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if method == "willneed":
+            # asynchronous readahead, the kernel may drop it under pressure
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        elif method == "mmap":
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(fd, length + offset - start, prot=mmap.PROT_READ, offset=start) as mapped:
+                mapped.madvise(mmap.MADV_WILLNEED)
+                # touch every page so the call returns once the range is resident
+                for position in range(0, len(mapped), PAGE_SIZE):
+                    mapped[position]
+        else:
+            end = offset + length
+            while offset < end:
+                data = os.pread(fd, min(READ_SIZE, end - offset), offset)
+                if not data:
+                    break
+                offset += len(data)
+    finally:
+        os.close(fd)
+
+
+def plan(scores: Dict[str, float], top: int, budget: int) -> Tuple[List[Tuple[str, int, int]], int]:
+    # ranges to load as (path, offset, length), and the bytes they take
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top]
+    ranges = []
+    indexed = {}  # type: Dict[str, List[Tuple[int, int]]]
+    used = 0
+    # index atoms of every ranked file first, they decide how fast playback starts and seeks
+    for path in ranked:
+        for offset, length in index_ranges(path):
+            if used + length <= budget:
+                ranges.append((path, offset, length))
+                indexed.setdefault(path, []).append((offset, length))
+                used += length
+    for path in ranked:
+        # the rest of the file: the index atoms are already planned
+        atoms = indexed.get(path, [])
+        size = os.path.getsize(path) - sum(length for _, length in atoms)
+        if used + size > budget:
+            continue
+        position = 0
+        for offset, length in sorted(atoms) + [(os.path.getsize(path), 0)]:
+            if offset > position:
+                ranges.append((path, position, offset - position))
+            position = max(position, offset + length)
+        used += size
+    return ranges, used
+
+
+def prewarm(logs: List[str], root: str, budget: int, top: int, half_life: float, method: str,
+            state_path: str) -> List[str]:
+    started = time.monotonic()
+    state = load_state(state_path)
+    scores = popularity(logs, os.path.abspath(root), half_life, time.time(), state, top)
+    save_state(state_path, state)
+    ranges, total = plan(scores, top, budget)
+    for path, offset, length in ranges:
+        try:
+            warm(path, offset, length, method)
+        except OSError as ex:
+            print(f"Warning: failed to prewarm {path}: {ex}")
+
+    files = list(dict.fromkeys(path for path, _, _ in ranges))
+    print(f"Prewarmed {len(files)} of {len(scores)} requested files, {total >> 20} MiB of "
+          f"{budget >> 20} MiB budget in {time.monotonic() - started:.1f}s", flush=True)
+    return files
+
+
+def report(paths: List[str]) -> None:
+    print("resident%  resident_mib  size_mib  file")
+    for path in paths:
+        try:
+            resident, pages = residency(path)
+        except OSError as ex:
+            print(f"{'-':>9s}  {'-':>12s}  {'-':>8s}  {path} ({ex})")
+            continue
+        percent = 100.0 * resident / pages if pages else 100.0
+        print(f"{percent:9.1f}  {resident * PAGE_SIZE / (1 << 20):12.1f}  {pages * PAGE_SIZE / (1 << 20):8.1f}  "
+              f"{path}")
+
+
+SERVICE_TEMPLATE = """[Unit]
+Description=FastoCloud VOD page-cache prewarming
+After=nginx.service
+
+[Service]
+ExecStart={python} {script} run --budget {budget} --interval {interval} --state {state}
+Nice=10
+IOSchedulingClass=idle
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def install(budget: str, interval: int, state_path: str, prefix: str) -> None:
+    # "%" starts a specifier in unit files
+    service = SERVICE_TEMPLATE.format(python=sys.executable, script=fastocloud_service.install_script(__file__, prefix),
+                                      budget=budget.replace("%", "%%"), interval=interval,
+                                      state=os.path.abspath(state_path).replace("%", "%%"))
+    fastocloud_service.install_units({SERVICE_UNIT + ".service": service}, SERVICE_UNIT + ".service")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="vod_prewarm", usage="%(prog)s [options] {once,run,report,install}")
+    parser.add_argument("command", choices=["once", "run", "report", "install"])
+    parser.add_argument("files", nargs="*", help="files to report (default: the ranked files)")
+    parser.add_argument("--root", help=f"VODS directory (default: {VODS_DIR})", default=VODS_DIR)
+    parser.add_argument("--log", help=f"access logs (default: {LOG_GLOB} and rotated .1)", action="append")
+    parser.add_argument("--budget", help=f"page cache to fill, bytes (k/m/g) or %% of available memory "
+                                         f"(default: {DEFAULT_BUDGET.replace('%', '%%')})", default=DEFAULT_BUDGET)
+    parser.add_argument("--top", help=f"most popular files considered (default: {DEFAULT_TOP})", type=int,
+                        default=DEFAULT_TOP)
+    parser.add_argument("--half-life", help=f"hours for a request to lose half its weight "
+                                            f"(default: {DEFAULT_HALF_LIFE_HOURS})", type=float,
+                        default=DEFAULT_HALF_LIFE_HOURS)
+    parser.add_argument("--method", help="willneed: fadvise readahead, mmap: madvise and touch, read: pread "
+                                         "(default: read)", choices=["willneed", "mmap", "read"], default="read")
+    parser.add_argument("--interval", help=f"seconds between runs (default: {DEFAULT_INTERVAL})", type=int,
+                        default=DEFAULT_INTERVAL)
+    parser.add_argument("--state", help=f"decayed scores and log offsets (default: {STATE_PATH})",
+                        default=STATE_PATH)
+    parser.add_argument("--prefix", help=f"install: environment prefix the service is installed into "
+                                         f"(default: {fastocloud_service.DEFAULT_PREFIX})",
+                        default=fastocloud_service.DEFAULT_PREFIX)
+    argv = parser.parse_args()
+
+    logs = argv.log or sorted(glob.glob(LOG_GLOB) + glob.glob(LOG_GLOB + ".1"))
+    half_life = argv.half_life * 3600
+
+    if argv.command == "install":
+        install(argv.budget, argv.interval, argv.state, argv.prefix)
+    elif argv.command == "report":
+        paths = argv.files
+        if not paths:
+            # ranks with the lines logged since the last run, without saving the state
+            scores = popularity(logs, os.path.abspath(argv.root), half_life, time.time(), load_state(argv.state),
+                                argv.top)
+            paths = sorted(scores, key=scores.get, reverse=True)[:argv.top]
+        report(paths)
+    elif argv.command == "once":
+        report(prewarm(logs, argv.root, parse_size(argv.budget), argv.top, half_life, argv.method, argv.state))
+    else:
+        while True:
+            # the budget follows the memory available at every run
+            prewarm(logs, argv.root, parse_size(argv.budget), argv.top, half_life, argv.method, argv.state)
+            time.sleep(argv.interval)